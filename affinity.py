@@ -0,0 +1,126 @@
+"""Local retrieval index scoring AI suggestions against the rated collection."""
+import zlib
+
+import numpy as np
+
+from collection import as_collection
+from titles import normalize_titles
+
+# Hashed feature space of the title vectors
+EMBED_DIM = 2 ** 18
+NGRAM_SIZES = (3, 4)
+# Neighbours used to estimate how the user rates similar titles
+TOP_K = 10
+# Cosine similarity above which a suggestion is a near-duplicate of a seen title
+NEAR_DUPLICATE_THRESHOLD = 0.75
+# Affinity (in standard deviations of the user's ratings) below which a
+# suggestion is dropped
+LOW_AFFINITY = -1.0
+# Weight of the category affinity vs. the title neighbours affinity
+CATEGORY_WEIGHT = 0.5
+
+
+def _feature_ids(norm_title):
+    """Hashed character n-gram ids of a normalized title."""
+    padded = f"^{norm_title}$"
+    return [
+        zlib.crc32(padded[i:i + n].encode("ascii")) % EMBED_DIM
+        for n in NGRAM_SIZES
+        for i in range(len(padded) - n + 1)
+    ]
+
+
+def _term_counts(norm_titles):
+    """Sparse n-gram counts as (rows, feature ids, counts) arrays, one entry per pair."""
+    rows, cols = [], []
+    for row, norm_title in enumerate(norm_titles):
+        ids = _feature_ids(norm_title)
+        rows.extend([row] * len(ids))
+        cols.extend(ids)
+
+    keys = np.asarray(rows, dtype=np.int64) * EMBED_DIM + np.asarray(cols, dtype=np.int64)
+    keys, counts = np.unique(keys, return_counts=True)
+    return keys // EMBED_DIM, keys % EMBED_DIM, counts.astype(np.float32)
+
+
+def _tfidf(rows, cols, counts, idf, n_rows):
+    """L2-normalized TF-IDF weights of sparse term counts."""
+    values = counts * idf[cols]
+    norms = np.sqrt(np.bincount(rows, weights=values ** 2, minlength=n_rows)).astype(np.float32)
+    norms[norms == 0] = 1.0
+    return values / norms[rows]
+
+
+class AffinityIndex:
+    """TF-IDF vectors of the user's rated titles, with their ratings.
+
+    Suggestions are embedded the same way and scored against the whole
+    collection at once through a column-major sparse layout: the closest
+    seen title flags near-duplicates, and the similarity-weighted ratings
+    of the nearest titles plus the user's average rating of the suggested
+    category give an affinity score, in standard deviations of the user's
+    ratings.
+    """
+
+    def __init__(self, collection):
+        collection = as_collection(collection)
+        self._size = len(collection)
+        ratings = collection.ratings
+        mean = float(ratings.mean()) if self._size else 0.0
+        std = float(ratings.std()) if self._size else 0.0
+        self._z = (ratings - mean) / (std or 1.0)
+
+        rows, cols, counts = _term_counts(collection.norm_titles)
+        document_frequency = np.bincount(cols, minlength=EMBED_DIM)
+        self._idf = (np.log((1 + self._size) / (1 + document_frequency)) + 1).astype(np.float32)
+        values = _tfidf(rows, cols, counts, self._idf, self._size)
+
+        # Column-major layout: rows and weights of each feature are contiguous
+        order = np.argsort(cols, kind="stable")
+        self._rows = rows[order]
+        self._values = values[order]
+        self._indptr = np.concatenate(([0], np.cumsum(document_frequency)))
+
+        self._category_affinity = {
+            category.lower(): float(self._z[collection.category_indices(category)].mean())
+            for category in collection.categories
+        }
+
+    def __len__(self):
+        return self._size
+
+    def similarities(self, norm_titles):
+        """Cosine similarity of each title to every collection item (dense m x n)."""
+        rows, cols, counts = _term_counts(norm_titles)
+        values = _tfidf(rows, cols, counts, self._idf, len(norm_titles))
+
+        starts = self._indptr[cols]
+        lengths = self._indptr[cols + 1] - starts
+        total = int(lengths.sum())
+        # Positions of every posting of every query feature, concatenated
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+
+        cells = np.repeat(rows, lengths) * self._size + self._rows[offsets]
+        weights = np.repeat(values, lengths) * self._values[offsets]
+        result = np.bincount(cells, weights=weights, minlength=len(norm_titles) * self._size)
+        return result.reshape(len(norm_titles), self._size).astype(np.float32)
+
+    def score(self, suggestions):
+        """Return (max similarity, affinity) arrays for a batch of suggestions."""
+        if not suggestions or not self._size:
+            zeros = np.zeros(len(suggestions), dtype=np.float32)
+            return zeros, zeros
+
+        similarities = self.similarities(normalize_titles(s["title"] for s in suggestions))
+
+        k = min(TOP_K, self._size)
+        neighbours = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        weights = np.take_along_axis(similarities, neighbours, axis=1).clip(min=0)
+        neighbour_affinity = (weights * self._z[neighbours]).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-6)
+
+        category_affinity = np.asarray(
+            [self._category_affinity.get(s["category"].strip().lower(), 0.0) for s in suggestions],
+            dtype=np.float32
+        )
+        affinity = CATEGORY_WEIGHT * category_affinity + (1 - CATEGORY_WEIGHT) * neighbour_affinity
+        return similarities.max(axis=1), affinity
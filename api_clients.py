@@ -1,21 +1,86 @@
 import asyncio
+import random
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+
 import aiohttp
-import requests
+import ijson
 from dotenv import load_dotenv
 
+from cache_utils import TTLCache
+from collection import rated_items
+from product_index import ProductIndex, best_match, product_key, rating_query
+from rate_limit import APOLLO, limiter, retry_after
+from titles import normalize_titles
+from tracing import span
+
 load_dotenv()
 
+SC_URL = "https://apollo.senscritique.com/"
+SC_HEADERS = {
+    'accept': '*/*',
+    'content-type': 'application/json',
+    'origin': 'https://www.senscritique.com',
+    'user-agent': 'Mozilla/5.0'
+}
 
-async def fetch_senscritique_page(session, username, offset, limit, progress_callback=None):
-    """Fetch a single page of SensCritique collection results."""
-    headers = {
-        'accept': '*/*',
-        'content-type': 'application/json',
-        'origin': 'https://www.senscritique.com',
-        'user-agent': 'Mozilla/5.0'
-    }
+# Collection pagination: pages in flight and adaptive page size bounds
+FETCH_CONCURRENCY = 4
+PAGE_SIZE = 1000
+MIN_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+TARGET_PAGE_LATENCY = 3.0
+# Retries of 429/5xx answers, with jittered exponential backoff (seconds)
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+# Page size used when refreshing a cached collection
+DELTA_PAGE_SIZE = 100
+# Consecutive entries that must match the cached order to stop a refresh
+SYNC_WINDOW = 5
+# Larger deltas are cheaper to re-fetch with full concurrent pagination
+DELTA_MAX_PAGES = 10
+# Concurrent global rating searches and how long their results are reused
+RATING_CONCURRENCY = 8
+RATING_CACHE_SIZE = 10000
+RATING_CACHE_TTL = 7 * 24 * 3600
+# Search results compared against each suggestion
+SEARCH_LIMIT = 16
+# Known products whose rating is fetched in one request
+PRODUCT_BATCH_SIZE = 50
+
+USER_COLLECTION_QUERY = 'query UserCollection($action: ProductAction, $categoryId: Int, $gameSystemId: Int, $genreId: Int, $isAgenda: Boolean, $keywords: String, $limit: Int, $month: Int, $offset: Int, $order: CollectionSort, $showTvAgenda: Boolean, $universe: String, $username: String!, $versus: Boolean, $year: Int, $yearDateDone: Int, $yearDateRelease: Int, $isCollection: Boolean, $minDateRelease: Int, $maxDateRelease: Int) {\n  user(username: $username) {\n    ...UserMinimal\n    ...ProfileStats\n    notificationSettings {\n      alertAgenda\n      __typename\n    }\n    collection(\n      action: $action\n      categoryId: $categoryId\n      gameSystemId: $gameSystemId\n      genreId: $genreId\n      isAgenda: $isAgenda\n      keywords: $keywords\n      limit: $limit\n      month: $month\n      offset: $offset\n      order: $order\n      showTvAgenda: $showTvAgenda\n      universe: $universe\n      versus: $versus\n      year: $year\n      yearDateDone: $yearDateDone\n      yearDateRelease: $yearDateRelease\n      isCollection: $isCollection\n      minDateRelease: $minDateRelease\n      maxDateRelease: $maxDateRelease\n    ) {\n      total\n      filters {\n        action {\n          count\n          label\n          value\n          __typename\n        }\n        category {\n          count\n          label\n          value\n          __typename\n        }\n        gamesystem {\n          count\n          label\n          value\n          __typename\n        }\n        genre {\n          count\n          label\n          value\n          __typename\n        }\n        monthDateDone {\n          count\n          label\n          value\n          __typename\n        }\n        releaseDate {\n          count\n          label\n          value\n          __typename\n        }\n        universe {\n          count\n          label\n          value\n          __typename\n        }\n        yearDateDone {\n          count\n          label\n          value\n          __typename\n        }\n        __typename\n      }\n      periodDateRelease {\n        max\n        min\n        __typename\n      }\n      products {\n        ...ProductList\n        episodeNumber\n        seasonNumber\n        totalEpisodes\n        preloadedParentTvShow {\n          ...ProductList\n          __typename\n        }\n        scoutsAverage {\n          average\n          count\n          __typename\n        }\n        currentUserInfos {\n          ...ProductUserInfos\n          __typename\n        }\n        otherUserInfos(username: $username) {\n          ...ProductUserInfos\n          lists {\n            id\n            label\n            listSubtype\n            url\n            __typename\n          }\n          review {\n            id\n            title\n            url\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      tvProducts {\n        infos {\n          channel {\n            id\n            label\n            __typename\n          }\n          showTimes {\n            id\n            dateEnd\n            dateStart\n            __typename\n          }\n          __typename\n        }\n        product {\n          ...ProductList\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n\nfragment UserMinimal on User {\n  ...UserNano\n  dateCreation\n  settings {\n    about\n    birthDate\n    country\n    dateLastSession\n    displayedName\n    email\n    firstName\n    gender\n    lastName\n    privacyName\n    privacyProfile\n    showAge\n    showGender\n    showProfileType\n    urlWebsite\n    username\n    zipCode\n    __typename\n  }\n  __typename\n}\n\nfragment UserNano on User {\n  following\n  hasBlockedMe\n  id\n  isBlocked\n  isScout\n  name\n  url\n  username\n  medias {\n    avatar\n    backdrop\n    __typename\n  }\n  __typename\n}\n\nfragment ProductList on Product {\n  category\n  channel\n  dateRelease\n  dateReleaseEarlyAccess\n  dateReleaseJP\n  dateReleaseOriginal\n  dateReleaseUS\n  displayedYear\n  duration\n  episodeNumber\n  seasonNumber\n  frenchReleaseDate\n  id\n  numberOfSeasons\n  originalRun\n  originalTitle\n  rating\n  slug\n  subtitle\n  title\n  universe\n  url\n  yearOfProduction\n  canalVOD {\n    url\n    __typename\n  }\n  tvChannel {\n    name\n    url\n    __typename\n  }\n  countries {\n    id\n    name\n    __typename\n  }\n  gameSystems {\n    id\n    label\n    __typename\n  }\n  medias {\n    picture\n    __typename\n  }\n  genresInfos {\n    label\n    __typename\n  }\n  artists {\n    name\n    person_id\n    url\n    __typename\n  }\n  authors {\n    name\n    person_id\n    url\n    __typename\n  }\n  creators {\n    name\n    person_id\n    url\n    __typename\n  }\n  developers {\n    name\n    person_id\n    url\n    __typename\n  }\n  directors {\n    name\n    person_id\n    url\n    __typename\n  }\n  pencillers {\n    name\n    person_id\n    url\n    __typename\n  }\n  stats {\n    ratingCount\n    __typename\n  }\n  __typename\n}\n\nfragment ProductUserInfos on ProductUserInfos {\n  dateDone\n  hasStartedReview\n  isCurrent\n  id\n  isDone\n  isListed\n  isRecommended\n  isReviewed\n  isWished\n  productId\n  rating\n  userId\n  numberEpisodeDone\n  lastEpisodeDone {\n    episodeNumber\n    id\n    season {\n      seasonNumber\n      id\n      episodes {\n        title\n        id\n        episodeNumber\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n  gameSystem {\n    id\n    label\n    __typename\n  }\n  review {\n    author {\n      id\n      name\n      __typename\n    }\n    url\n    __typename\n  }\n  __typename\n}\n\nfragment ProfileStats on User {\n  likePositiveCountStats {\n    contact\n    feed\n    list\n    paramIndex\n    review\n    total\n    __typename\n  }\n  stats {\n    ...UserStatsData\n    __typename\n  }\n  __typename\n}\n\nfragment UserStatsData on UserStats {\n  collectionCount\n  diaryCount\n  listCount\n  pollCount\n  topCount\n  followerCount\n  ratingCount\n  reviewCount\n  scoutCount\n  __typename\n}\n'
+
+# Only the fields turned into collection entries
+USER_COLLECTION_MINIMAL_QUERY = 'query UserCollection($limit: Int, $offset: Int, $order: CollectionSort, $username: String!, $isCollection: Boolean) {\n  user(username: $username) {\n    collection(\n      limit: $limit\n      offset: $offset\n      order: $order\n      isCollection: $isCollection\n    ) {\n      total\n      products {\n        id\n        title\n        category\n        displayedYear\n        otherUserInfos(username: $username) {\n          rating\n        }\n      }\n    }\n  }\n}\n'
 
-    json_data = {
+COLLECTION_QUERIES = {
+    "full": USER_COLLECTION_QUERY,
+    "minimal": USER_COLLECTION_MINIMAL_QUERY,
+}
+TOTAL_PREFIX = "data.user.collection.total"
+PRODUCTS_PREFIX = "data.user.collection.products.item"
+# Event prefix of each product field kept in a collection entry
+_ENTRY_FIELDS = {
+    f"{PRODUCTS_PREFIX}.id": "id",
+    f"{PRODUCTS_PREFIX}.title": "title",
+    f"{PRODUCTS_PREFIX}.category": "category",
+    f"{PRODUCTS_PREFIX}.displayedYear": "year",
+    f"{PRODUCTS_PREFIX}.otherUserInfos.rating": "rating_sc",
+}
+
+# Global ratings keyed by product_key, shared by every lookup
+rating_cache = TTLCache(maxsize=RATING_CACHE_SIZE, ttl=RATING_CACHE_TTL)
+# Product each rating query resolved to, persisted across runs
+product_index = ProductIndex()
+
+
+def _collection_payload(username, offset, limit, projection="minimal"):
+    """GraphQL payload of a UserCollection page in the given projection."""
+    if projection not in COLLECTION_QUERIES:
+        raise ValueError(f"Unknown collection projection: {projection}")
+    return {
         "operationName": "UserCollection",
         "variables": {
             "username": username,
@@ -24,31 +89,107 @@ async def fetch_senscritique_page(session, username, offset, limit, progress_cal
             "order": "LAST_ACTION_DESC",
             "isCollection": True
         },
-        "query": 'query UserCollection($action: ProductAction, $categoryId: Int, $gameSystemId: Int, $genreId: Int, $isAgenda: Boolean, $keywords: String, $limit: Int, $month: Int, $offset: Int, $order: CollectionSort, $showTvAgenda: Boolean, $universe: String, $username: String!, $versus: Boolean, $year: Int, $yearDateDone: Int, $yearDateRelease: Int, $isCollection: Boolean, $minDateRelease: Int, $maxDateRelease: Int) {\n  user(username: $username) {\n    ...UserMinimal\n    ...ProfileStats\n    notificationSettings {\n      alertAgenda\n      __typename\n    }\n    collection(\n      action: $action\n      categoryId: $categoryId\n      gameSystemId: $gameSystemId\n      genreId: $genreId\n      isAgenda: $isAgenda\n      keywords: $keywords\n      limit: $limit\n      month: $month\n      offset: $offset\n      order: $order\n      showTvAgenda: $showTvAgenda\n      universe: $universe\n      versus: $versus\n      year: $year\n      yearDateDone: $yearDateDone\n      yearDateRelease: $yearDateRelease\n      isCollection: $isCollection\n      minDateRelease: $minDateRelease\n      maxDateRelease: $maxDateRelease\n    ) {\n      total\n      filters {\n        action {\n          count\n          label\n          value\n          __typename\n        }\n        category {\n          count\n          label\n          value\n          __typename\n        }\n        gamesystem {\n          count\n          label\n          value\n          __typename\n        }\n        genre {\n          count\n          label\n          value\n          __typename\n        }\n        monthDateDone {\n          count\n          label\n          value\n          __typename\n        }\n        releaseDate {\n          count\n          label\n          value\n          __typename\n        }\n        universe {\n          count\n          label\n          value\n          __typename\n        }\n        yearDateDone {\n          count\n          label\n          value\n          __typename\n        }\n        __typename\n      }\n      periodDateRelease {\n        max\n        min\n        __typename\n      }\n      products {\n        ...ProductList\n        episodeNumber\n        seasonNumber\n        totalEpisodes\n        preloadedParentTvShow {\n          ...ProductList\n          __typename\n        }\n        scoutsAverage {\n          average\n          count\n          __typename\n        }\n        currentUserInfos {\n          ...ProductUserInfos\n          __typename\n        }\n        otherUserInfos(username: $username) {\n          ...ProductUserInfos\n          lists {\n            id\n            label\n            listSubtype\n            url\n            __typename\n          }\n          review {\n            id\n            title\n            url\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      tvProducts {\n        infos {\n          channel {\n            id\n            label\n            __typename\n          }\n          showTimes {\n            id\n            dateEnd\n            dateStart\n            __typename\n          }\n          __typename\n        }\n        product {\n          ...ProductList\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n\nfragment UserMinimal on User {\n  ...UserNano\n  dateCreation\n  settings {\n    about\n    birthDate\n    country\n    dateLastSession\n    displayedName\n    email\n    firstName\n    gender\n    lastName\n    privacyName\n    privacyProfile\n    showAge\n    showGender\n    showProfileType\n    urlWebsite\n    username\n    zipCode\n    __typename\n  }\n  __typename\n}\n\nfragment UserNano on User {\n  following\n  hasBlockedMe\n  id\n  isBlocked\n  isScout\n  name\n  url\n  username\n  medias {\n    avatar\n    backdrop\n    __typename\n  }\n  __typename\n}\n\nfragment ProductList on Product {\n  category\n  channel\n  dateRelease\n  dateReleaseEarlyAccess\n  dateReleaseJP\n  dateReleaseOriginal\n  dateReleaseUS\n  displayedYear\n  duration\n  episodeNumber\n  seasonNumber\n  frenchReleaseDate\n  id\n  numberOfSeasons\n  originalRun\n  originalTitle\n  rating\n  slug\n  subtitle\n  title\n  universe\n  url\n  yearOfProduction\n  canalVOD {\n    url\n    __typename\n  }\n  tvChannel {\n    name\n    url\n    __typename\n  }\n  countries {\n    id\n    name\n    __typename\n  }\n  gameSystems {\n    id\n    label\n    __typename\n  }\n  medias {\n    picture\n    __typename\n  }\n  genresInfos {\n    label\n    __typename\n  }\n  artists {\n    name\n    person_id\n    url\n    __typename\n  }\n  authors {\n    name\n    person_id\n    url\n    __typename\n  }\n  creators {\n    name\n    person_id\n    url\n    __typename\n  }\n  developers {\n    name\n    person_id\n    url\n    __typename\n  }\n  directors {\n    name\n    person_id\n    url\n    __typename\n  }\n  pencillers {\n    name\n    person_id\n    url\n    __typename\n  }\n  stats {\n    ratingCount\n    __typename\n  }\n  __typename\n}\n\nfragment ProductUserInfos on ProductUserInfos {\n  dateDone\n  hasStartedReview\n  isCurrent\n  id\n  isDone\n  isListed\n  isRecommended\n  isReviewed\n  isWished\n  productId\n  rating\n  userId\n  numberEpisodeDone\n  lastEpisodeDone {\n    episodeNumber\n    id\n    season {\n      seasonNumber\n      id\n      episodes {\n        title\n        id\n        episodeNumber\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n  gameSystem {\n    id\n    label\n    __typename\n  }\n  review {\n    author {\n      id\n      name\n      __typename\n    }\n    url\n    __typename\n  }\n  __typename\n}\n\nfragment ProfileStats on User {\n  likePositiveCountStats {\n    contact\n    feed\n    list\n    paramIndex\n    review\n    total\n    __typename\n  }\n  stats {\n    ...UserStatsData\n    __typename\n  }\n  __typename\n}\n\nfragment UserStatsData on UserStats {\n  collectionCount\n  diaryCount\n  listCount\n  pollCount\n  topCount\n  followerCount\n  ratingCount\n  reviewCount\n  scoutCount\n  __typename\n}\n'
+        "query": COLLECTION_QUERIES[projection]
     }
 
-    async with session.post("https://apollo.senscritique.com/", headers=headers, json=json_data) as response:
-        if response.status != 200:
-            raise RuntimeError(f"SensCritique error: {response.status}")
-        
-        data = await response.json()
-        
-    collection_data = data.get("data", {}).get("user", {}).get("collection", {})
-    products = collection_data.get("products", [])
-    total = collection_data.get("total", 0)
-
-    items = []
-    for p in products:
-        title = p.get("title")
-        rating = p.get("otherUserInfos", {}).get("rating")
-        category = p.get("category")
-
-        if title and rating is not None and category:
-            items.append({
-                "title": title,
-                "rating_sc": float(rating),
-                "category": category
-            })
+
+def _parse_entry(product):
+    """Raw collection entry (id, title, user rating, category, year) of a product."""
+    rating = (product.get("otherUserInfos") or {}).get("rating")
+    return {
+        "id": product.get("id"),
+        "title": product.get("title"),
+        "rating_sc": float(rating) if rating is not None else None,
+        "category": product.get("category"),
+        "year": product.get("displayedYear")
+    }
+
+
+async def _stream_collection_entries(response):
+    """Decode a UserCollection response incrementally, one product at a time.
+
+    Only the fields of each product that make up an entry are picked from
+    the event stream; products are never materialized as nested objects.
+    Raises SensCritiqueError if the answer reports errors or no such user.
+    """
+    entries = []
+    total = 0
+    entry = None
+    errors = []
+    user_found = False
+
+    async for prefix, event, value in ijson.parse_async(response.content, use_float=True):
+        if entry is not None:
+            field = _ENTRY_FIELDS.get(prefix)
+            if field is not None and event in ("string", "number"):
+                entry[field] = value
+            elif prefix == PRODUCTS_PREFIX and event == "end_map":
+                if entry["rating_sc"] is not None:
+                    entry["rating_sc"] = float(entry["rating_sc"])
+                entries.append(entry)
+                entry = None
+        elif prefix == PRODUCTS_PREFIX and event == "start_map":
+            entry = {"id": None, "title": None, "rating_sc": None, "category": None, "year": None}
+        elif prefix == TOTAL_PREFIX and event == "number":
+            total = int(value)
+        elif prefix == "data.user" and event == "start_map":
+            user_found = True
+        elif prefix == "errors.item" and event == "start_map":
+            errors.append(None)
+        elif prefix == "errors.item.message" and event == "string":
+            errors[-1] = value
+
+    error = _graphql_error(errors, user_found)
+    if error is not None:
+        raise error
+    return entries, total
+
+
+async def fetch_senscritique_entries(session, username, offset, limit, projection="minimal"):
+    """Fetch a single page of raw SensCritique collection entries, rated or not.
+
+    The "minimal" projection only requests the fields the recommender uses
+    and decodes the body as it streams in; "full" sends the complete
+    UserCollection query of the SensCritique website.
+    """
+    json_data = _collection_payload(username, offset, limit, projection)
+
+    with span("collection.page", offset=offset, limit=limit, projection=projection) as page_span:
+        async with apollo_post(session, json_data) as response:
+            page_span.set(status=response.status)
+            if response.status != 200:
+                raise SensCritiqueError(response.status, _retry_after(response))
+
+            if projection == "minimal":
+                entries, total = await _stream_collection_entries(response)
+                page_span.set(entries=len(entries))
+                return _add_norm_titles(entries), total
+
+            data = await response.json()
+
+        user = (data.get("data") or {}).get("user")
+        error = _graphql_error([e.get("message") for e in data.get("errors") or []], user is not None)
+        if error is not None:
+            raise error
+        collection_data = user.get("collection") or {}
+        products = collection_data.get("products", [])
+        total = collection_data.get("total", 0)
+        page_span.set(entries=len(products))
+
+        return _add_norm_titles([_parse_entry(p) for p in products]), total
+
+
+def _add_norm_titles(entries):
+    """Attach the normalized title of each entry, computed in one batch."""
+    for entry, norm in zip(entries, normalize_titles(e["title"] for e in entries)):
+        entry["norm_title"] = norm
+    return entries
+
+
+async def fetch_senscritique_page(session, username, offset, limit, progress_callback=None):
+    """Fetch a single page of SensCritique collection results."""
+    entries, total = await fetch_senscritique_entries(session, username, offset, limit)
+    items = rated_items(entries)
     
     if progress_callback:
         progress_callback(offset + len(items), total)
@@ -56,71 +197,437 @@ async def fetch_senscritique_page(session, username, offset, limit, progress_cal
     return items, total
 
 
-async def fetch_senscritique_collection_async(username, progress_callback=None):
-    """Fetch complete SensCritique collection using concurrent pagination."""
-    limit = 1000
-    all_items = []
-    
+class SensCritiqueError(RuntimeError):
+    """Non-200 answer from the SensCritique API, or an answer reporting errors."""
+
+    def __init__(self, status, retry_after=None, message=None):
+        super().__init__(message or f"SensCritique error: {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.status == 429 or self.status >= 500
+
+
+def _graphql_error(errors, user_found):
+    """SensCritiqueError for a collection answer with GraphQL `errors` or no user, else None."""
+    if errors:
+        messages = "; ".join(m or "unknown error" for m in errors)
+        return SensCritiqueError(200, message=f"SensCritique GraphQL error: {messages}")
+    if not user_found:
+        # Unknown username, or a profile that is not public
+        return SensCritiqueError(404, message="SensCritique: unknown or private user")
+    return None
+
+
+class IncompleteCollectionError(RuntimeError):
+    """Collection pages still failing after their retries."""
+
+    def __init__(self, n_failed, fetched, total):
+        super().__init__(f"SensCritique: {n_failed} page(s) of the collection could not be fetched "
+                         f"({fetched}/{total} entries)")
+
+
+def _retry_after(response):
+    """Seconds to wait according to a Retry-After header, if any."""
+    return retry_after(response.headers)
+
+
+@asynccontextmanager
+async def apollo_post(session, payload):
+    """POST a GraphQL payload within the shared Apollo budget (see rate_limit).
+
+    A 429 answer pauses the budget for every caller until its Retry-After.
+    """
+    await limiter.acquire(APOLLO)
+    async with session.post(SC_URL, headers=SC_HEADERS, json=payload) as response:
+        if response.status == 429:
+            limiter.throttle(APOLLO, _retry_after(response))
+        yield response
+
+
+def _backoff_delay(attempt, retry_after=None):
+    """Jittered exponential backoff, never shorter than the server's Retry-After."""
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+async def fetch_entries_with_retry(session, username, offset, limit):
+    """Fetch a collection page, retrying 429/5xx and network errors with backoff."""
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return await fetch_senscritique_entries(session, username, offset, limit)
+        except SensCritiqueError as e:
+            if not e.retryable or attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(_backoff_delay(attempt, e.retry_after))
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(_backoff_delay(attempt))
+
+
+async def fetch_all_entries(session, username, progress_callback=None, concurrency=FETCH_CONCURRENCY):
+    """Fetch every raw collection entry using concurrent pagination.
+
+    At most `concurrency` pages are in flight. The page size starts at
+    PAGE_SIZE and adapts to the observed latency: halved when a page takes
+    longer than TARGET_PAGE_LATENCY, doubled back when it is much faster.
+    A page failing with a retryable error is retried on its own with
+    backoff while the other pages keep going, so the pages already
+    fetched are not requested again during this fetch. Pages still
+    failing after MAX_RETRIES are reported together once the others are
+    done, as an IncompleteCollectionError; nothing is kept of an
+    incomplete fetch, and the next one starts over.
+    """
+    page_size = PAGE_SIZE
+    pages = {}
+    fetched = 0
+
+    def page_done(offset, page, total, elapsed):
+        nonlocal fetched, page_size
+        pages[offset] = page
+        fetched += len(page)
+        if elapsed > TARGET_PAGE_LATENCY:
+            page_size = max(MIN_PAGE_SIZE, page_size // 2)
+        elif elapsed < TARGET_PAGE_LATENCY / 4:
+            page_size = min(MAX_PAGE_SIZE, page_size * 2)
+        if progress_callback:
+            progress_callback(min(fetched, total), total)
+
+    start = time.monotonic()
+    first_page, total = await fetch_entries_with_retry(session, username, 0, page_size)
+    page_done(0, first_page, total, time.monotonic() - start)
+    next_offset = len(first_page) if first_page else total
+
+    # Ranges left over when the server returns a shorter page than asked
+    gaps = []
+    # (offset, limit) and error of each page that failed for good
+    failures = []
+
+    async def worker():
+        nonlocal next_offset
+        while gaps or next_offset < total:
+            if gaps:
+                offset, limit = gaps.pop()
+            else:
+                offset, limit = next_offset, page_size
+                next_offset += limit
+            start = time.monotonic()
+            try:
+                page, _ = await fetch_entries_with_retry(session, username, offset, limit)
+            except (SensCritiqueError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                failures.append(((offset, limit), e))
+                continue
+            page_done(offset, page, total, time.monotonic() - start)
+            if page and len(page) < limit and offset + len(page) < total:
+                gaps.append((offset + len(page), limit - len(page)))
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+
+    if failures:
+        raise IncompleteCollectionError(len(failures), fetched, total) from failures[0][1]
+    all_entries = []
+    for offset in sorted(pages):
+        all_entries.extend(pages[offset])
+    return all_entries
+
+
+def _entry_key(entry):
+    """Identity of a collection entry as of its last action."""
+    return entry["id"], entry["rating_sc"]
+
+
+def _remainder_head(cached, changed_ids, size):
+    """First `size` keys of the cached order once changed entries are moved out."""
+    head = []
+    for entry in cached:
+        if entry["id"] in changed_ids:
+            continue
+        head.append(_entry_key(entry))
+        if len(head) == size:
+            break
+    return head
+
+
+async def fetch_delta_entries(session, username, cached, progress_callback=None):
+    """Refresh a cached collection by fetching only its most recent entries.
+
+    The collection is ordered by last action, so entries that changed since
+    the last sync come first. Pages are fetched until the fresh order joins
+    the cached one again (SYNC_WINDOW consecutive matching entries) and the
+    delta is merged on top of the cached entries. Returns None when a full
+    fetch is needed instead: the delta is larger than DELTA_MAX_PAGES pages,
+    or the merged result does not add up to the server total (e.g. deleted
+    items).
+    """
+    fresh = []
+    changed_ids = set()
+    offset = 0
+    position = 0
+
+    for _ in range(DELTA_MAX_PAGES):
+        page, total = await fetch_entries_with_retry(session, username, offset, DELTA_PAGE_SIZE)
+        fresh.extend(page)
+        offset += len(page)
+        complete = not page or offset >= total
+
+        while position < len(fresh):
+            head = _remainder_head(cached, changed_ids, SYNC_WINDOW)
+            window = [_entry_key(e) for e in fresh[position:position + len(head)]]
+            if len(window) < len(head) and not complete:
+                break  # Need the next page to decide
+            if head and window == head:
+                merged = fresh[:position] + [e for e in cached if e["id"] not in changed_ids]
+                if len(merged) != total:
+                    return None
+                if progress_callback:
+                    progress_callback(total, total)
+                return merged
+            changed_ids.add(fresh[position]["id"])
+            position += 1
+
+        if complete:
+            return fresh if len(fresh) == total else None
+        if progress_callback:
+            progress_callback(offset, total)
+
+    return None
+
+
+async def sync_collection(session, username, progress_callback=None, cache=None):
+    """Fetch complete SensCritique collection over a session, incrementally when a cache is given.
+
+    The cache reads and writes and the collection build run in threads,
+    so that concurrent syncs on the same event loop keep going.
+    """
+    with span("collection.sync", username=username, cached=cache is not None) as sync_span:
+        if cache is None:
+            entries = await fetch_all_entries(session, username, progress_callback)
+        else:
+            entries = None
+            cached = await asyncio.to_thread(cache.load_entries, username)
+            if cached is not None:
+                entries = await fetch_delta_entries(session, username, cached, progress_callback)
+                sync_span.set(delta=entries is not None)
+            if entries is None:
+                # Raises before anything is saved if some pages are missing
+                entries = await fetch_all_entries(session, username, progress_callback)
+            await asyncio.to_thread(cache.save_entries, username, entries)
+        sync_span.set(entries=len(entries))
+        return await asyncio.to_thread(rated_items, entries)
+
+
+async def fetch_senscritique_collection_async(username, progress_callback=None, cache=None):
+    """Fetch complete SensCritique collection, incrementally when a cache is given."""
     async with aiohttp.ClientSession() as session:
-        first_page, total = await fetch_senscritique_page(session, username, 0, limit, progress_callback)
-        all_items.extend(first_page)
-        
-        if total <= limit:
-            return all_items
-        
-        tasks = [
-            fetch_senscritique_page(session, username, offset, limit, progress_callback)
-            for offset in range(limit, total, limit)
-        ]
-        
-        results = await asyncio.gather(*tasks)
-        
-        for page_items, _ in results:
-            all_items.extend(page_items)
-    
-    return all_items
+        return await sync_collection(session, username, progress_callback, cache)
 
 
-def fetch_senscritique_collection(username, progress_callback=None):
+def fetch_senscritique_collection(username, progress_callback=None, cache=None):
     """Synchronous wrapper for async fetch."""
-    return asyncio.run(fetch_senscritique_collection_async(username, progress_callback))
+    return asyncio.run(fetch_senscritique_collection_async(username, progress_callback, cache))
 
 
-def get_sc_global_rating(title):
-    """Fetch global SensCritique rating for a title via search."""
-    headers = {        
-        'accept': '*/*',
-        'content-type': 'application/json',
-        'origin': 'https://www.senscritique.com',
-        'user-agent': 'Mozilla/5.0'    
-    }
+SEARCH_QUERY = 'query SearchProductExplorer($query: String, $offset: Int, $limit: Int, $filters: [SearchFilter], $sortBy: SearchProductExplorerSort) {\n  searchProductExplorer(\n    query: $query\n    filters: $filters\n    sortBy: $sortBy\n    offset: $offset\n    limit: $limit\n  ) {\n    items {\n      id\n      title\n      originalTitle\n      category\n      displayedYear\n      rating\n    }\n  }\n}\n'
+
 
-    json_data = {
+def _search_payload(title):
+    """GraphQL payload of a SensCritique product search, with only the fields used for matching."""
+    return {
         'operationName': 'SearchProductExplorer',
         'variables': {
             'offset': 0,
-            'limit': 16,
+            'limit': SEARCH_LIMIT,
             'query': title,
             'filters': [],
             'sortBy': 'RELEVANCE',
         },
-        'query': 'query SearchProductExplorer($query: String, $offset: Int, $limit: Int, $filters: [SearchFilter], $sortBy: SearchProductExplorerSort) {\n  searchProductExplorer(\n    query: $query\n    filters: $filters\n    sortBy: $sortBy\n    offset: $offset\n    limit: $limit\n  ) {\n    total\n    aggregations {\n      identifier\n      count\n      items {\n        label\n        count\n        __typename\n      }\n      __typename\n    }\n    sortOptions {\n      id\n      __typename\n    }\n    items {\n      ...ProductList\n      currentUserInfos {\n        ...ProductUserInfos\n        __typename\n      }\n      scoutsAverage {\n        average\n        count\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n\nfragment ProductList on Product {\n  category\n  channel\n  dateRelease\n  dateReleaseEarlyAccess\n  dateReleaseJP\n  dateReleaseOriginal\n  dateReleaseUS\n  displayedYear\n  duration\n  episodeNumber\n  seasonNumber\n  frenchReleaseDate\n  id\n  numberOfSeasons\n  originalRun\n  originalTitle\n  rating\n  slug\n  subtitle\n  title\n  universe\n  url\n  yearOfProduction\n  canalVOD {\n    url\n    __typename\n  }\n  tvChannel {\n    name\n    url\n    __typename\n  }\n  countries {\n    id\n    name\n    __typename\n  }\n  gameSystems {\n    id\n    label\n    __typename\n  }\n  medias {\n    picture\n    pictureWithMetadata {\n      url\n      width\n      height\n      __typename\n    }\n    __typename\n  }\n  genresInfos {\n    label\n    __typename\n  }\n  artists {\n    name\n    person_id\n    url\n    __typename\n  }\n  authors {\n    name\n    person_id\n    url\n    __typename\n  }\n  creators {\n    name\n    person_id\n    url\n    __typename\n  }\n  developers {\n    name\n    person_id\n    url\n    __typename\n  }\n  directors {\n    name\n    person_id\n    url\n    __typename\n  }\n  pencillers {\n    name\n    person_id\n    url\n    __typename\n  }\n  stats {\n    ratingCount\n    __typename\n  }\n  __typename\n}\n\nfragment ProductUserInfos on ProductUserInfos {\n  dateDone\n  hasStartedReview\n  isCurrent\n  id\n  isDone\n  isListed\n  isRecommended\n  isReviewed\n  isWished\n  productId\n  rating\n  userId\n  numberEpisodeDone\n  lastEpisodeDone {\n    episodeNumber\n    id\n    season {\n      seasonNumber\n      id\n      episodes {\n        title\n        id\n        episodeNumber\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n  gameSystem {\n    id\n    label\n    __typename\n  }\n  review {\n    author {\n      id\n      name\n      __typename\n    }\n    url\n    __typename\n  }\n  __typename\n}\n'
+        'query': SEARCH_QUERY
     }
 
+
+def _products_payload(product_ids):
+    """GraphQL payload fetching the global rating of several products by id, one alias each."""
+    fields = "".join(
+        f"  p{i}: product(id: {int(product_id)}) {{\n    id\n    rating\n  }}\n"
+        for i, product_id in enumerate(product_ids)
+    )
+    return {
+        "operationName": "ProductRatings",
+        "variables": {},
+        "query": f"query ProductRatings {{\n{fields}}}\n",
+    }
+
+
+async def _apollo_json(session, payload, request_span):
+    """JSON answer of an Apollo request, or None if it fails.
+
+    A 429 is retried once the shared budget resumes, up to MAX_RETRIES times.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        async with apollo_post(session, payload) as response:
+            request_span.set(status=response.status)
+            if response.status == 429 and attempt < MAX_RETRIES:
+                continue
+            if response.status != 200:
+                return None
+            return await response.json()
+
+
+def _search_items(data):
+    return ((data.get("data") or {}).get("searchProductExplorer") or {}).get("items") or []
+
+
+def _product_rating(product):
+    rating = product.get("rating") if product else None
+    return float(rating) if rating is not None else None
+
+
+def get_sc_global_rating(item):
+    """Synchronous global rating lookup of a single title or suggestion."""
+    return get_sc_global_ratings([item])[0]
+
+
+async def fetch_sc_global_rating(session, item):
+    """Resolve a title or suggestion to a SensCritique product by search, and return its global rating.
+
+    The search results are matched on the normalized title, category and
+    year (see product_index.best_match); the chosen product is remembered
+    in `product_index`. None if nothing matches.
+    """
+    query = rating_query(item)
+    key = product_key(query)
+    if key in rating_cache:
+        return rating_cache.get(key)
+
     try:
-        resp = requests.post('https://apollo.senscritique.com/', headers=headers, json=json_data)
-        if resp.status_code != 200:
-            return None
-        data = resp.json()
-        items = data.get("data", {}).get("searchProductExplorer", {}).get("items", [])
-        if not items:
-            return None
-        rating = items[0].get("rating")
-        if rating is None:
-            return None
-        return float(rating)
-    except Exception:
+        with span("ratings.search", title=query["title"]) as search_span:
+            data = await _apollo_json(session, _search_payload(query["title"]), search_span)
+            if data is None:
+                return None
+            items = _search_items(data)
+            product = best_match(query, items)
+            search_span.set(results=len(items), matched=product is not None)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
         return None
 
+    if product is not None and product.get("id") is not None:
+        # SQLite write, kept off the event loop
+        await asyncio.to_thread(product_index.set, key, product)
+    rating = _product_rating(product)
+    rating_cache.set(key, rating)
+    return rating
+
+
+async def _fetch_product_chunk(session, product_ids):
+    with span("ratings.products", products=len(product_ids)) as chunk_span:
+        try:
+            data = await _apollo_json(session, _products_payload(product_ids), chunk_span)
+            if data is None:
+                return {}
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            return {}
+    products = data.get("data") or {}
+    return {
+        product_id: _product_rating(products[f"p{i}"])
+        for i, product_id in enumerate(product_ids) if products.get(f"p{i}")
+    }
+
+
+async def fetch_product_ratings(session, product_ids):
+    """Global ratings of products known by id, PRODUCT_BATCH_SIZE per request.
+
+    Returns {product_id: rating}; products missing from the answers, or
+    whose request failed, are left out so that they can be searched again.
+    """
+    product_ids = list(dict.fromkeys(product_ids))
+    chunks = await asyncio.gather(*(
+        _fetch_product_chunk(session, product_ids[start:start + PRODUCT_BATCH_SIZE])
+        for start in range(0, len(product_ids), PRODUCT_BATCH_SIZE)
+    ))
+    ratings = {}
+    for chunk in chunks:
+        ratings.update(chunk)
+    return ratings
+
+
+async def fetch_sc_global_ratings_async(items, progress_callback=None, concurrency=RATING_CONCURRENCY,
+                                        session=None):
+    """Fetch global ratings for many titles or suggestions over a pooled keep-alive session.
+
+    Items are titles or suggestion dicts, whose category and year help
+    pick the right search result. Items sharing a normalized title,
+    category and year are looked up once and cached ones are not
+    requested at all. Products resolved by earlier runs are fetched by
+    id in a few batched requests; the others are searched, with at most
+    `concurrency` searches in flight. A shared `session` can be passed,
+    otherwise a dedicated pool is opened. Returns the ratings in the
+    order of `items`.
+    """
+    with span("ratings.lookup", titles=len(items)) as lookup_span:
+        return await _fetch_sc_global_ratings(items, progress_callback, concurrency, session, lookup_span)
+
+
+async def _fetch_sc_global_ratings(items, progress_callback, concurrency, session, lookup_span):
+    queries = [rating_query(item) for item in items]
+    keys = [product_key(q) for q in queries]
+    # Items sharing each key, so that progress counts items rather than lookups
+    copies = Counter(keys)
+    pending = {}
+    for query, key in zip(queries, keys):
+        if key not in pending and key not in rating_cache:
+            pending[key] = query
+    known = await asyncio.to_thread(product_index.get_many, pending) if pending else {}
+
+    lookup_span.set(requested=len(pending), indexed=len(known))
+    done = len(items) - sum(copies[key] for key in pending)
+    if progress_callback:
+        progress_callback(done, len(items))
+
+    async def resolve(session):
+        nonlocal done
+        if known:
+            ratings = await fetch_product_ratings(session, known.values())
+            for key, product_id in known.items():
+                if product_id in ratings:
+                    rating_cache.set(key, ratings[product_id])
+                    done += copies[key]
+                    del pending[key]
+            if progress_callback:
+                progress_callback(done, len(items))
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def lookup(key, query):
+            nonlocal done
+            async with semaphore:
+                await fetch_sc_global_rating(session, query)
+            done += copies[key]
+            if progress_callback:
+                progress_callback(done, len(items))
+
+        await asyncio.gather(*(lookup(key, query) for key, query in pending.items()))
+
+    if pending:
+        if session is not None:
+            await resolve(session)
+        else:
+            connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=60)
+            async with aiohttp.ClientSession(connector=connector) as own_session:
+                await resolve(own_session)
+
+    return [rating_cache.get(key) for key in keys]
 
 
+def get_sc_global_ratings(items, progress_callback=None, concurrency=RATING_CONCURRENCY):
+    """Synchronous wrapper for the batched global rating lookup."""
+    return asyncio.run(fetch_sc_global_ratings_async(items, progress_callback, concurrency))
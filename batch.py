@@ -0,0 +1,189 @@
+"""Headless batch mode: recommendations for many users, written as JSONL.
+
+Each line of the jobs file is a JSON object:
+    {"username": "...", "n": 10, "categories": ["Film", "Série"], "model": "gpt-4.1-mini"}
+Only "username" is required. Jobs run concurrently on a single event loop
+sharing one HTTP connection pool, one OpenAI client and the collection
+cache; their cache I/O, index and prompt builds run in worker threads so
+that they do not hold up the other jobs. Results are appended to the
+output file as each job completes.
+With a charts directory, each user's charts are also written there, as
+static JSON or standalone HTML, without opening a browser.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import aiohttp
+from openai import AsyncOpenAI
+
+from api_clients import fetch_sc_global_ratings_async, sync_collection
+from collection_cache import CollectionCache
+from file_utils import user_filename
+from rate_limit import BATCH, OPENAI_MAX_RETRIES, limiter, priority
+from recommender import CATEGORIES, get_recommendations_async
+from tracing import Trace, profiling, span, tracing
+from visualization import write_charts
+
+DEFAULT_MODEL = "gpt-4.1-mini"
+DEFAULT_SUGGESTIONS = 10
+# Jobs processed at the same time
+DEFAULT_CONCURRENCY = 8
+# Open connections per job kept in the shared HTTP pool
+CONNECTIONS_PER_JOB = 4
+
+
+_CATEGORY_NAMES = {c.lower(): c for c in CATEGORIES}
+
+
+def parse_job(job):
+    """Validate a job object and fill in its defaults; raises ValueError if it is malformed."""
+    if not isinstance(job, dict) or not job.get("username"):
+        raise ValueError("missing username")
+    if not isinstance(job["username"], str):
+        raise ValueError("username must be a string")
+    n = job.get("n", DEFAULT_SUGGESTIONS)
+    if not isinstance(n, int) or isinstance(n, bool):
+        raise ValueError("n must be an integer")
+    model = job.get("model", DEFAULT_MODEL)
+    if not isinstance(model, str) or not model:
+        raise ValueError("model must be a string")
+    categories = job.get("categories") or CATEGORIES
+    if not isinstance(categories, list) or not all(isinstance(c, str) for c in categories):
+        raise ValueError("categories must be a list of category names")
+    unknown = [c for c in categories if c.strip().lower() not in _CATEGORY_NAMES]
+    if unknown:
+        raise ValueError(f"unknown categories: {', '.join(unknown)}")
+    return {
+        "username": job["username"],
+        "n": n,
+        "categories": [_CATEGORY_NAMES[c.strip().lower()] for c in categories],
+        "model": model,
+    }
+
+
+def read_jobs(path):
+    """Parse a JSONL jobs file ("-" for stdin), filling in defaults."""
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        jobs = []
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                jobs.append(parse_job(json.loads(line)))
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_no}: {e}") from None
+        return jobs
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+async def run_job(job, session, client, cache):
+    """Fetch one user's collection, generate suggestions and their global ratings."""
+    collection = await sync_collection(session, job["username"], cache=cache)
+    if not collection:
+        raise ValueError("empty or private collection")
+
+    recos = await get_recommendations_async(
+        collection, job["n"], job["categories"], job["model"], client=client
+    )
+    ratings = await fetch_sc_global_ratings_async(recos, session=session)
+    for r, rating in zip(recos, ratings):
+        r["rating_sc_global"] = rating
+    return recos
+
+
+async def run_batch(jobs, output, concurrency=DEFAULT_CONCURRENCY, cache=None, charts_dir=None,
+                    chart_format="json"):
+    """Run jobs with at most `concurrency` in flight, writing one JSON line per job.
+
+    With `charts_dir`, the charts of each successful job are written
+    there as "json" or "html" (see visualization.write_charts). Returns
+    the number of failed jobs.
+    """
+    cache = cache or CollectionCache()
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def run(job):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            result = dict(job, suggestions=None, error=None)
+            try:
+                with span("job", username=job["username"], n=job["n"], model=job["model"]):
+                    result["suggestions"] = await run_job(job, session, client, cache)
+                if charts_dir and result["suggestions"]:
+                    path = user_filename(charts_dir, job["username"], chart_format)
+                    # Built off the event loop so the other jobs keep going
+                    await asyncio.to_thread(write_charts, result["suggestions"], path)
+                    result["charts"] = path
+            except Exception as e:
+                failures += 1
+                result["error"] = f"{type(e).__name__}: {e}"
+            result["elapsed"] = round(time.perf_counter() - start, 3)
+
+        output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output.flush()
+        status = "ok" if result["error"] is None else result["error"]
+        print(f"[{job['username']}] {status} ({result['elapsed']:.1f}s)", file=sys.stderr)
+
+    connector = aiohttp.TCPConnector(limit=concurrency * CONNECTIONS_PER_JOB, keepalive_timeout=60)
+    client = AsyncOpenAI(max_retries=OPENAI_MAX_RETRIES)
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            # Interactive requests of the same process go first in the API queues
+            with priority(BATCH):
+                await asyncio.gather(*(run(job) for job in jobs))
+    finally:
+        await client.close()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate WatWatch recommendations for many users")
+    parser.add_argument("jobs", help="JSONL file of jobs, or - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="JSONL results file (default: stdout)")
+    parser.add_argument("-c", "--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--charts", metavar="DIR", help="Write each user's charts to this directory")
+    parser.add_argument("--chart-format", choices=("json", "html"), default="json",
+                        help="Charts as static JSON for embedding, or standalone HTML (default: json)")
+    parser.add_argument("--trace", help="Write stage timings to this file")
+    parser.add_argument("--trace-format", choices=("json", "chrome"),
+                        help="Trace file format (default: chrome for *.trace.json, json otherwise)")
+    parser.add_argument("--profile", help="Profile the run with cProfile into this file")
+    args = parser.parse_args()
+
+    jobs = read_jobs(args.jobs)
+    if args.charts:
+        os.makedirs(args.charts, exist_ok=True)
+    trace = Trace("batch", jobs=len(jobs), concurrency=args.concurrency)
+    output = sys.stdout if args.output == "-" else open(args.output, "a", encoding="utf-8")
+    try:
+        with tracing(trace), profiling(args.profile):
+            failures = asyncio.run(run_batch(
+                jobs, output, max(1, args.concurrency), charts_dir=args.charts, chart_format=args.chart_format
+            ))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if args.trace:
+            trace.dump(args.trace, args.trace_format)
+
+    for name, (count, total) in trace.summary().items():
+        print(f"{name}: {total:.2f}s over {count} span(s)", file=sys.stderr)
+    for name, stats in limiter.stats().items():
+        print(f"{name}: {stats['granted']} call(s), {stats['throttled']} throttled, "
+              f"{stats['wait_seconds']:.2f}s waiting for the rate limit", file=sys.stderr)
+    print(f"{len(jobs) - failures}/{len(jobs)} jobs succeeded", file=sys.stderr)
+    raise SystemExit(0 if not failures else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,810 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+import uuid
+import zlib
+
+import aiohttp
+from aiohttp import web
+
+import api_clients
+import titles
+from titles import TitleIndex
+from tracing import Trace, tracing
+
+CATEGORIES = ["Film", "Série", "Jeu", "Album", "Manga", "BD Franco-Belge"]
+
+
+def naive_is_too_similar(norm_title, existing_titles):
+    """Reference implementation: the original per-title scan of get_recommendations."""
+    for existing_norm in existing_titles:
+        if not norm_title or not existing_norm:
+            continue
+
+        if norm_title in existing_norm or existing_norm in norm_title:
+            return True
+
+        min_len = min(len(norm_title), len(existing_norm))
+        if min_len >= 5:
+            common_prefix_len = 0
+            for i in range(min_len):
+                if norm_title[i] == existing_norm[i]:
+                    common_prefix_len += 1
+                else:
+                    break
+            if common_prefix_len / min_len >= 0.8:
+                return True
+    return False
+
+
+def synthetic_titles(count, rng):
+    """Generate normalized-looking titles built from a small shared vocabulary."""
+    vocabulary = [
+        "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 8)))
+        for _ in range(4000)
+    ]
+    titles = set()
+    while len(titles) < count:
+        words = rng.sample(vocabulary, rng.randint(1, 4))
+        title = "".join(words)
+        if rng.random() < 0.1:
+            title += str(rng.randint(2, 9))
+        titles.add(title)
+    return list(titles)
+
+
+def synthetic_candidates(existing, count, rng):
+    """Mix sequels, truncations and unrelated titles, like LLM suggestions."""
+    candidates = []
+    for _ in range(count):
+        kind = rng.random()
+        base = rng.choice(existing)
+        if kind < 0.25:
+            candidates.append(base + str(rng.randint(2, 5)))
+        elif kind < 0.4:
+            candidates.append(base[:max(1, int(len(base) * 0.85))] + "xq")
+        elif kind < 0.5:
+            candidates.append(base[1:-1] or base)
+        else:
+            candidates.append("".join(
+                rng.choice(string.ascii_lowercase) for _ in range(rng.randint(6, 20))
+            ))
+    return candidates
+
+
+def bench_similarity(collection_size, n_candidates, seed):
+    """Compare the indexed similarity check with the original linear scan."""
+    rng = random.Random(seed)
+    existing = synthetic_titles(collection_size, rng)
+    candidates = synthetic_candidates(existing, n_candidates, rng)
+    existing_set = set(existing)
+
+    start = time.perf_counter()
+    index = TitleIndex(existing_set)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed = [index.is_too_similar(c) for c in candidates]
+    indexed_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    naive = [naive_is_too_similar(c, existing_set) for c in candidates]
+    naive_time = time.perf_counter() - start
+
+    mismatches = sum(1 for a, b in zip(indexed, naive) if a != b)
+
+    print(f"Collection: {collection_size} titles, {n_candidates} candidates "
+          f"({sum(naive)} too similar)")
+    print(f"Index build:  {build_time * 1000:.1f} ms")
+    print(f"Indexed:      {indexed_time * 1000:.1f} ms "
+          f"({indexed_time / n_candidates * 1e6:.1f} µs/candidate)")
+    print(f"Linear scan:  {naive_time * 1000:.1f} ms "
+          f"({naive_time / n_candidates * 1e6:.1f} µs/candidate)")
+    print(f"Speedup:      {naive_time / max(indexed_time, 1e-9):.0f}x")
+    print(f"Mismatches:   {mismatches}")
+    return mismatches == 0
+
+
+def _people(rng, count):
+    return [
+        {"name": f"Person {rng.randint(1, 99999)}", "person_id": rng.randint(1, 99999),
+         "url": "/person/x", "__typename": "Person"}
+        for _ in range(count)
+    ]
+
+
+def _user_infos(rng, rating):
+    """ProductUserInfos block as returned by the full UserCollection query."""
+    return {
+        "dateDone": "2023-05-01T00:00:00.000Z", "hasStartedReview": False, "isCurrent": False,
+        "id": rng.randint(1, 10**8), "isDone": True, "isListed": False, "isRecommended": False,
+        "isReviewed": False, "isWished": False, "productId": rng.randint(1, 10**7),
+        "rating": rating, "userId": 42, "numberEpisodeDone": None,
+        "lastEpisodeDone": {
+            "episodeNumber": 8, "id": 1,
+            "season": {
+                "seasonNumber": 1, "id": 1,
+                "episodes": [
+                    {"title": f"Episode {e}", "id": e, "episodeNumber": e, "__typename": "Episode"}
+                    for e in range(1, 9)
+                ],
+                "__typename": "Season",
+            },
+            "__typename": "Episode",
+        } if rng.random() < 0.2 else None,
+        "gameSystem": None, "review": None, "__typename": "ProductUserInfos",
+    }
+
+
+def synthetic_product(index, rng, projection="full"):
+    """A collection product shaped like the SensCritique response of a projection."""
+    title = "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 20))).title()
+    rating = rng.randint(1, 10) if rng.random() < 0.9 else None
+    category = rng.choice(CATEGORIES)
+    if projection == "minimal":
+        return {"id": index, "title": title, "category": category,
+                "displayedYear": rng.randint(1950, 2025), "otherUserInfos": {"rating": rating}}
+
+    product = {
+        "category": category, "channel": None, "dateRelease": "2010-01-01",
+        "dateReleaseEarlyAccess": None, "dateReleaseJP": None, "dateReleaseOriginal": "2010-01-01",
+        "dateReleaseUS": None, "displayedYear": 2010, "duration": 6000, "episodeNumber": None,
+        "seasonNumber": None, "frenchReleaseDate": "2010-01-01", "id": index, "numberOfSeasons": None,
+        "originalRun": None, "originalTitle": title, "rating": round(rng.uniform(4, 9), 1),
+        "slug": title.lower(), "subtitle": None, "title": title, "universe": 1,
+        "url": f"/film/{title.lower()}/{index}", "yearOfProduction": 2010,
+        "canalVOD": None, "tvChannel": None,
+        "countries": [{"id": 1, "name": "France", "__typename": "Country"}],
+        "gameSystems": [], "medias": {"picture": "https://media.senscritique.com/x.jpg", "__typename": "Medias"},
+        "genresInfos": [{"label": "Drame", "__typename": "GenreInfo"}],
+        "artists": [], "authors": [], "creators": _people(rng, 1), "developers": [],
+        "directors": _people(rng, 2), "pencillers": [],
+        "stats": {"ratingCount": rng.randint(10, 100000), "__typename": "ProductStats"},
+        "__typename": "Product",
+    }
+    product.update({
+        "preloadedParentTvShow": None,
+        "totalEpisodes": None,
+        "scoutsAverage": {"average": 7.1, "count": 3, "__typename": "ScoutsAverage"},
+        "currentUserInfos": None,
+        "otherUserInfos": dict(_user_infos(rng, rating), lists=[], review=None),
+    })
+    return product
+
+
+def synthetic_collection_page(products, total):
+    """UserCollection response body wrapping the given products."""
+    return {"data": {"user": {"collection": {
+        "total": total, "products": products, "__typename": "UserCollection"
+    }, "__typename": "User"}}}
+
+
+async def start_fake_apollo(collection_size, seed=0, port=0):
+    """Serve a synthetic collection of each projection on a local port."""
+    products = {
+        projection: [synthetic_product(i, random.Random(seed + i), projection) for i in range(collection_size)]
+        for projection in ("full", "minimal")
+    }
+
+    async def graphql(request):
+        payload = await request.json()
+        variables = payload["variables"]
+        projection = "full" if "tvProducts" in payload["query"] else "minimal"
+        offset, limit = variables["offset"], variables["limit"]
+        page = products[projection][offset:offset + limit]
+        return web.json_response(synthetic_collection_page(page, collection_size))
+
+    app = web.Application()
+    app.router.add_post("/", graphql)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}/"
+
+
+async def _time_page(session, username, limit, projection, rounds):
+    """Payload size and mean decode time of one collection page."""
+    payload = api_clients._collection_payload(username, 0, limit, projection)
+    async with session.post(api_clients.SC_URL, headers=api_clients.SC_HEADERS, json=payload) as response:
+        size = len(await response.read())
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        entries, _ = await api_clients.fetch_senscritique_entries(session, username, 0, limit, projection)
+    elapsed = (time.perf_counter() - start) / rounds
+    return size, elapsed, len(entries)
+
+
+async def bench_collection_page(username, limit, rounds, url):
+    """Compare the full and minimal UserCollection projections on one page."""
+    runner = None
+    if url is None:
+        runner, url = await start_fake_apollo(limit)
+    api_clients.SC_URL = url
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            results = {}
+            for projection in ("full", "minimal"):
+                results[projection] = await _time_page(session, username, limit, projection, rounds)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+    for projection, (size, elapsed, count) in results.items():
+        print(f"{projection:8s} {size / 1024:9.1f} KiB  {elapsed * 1000:8.1f} ms/page  ({count} entries)")
+    full_size, full_time, _ = results["full"]
+    min_size, min_time, _ = results["minimal"]
+    print(f"Payload:  {full_size / max(min_size, 1):.1f}x smaller, "
+          f"time: {full_time / max(min_time, 1e-9):.1f}x faster")
+    return True
+
+
+def legacy_normalize_title(title):
+    """Reference implementation: the original per-title normalize_title."""
+    if not title:
+        return ""
+    title = re.sub(r'\([^)]*\)', '', title)
+    title = re.sub(r'\b(version|v\.|vol\.|volume|part|partie|saison|season|s\d+|épisode|episode|ep\.?)\b', '', title, flags=re.IGNORECASE)
+    title = unicodedata.normalize("NFKD", title)
+    title = title.encode("ascii", "ignore").decode("ascii")
+    title = title.lower().strip()
+    title = re.sub(r"[^a-z0-9]+", "", title)
+    return title
+
+
+def synthetic_raw_titles(count, rng):
+    """Display titles with accents, years, versions and sequel markers."""
+    words = ["été", "meurtrier", "château", "la", "le", "des", "cœur", "noël", "übermensch",
+             "nuit", "étoile", "forêt", "garçon", "héros", "l'ombre", "mémoire", "dernière"]
+    suffixes = ["", "", " (1983)", " (Version Coréenne)", " 2", " : Saison 3", " Vol. 2", " - Part II"]
+    result = []
+    for _ in range(count):
+        title = " ".join(rng.choice(words) for _ in range(rng.randint(1, 5))).capitalize()
+        result.append(title + rng.choice(suffixes) + f" {rng.randint(1, 99999)}")
+    return result
+
+
+def bench_normalize(corpus_size, seed):
+    """Compare per-title normalization with the memoized batch normalizer."""
+    corpus = synthetic_raw_titles(corpus_size, random.Random(seed))
+
+    start = time.perf_counter()
+    legacy = [legacy_normalize_title(t) for t in corpus]
+    legacy_time = time.perf_counter() - start
+
+    titles._memo.clear()
+    start = time.perf_counter()
+    batch = titles.normalize_titles(corpus)
+    batch_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    titles.normalize_titles(corpus)
+    warm_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    single = [titles.normalize_title(t) for t in corpus]
+    single_time = time.perf_counter() - start
+
+    mismatches = sum(1 for a, b, c in zip(legacy, batch, single) if not a == b == c)
+
+    print(f"Corpus: {corpus_size} titles")
+    print(f"Per-title (legacy):   {legacy_time * 1000:8.1f} ms")
+    print(f"Batch (cold memo):    {batch_time * 1000:8.1f} ms")
+    print(f"Batch (warm memo):    {warm_time * 1000:8.1f} ms")
+    print(f"Per-title (memoized): {single_time * 1000:8.1f} ms")
+    print(f"Mismatches:           {mismatches}")
+    return mismatches == 0
+
+
+# Taste clusters of the synthetic users: each likes its own share of the catalog
+COLLABORATIVE_CLUSTERS = 4
+# Share of the candidates that must come from the query user's cluster
+COLLABORATIVE_MIN_PRECISION = 0.8
+
+
+def bench_collaborative(n_users, items_per_user, catalog_size, n_candidates, seed):
+    """Build the co-occurrence index from synthetic cached collections and time its queries.
+
+    Every user belongs to a taste cluster, rating the cluster's share of
+    the catalog high and the rest low; a new user's candidates should
+    come from their own cluster.
+    """
+    from collection import rated_items
+    from collection_cache import CollectionCache
+    from cooccurrence import CooccurrenceIndex
+
+    rng = random.Random(seed)
+    catalog = synthetic_raw_titles(catalog_size, rng)
+
+    def collection(cluster, size):
+        entries = []
+        for i in rng.sample(range(catalog_size), size):
+            liked = i % COLLABORATIVE_CLUSTERS == cluster
+            rating = rng.randint(7, 10) if liked else rng.randint(1, 5)
+            entries.append({"id": i, "title": catalog[i], "rating_sc": float(rating),
+                            "category": CATEGORIES[i % len(CATEGORIES)], "year": 2000 + i % 25})
+        return entries
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = CollectionCache(os.path.join(tmp, "collections.sqlite"))
+        for user in range(n_users):
+            cache.save_entries(f"user-{user}", collection(user % COLLABORATIVE_CLUSTERS, items_per_user))
+        index = CooccurrenceIndex(cache)
+
+        start = time.perf_counter()
+        index.refresh()
+        build_time = time.perf_counter() - start
+
+        cache.save_entries("user-0", collection(0, items_per_user))
+        start = time.perf_counter()
+        index.refresh(force=True)
+        refresh_time = time.perf_counter() - start
+
+        cluster_of = {titles.normalize_title(t): i % COLLABORATIVE_CLUSTERS for i, t in enumerate(catalog)}
+        query_times, hits, total = [], 0, 0
+        for cluster in range(COLLABORATIVE_CLUSTERS):
+            query = rated_items(collection(cluster, items_per_user))
+            start = time.perf_counter()
+            candidates = index.candidates(query, n_candidates)
+            query_times.append(time.perf_counter() - start)
+            hits += sum(cluster_of[titles.normalize_title(c["title"])] == cluster for c in candidates)
+            total += len(candidates)
+
+    precision = hits / total if total else 0.0
+    print(f"Users: {n_users} x {items_per_user} items, catalog {catalog_size} ({index.items} keys)")
+    print(f"Full build:            {build_time * 1000:8.1f} ms")
+    print(f"Refresh (1 user):      {refresh_time * 1000:8.1f} ms")
+    print(f"Query (median):        {statistics.median(query_times) * 1000:8.1f} ms")
+    print(f"Candidates in taste:   {precision:8.1%} of {total}")
+    return precision >= COLLABORATIVE_MIN_PRECISION
+
+
+# Module loaded by run.py before the window shows
+STARTUP_MODULE = "gui"
+# Dependencies that must be left to the stages using them, out of the startup imports
+DEFERRED_MODULES = ("openai", "bokeh", "xlsxwriter")
+# Import time budget of STARTUP_MODULE, in milliseconds
+STARTUP_BUDGET_MS = 1000
+FIRST_PAINT_SCRIPT = """
+from PySide6.QtCore import QTimer
+from PySide6.QtWidgets import QApplication
+from gui import App
+app = QApplication([])
+window = App()
+window.show()
+QTimer.singleShot(0, app.quit)
+app.exec()
+"""
+
+
+def import_times(module):
+    """Cumulative import time in microseconds of `module` and of everything it imports, by name."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def first_paint_time():
+    """Seconds from interpreter start to the main window's first event loop pass."""
+    env = dict(os.environ)
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", FIRST_PAINT_SCRIPT], check=True, env=env,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    return time.perf_counter() - start
+
+
+def bench_startup(repeat, budget_ms):
+    """Check the GUI's import time against a budget, and time the cold start to first paint."""
+    runs = [import_times(STARTUP_MODULE) for _ in range(repeat)]
+    total_ms = statistics.median(r[STARTUP_MODULE] for r in runs) / 1000
+    paint_ms = statistics.median(first_paint_time() for _ in range(repeat)) * 1000
+
+    # Heaviest top-level packages of the last run
+    packages = {}
+    for name, cumulative in runs[-1].items():
+        root = name.split(".")[0]
+        if root != STARTUP_MODULE:
+            packages[root] = max(packages.get(root, 0), cumulative)
+    eager = [m for m in DEFERRED_MODULES if m in runs[-1]]
+
+    print(f"import {STARTUP_MODULE}:        {total_ms:8.1f} ms (budget {budget_ms} ms)")
+    print(f"Cold start to paint: {paint_ms:8.1f} ms")
+    for root, cumulative in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:8]:
+        print(f"  {root:<18} {cumulative / 1000:8.1f} ms")
+    if eager:
+        print(f"Imported at startup but should be deferred: {', '.join(eager)}")
+    return total_ms <= budget_ms and not eager
+
+SCENARIO_SIZES = (1000, 10000, 50000)
+# Share of each fake LLM answer made of titles taken from the prompt's library
+FAKE_DUPLICATE_RATIO = 0.3
+# Characters per streamed fake LLM text delta
+FAKE_DELTA_SIZE = 16
+
+_REQUESTED_RE = re.compile(r"EXACTEMENT (\d+)")
+_CATEGORIES_RE = re.compile(r"UNIQUEMENT :\n(.+)")
+_LIBRARY_LINE_RE = re.compile(r"^- (.+) \([^()]*\)$", re.MULTILINE)
+
+
+def _message_text(message):
+    content = message.get("content", "")
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content)
+    return content
+
+
+def fake_llm_answer(messages, rng, duplicate_ratio=FAKE_DUPLICATE_RATIO):
+    """Suggestions JSON answering a recommendation conversation.
+
+    A share of the suggestions repeat titles listed in the library prompt
+    so that the dedupe filter and the retry rounds get exercised.
+    """
+    request = _message_text(messages[-1])
+    requested = _REQUESTED_RE.search(request)
+    count = int(requested.group(1)) if requested else 10
+    categories = _CATEGORIES_RE.search(request)
+    categories = [c.strip() for c in categories.group(1).split(",")] if categories else CATEGORIES
+    library = _LIBRARY_LINE_RE.findall(_message_text(messages[0]))
+
+    suggestions = []
+    for _ in range(count):
+        if library and rng.random() < duplicate_ratio:
+            title = rng.choice(library)
+        else:
+            title = "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(6, 18))).title()
+        suggestions.append({
+            "title": title, "category": rng.choice(categories), "year": rng.randint(1990, 2025),
+            "reason": "Synthetic suggestion", "score": rng.randint(30, 99),
+        })
+    return json.dumps({"suggestions": suggestions}, ensure_ascii=False)
+
+
+def fake_response_body(model, text):
+    """Responses API body with a single assistant message."""
+    return {
+        "id": f"resp_{uuid.uuid4().hex}", "object": "response", "created_at": int(time.time()),
+        "model": model, "status": "completed", "parallel_tool_calls": True,
+        "tool_choice": "auto", "tools": [],
+        "output": [{
+            "type": "message", "id": f"msg_{uuid.uuid4().hex}", "status": "completed", "role": "assistant",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }],
+        "usage": {
+            "input_tokens": 0, "output_tokens": len(text) // 4, "total_tokens": len(text) // 4,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens_details": {"reasoning_tokens": 0},
+        },
+    }
+
+
+# Decoys returned by a fake search besides the title in every category
+FAKE_SEARCH_DECOYS = 3
+_PRODUCT_ID_RE = re.compile(r"(p\d+): product\(id: (\d+)\)")
+
+
+def fake_product(title, category, year):
+    """A search result with a stable id, and a rating derived from it."""
+    product_id = zlib.crc32(f"{title}|{category}|{year}".encode("utf-8"))
+    return {"id": product_id, "title": title, "originalTitle": None, "category": category,
+            "displayedYear": year, "rating": fake_product_rating(product_id)}
+
+
+def fake_product_rating(product_id):
+    return round(random.Random(product_id).uniform(4, 9), 1)
+
+
+def fake_search_results(query):
+    """Search results of a title: homonyms in every category and a few decoys, in no useful order."""
+    rng = random.Random(query)
+    results = [fake_product(query, category, rng.randint(1950, 2025)) for category in CATEGORIES]
+    results += [
+        fake_product(f"{query} {rng.randint(2, 5)}" if i == 0 else f"{query[:2]}{rng.randint(100, 999)}",
+                     rng.choice(CATEGORIES), rng.randint(1950, 2025))
+        for i in range(FAKE_SEARCH_DECOYS)
+    ]
+    rng.shuffle(results)
+    return results
+
+
+class FakeBackends:
+    """Local stand-ins for the Apollo GraphQL endpoint and the OpenAI Responses API.
+
+    Users named "user-<size>" own a synthetic collection of <size> items,
+    product searches return homonyms in every category (see
+    fake_search_results), products can be fetched by id, and /v1/responses answers after
+    `llm_latency` seconds (plus up to `llm_jitter`), streamed or not. A
+    `truncate_ratio` share of the answers are cut at a random point. The
+    server runs on its own event loop thread so that synchronous entry
+    points can call it.
+    """
+
+    def __init__(self, llm_latency=0.5, llm_jitter=0.2, duplicate_ratio=FAKE_DUPLICATE_RATIO, seed=0,
+                 truncate_ratio=0.0):
+        self.llm_latency = llm_latency
+        self.llm_jitter = llm_jitter
+        self.duplicate_ratio = duplicate_ratio
+        self.truncate_ratio = truncate_ratio
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.collections = {}
+        self.url = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._runner = None
+
+    def collection(self, username):
+        size = int(username.rsplit("-", 1)[-1])
+        if size not in self.collections:
+            self.collections[size] = [
+                synthetic_product(i, random.Random(self.seed + i), "minimal") for i in range(size)
+            ]
+        return self.collections[size]
+
+    async def _graphql(self, request):
+        payload = await request.json()
+        variables = payload["variables"]
+        if payload.get("operationName") == "SearchProductExplorer":
+            items = fake_search_results(variables["query"])
+            return web.json_response({"data": {"searchProductExplorer": {"items": items}}})
+        if payload.get("operationName") == "ProductRatings":
+            products = {
+                alias: {"id": int(product_id), "rating": fake_product_rating(int(product_id))}
+                for alias, product_id in _PRODUCT_ID_RE.findall(payload["query"])
+            }
+            return web.json_response({"data": products})
+
+        products = self.collection(variables["username"])
+        offset, limit = variables["offset"], variables["limit"]
+        return web.json_response(synthetic_collection_page(products[offset:offset + limit], len(products)))
+
+    async def _responses(self, request):
+        payload = await request.json()
+        latency = self.llm_latency + self.rng.uniform(0, self.llm_jitter)
+        text = fake_llm_answer(payload["input"], self.rng, self.duplicate_ratio)
+        truncated = self.rng.random() < self.truncate_ratio
+        if truncated:
+            text = text[:self.rng.randint(1, len(text) - 1)]
+        if not payload.get("stream"):
+            await asyncio.sleep(latency)
+            return web.json_response(fake_response_body(payload["model"], text))
+
+        # Server-sent events: first token after a third of the latency, the
+        # rest of the answer spread over the remaining time
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        body = fake_response_body(payload["model"], text)
+        chunks = [text[i:i + FAKE_DELTA_SIZE] for i in range(0, len(text), FAKE_DELTA_SIZE)]
+        events = [{"type": "response.created", "response": dict(body, status="in_progress", output=[])}]
+        events += [
+            {"type": "response.output_text.delta", "item_id": body["output"][0]["id"], "output_index": 0,
+             "content_index": 0, "delta": chunk, "logprobs": []}
+            for chunk in chunks
+        ]
+        status = "incomplete" if truncated else "completed"
+        events.append({"type": f"response.{status}", "response": dict(body, status=status)})
+
+        await asyncio.sleep(latency / 3)
+        try:
+            for sequence_number, event in enumerate(events):
+                event["sequence_number"] = sequence_number
+                data = json.dumps(event, ensure_ascii=False)
+                await response.write(f"event: {event['type']}\ndata: {data}\n\n".encode("utf-8"))
+                if event["type"] == "response.output_text.delta":
+                    await asyncio.sleep(latency * 2 / 3 / len(chunks))
+            await response.write_eof()
+        except ConnectionResetError:
+            # The client stopped reading once it had enough suggestions
+            pass
+        return response
+
+    async def _start(self):
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_post("/", self._graphql)
+        app.router.add_post("/v1/responses", self._responses)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", 0).start()
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self._thread.start()
+        self.url = asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        self._saved = api_clients.SC_URL, os.environ.get("OPENAI_BASE_URL"), os.environ.get("OPENAI_API_KEY")
+        api_clients.SC_URL = f"{self.url}/"
+        os.environ["OPENAI_BASE_URL"] = f"{self.url}/v1"
+        os.environ["OPENAI_API_KEY"] = "benchmark"
+        return self
+
+    def __exit__(self, *exc):
+        sc_url, base_url, api_key = self._saved
+        api_clients.SC_URL = sc_url
+        for name, value in (("OPENAI_BASE_URL", base_url), ("OPENAI_API_KEY", api_key)):
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+def _timed(scenario, size, func, **attrs):
+    """Run one scenario under a trace; return its result row and func's return value."""
+    trace = Trace(scenario)
+    with tracing(trace):
+        start = time.perf_counter()
+        value = func()
+        elapsed = time.perf_counter() - start
+    stages = {name: {"count": count, "seconds": round(total, 6)} for name, (count, total) in trace.summary().items()}
+    row = dict(scenario=scenario, size=size, seconds=round(elapsed, 6), stages=stages, **attrs)
+    print(f"{scenario:20s} {size:>7d} items  {elapsed * 1000:10.1f} ms", file=sys.stderr)
+    return row, value
+
+
+def run_scenarios(sizes, n_suggestions, model, llm_latency, llm_jitter, duplicate_ratio, seed, truncate_ratio=0.0):
+    """Time the collection fetch, recommendation and output paths against FakeBackends."""
+    import recommender
+    import visualization
+    from collection_cache import CollectionCache
+    from cooccurrence import CooccurrenceIndex
+    from product_index import ProductIndex
+    # Imported up front so the output scenarios time the charts, not the import
+    import bokeh.embed
+    import bokeh.plotting
+
+    results = []
+    backends = FakeBackends(llm_latency, llm_jitter, duplicate_ratio, seed, truncate_ratio)
+    with backends, tempfile.TemporaryDirectory() as tmp:
+        api_clients.product_index = ProductIndex(os.path.join(tmp, "products.sqlite"))
+        recommender.cooccurrence_index = CooccurrenceIndex(CollectionCache(os.path.join(tmp, "collaborative.sqlite")))
+        for size in sizes:
+            username = f"user-{size}"
+            row, collection = _timed("fetch", size, lambda: api_clients.fetch_senscritique_collection(username))
+            results.append(dict(row, items=len(collection)))
+
+            cache = CollectionCache(os.path.join(tmp, f"collections-{size}.sqlite"))
+            api_clients.fetch_senscritique_collection(username, cache=cache)
+            row, _ = _timed("fetch_delta", size,
+                            lambda: api_clients.fetch_senscritique_collection(username, cache=cache))
+            results.append(row)
+
+            categories = sorted(collection.categories)
+            row, recos = _timed("recommend", size, lambda: recommender.get_recommendations(
+                collection, n_suggestions, categories, model, use_cache=False
+            ))
+            results.append(dict(row, suggestions=len(recos), rounds=row["stages"]["openai.call"]["count"]))
+
+            row, recos = _timed("recommend_parallel", size, lambda: asyncio.run(recommender.get_recommendations_async(
+                collection, n_suggestions, categories, model, use_cache=False
+            )))
+            results.append(dict(row, suggestions=len(recos), rounds=row["stages"]["openai.call"]["count"]))
+
+            api_clients.rating_cache.clear()
+            row, ratings = _timed("ratings", size, lambda: api_clients.get_sc_global_ratings(recos))
+            results.append(dict(row, matched=sum(r is not None for r in ratings)))
+            # Same lookups in a later run: products are fetched by id, without searching
+            api_clients.rating_cache.clear()
+            row, ratings = _timed("ratings_indexed", size, lambda: api_clients.get_sc_global_ratings(recos))
+            results.append(dict(row, matched=sum(r is not None for r in ratings)))
+            for reco, rating in zip(recos, ratings):
+                reco["rating_sc_global"] = rating
+
+            # Written to files: no browser is opened
+            filename = os.path.join(tmp, f"suggestions-{size}.html")
+            row, _ = _timed("bokeh", size, lambda: visualization.save_bokeh(recos, filename))
+            results.append(row)
+            row, _ = _timed("bokeh_json", size, lambda: visualization.chart_json(recos))
+            results.append(row)
+    return results
+
+
+def bench_scenarios(sizes, n_suggestions, model, llm_latency, llm_jitter, duplicate_ratio, seed, output,
+                    truncate_ratio=0.0):
+    """Run the end-to-end scenarios and write the results as JSON."""
+    results = run_scenarios(sizes, n_suggestions, model, llm_latency, llm_jitter, duplicate_ratio, seed,
+                            truncate_ratio)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {"n_suggestions": n_suggestions, "model": model, "llm_latency": llm_latency,
+                   "llm_jitter": llm_jitter, "duplicate_ratio": duplicate_ratio,
+                   "truncate_ratio": truncate_ratio, "seed": seed},
+        "results": results,
+    }
+    if output in (None, "-"):
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return all(r.get("suggestions", n_suggestions) == n_suggestions for r in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WatWatch benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    similarity = subparsers.add_parser("similarity", help="Indexed vs linear too-similar check")
+    similarity.add_argument("--collection-size", type=int, default=15000)
+    similarity.add_argument("--candidates", type=int, default=500)
+    similarity.add_argument("--seed", type=int, default=0)
+
+    page = subparsers.add_parser("collection-page", help="Full vs minimal collection page fetch")
+    page.add_argument("--username", default="benchmark")
+    page.add_argument("--limit", type=int, default=1000)
+    page.add_argument("--rounds", type=int, default=5)
+    page.add_argument("--url", help="GraphQL endpoint (default: local synthetic server)")
+
+    normalize = subparsers.add_parser("normalize", help="Per-title vs batch title normalization")
+    normalize.add_argument("--corpus-size", type=int, default=20000)
+    normalize.add_argument("--seed", type=int, default=0)
+
+    collaborative = subparsers.add_parser("collaborative", help="Co-occurrence index build and query times")
+    collaborative.add_argument("--users", type=int, default=2000)
+    collaborative.add_argument("--items-per-user", type=int, default=300)
+    collaborative.add_argument("--catalog-size", type=int, default=20000)
+    collaborative.add_argument("--candidates", type=int, default=20)
+    collaborative.add_argument("--seed", type=int, default=0)
+
+    startup = subparsers.add_parser("startup", help="GUI import time budget and cold start to first paint")
+    startup.add_argument("--repeat", type=int, default=3)
+    startup.add_argument("--budget-ms", type=int, default=STARTUP_BUDGET_MS)
+
+    scenarios = subparsers.add_parser("scenarios", help="End-to-end runs against local SensCritique/OpenAI fakes")
+    scenarios.add_argument("--sizes", type=int, nargs="+", default=list(SCENARIO_SIZES))
+    scenarios.add_argument("--suggestions", type=int, default=20)
+    scenarios.add_argument("--model", default="gpt-4.1-mini")
+    scenarios.add_argument("--llm-latency", type=float, default=0.5, help="Seconds per fake OpenAI call")
+    scenarios.add_argument("--llm-jitter", type=float, default=0.2, help="Extra random latency, in seconds")
+    scenarios.add_argument("--duplicate-ratio", type=float, default=FAKE_DUPLICATE_RATIO)
+    scenarios.add_argument("--truncate-ratio", type=float, default=0.0,
+                           help="Share of fake OpenAI answers cut short")
+    scenarios.add_argument("--seed", type=int, default=0)
+    scenarios.add_argument("--output", "-o", help="JSON results file (default: stdout)")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "similarity":
+        ok = bench_similarity(args.collection_size, args.candidates, args.seed)
+    elif args.benchmark == "normalize":
+        ok = bench_normalize(args.corpus_size, args.seed)
+    elif args.benchmark == "collaborative":
+        ok = bench_collaborative(args.users, args.items_per_user, args.catalog_size, args.candidates, args.seed)
+    elif args.benchmark == "startup":
+        ok = bench_startup(max(1, args.repeat), args.budget_ms)
+    elif args.benchmark == "scenarios":
+        ok = bench_scenarios(args.sizes, args.suggestions, args.model, args.llm_latency, args.llm_jitter,
+                             args.duplicate_ratio, args.seed, args.output, args.truncate_ratio)
+    else:
+        ok = asyncio.run(bench_collection_page(args.username, args.limit, args.rounds, args.url))
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".watwatch")
+
+
+def default_cache_dir():
+    """Directory holding WatWatch's local caches (overridable via WATWATCH_CACHE_DIR)."""
+    return os.environ.get("WATWATCH_CACHE_DIR") or DEFAULT_CACHE_DIR
+
+
+def stable_hash(value):
+    """SHA-256 of a JSON-serializable value, independent of dict ordering."""
+    payload = json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TTLCache:
+    """Thread-safe LRU mapping whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=4096, ttl=24 * 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the cached value, or `default` if missing or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def __contains__(self, key):
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entries if full."""
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class JSONFileCache:
+    """Directory of JSON documents keyed by hash, expiring after `ttl` seconds."""
+
+    def __init__(self, directory, ttl=None):
+        self.directory = directory
+        self.ttl = ttl
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key, default=None):
+        """Return the stored document, or `default` if missing, expired or unreadable."""
+        path = self._path(key)
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                return default
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+    def set(self, key, value):
+        """Store a document atomically."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        # Unique per thread too, as documents are also written from asyncio.to_thread
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
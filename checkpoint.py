@@ -0,0 +1,88 @@
+"""Checkpoints of a recommendation run, so an interrupted run can resume.
+
+A run (one user, number of suggestions, categories and model) gets a
+directory under the cache with one JSON document per finished stage:
+the version of the collection it fetched, the state of the suggestion
+rounds (see recommender.stream_recommendations) and the global ratings
+found so far. Running the same request again picks up from there
+instead of re-fetching the collection and paying for the same OpenAI
+rounds; the directory is removed once the run completes.
+"""
+import os
+import shutil
+import time
+
+from cache_utils import JSONFileCache, default_cache_dir, stable_hash
+from collection import rated_items
+
+# Checkpoints older than this are ignored and overwritten (seconds)
+RUN_CHECKPOINT_TTL = 24 * 3600
+
+COLLECTION = "collection"
+GENERATION = "generation"
+RATINGS = "ratings"
+
+
+def run_key(username, n_suggestions, categories, model):
+    """Key of a run's checkpoint directory."""
+    return stable_hash({
+        "username": username,
+        "n": n_suggestions,
+        "categories": sorted(categories or []),
+        "model": model,
+    })
+
+
+def rating_key(suggestion):
+    """Key of a suggestion in the ratings checkpoint."""
+    return f"{suggestion['title']}|{suggestion['category']}"
+
+
+class RunCheckpoint:
+    """Stage documents of one run, in `directory` (by default under the cache)."""
+
+    def __init__(self, username, n_suggestions, categories, model, directory=None):
+        self.username = username
+        if directory is None:
+            key = run_key(username, n_suggestions, categories, model)
+            directory = os.path.join(default_cache_dir(), "runs", key)
+        self.directory = directory
+        self._store = JSONFileCache(directory, ttl=RUN_CHECKPOINT_TTL)
+
+    def load(self, stage):
+        """Document saved by a stage, or None."""
+        return self._store.get(stage)
+
+    def save(self, stage, document):
+        self._store.set(stage, document)
+
+    def stages(self):
+        """Stages with a (fresh) saved document."""
+        return [stage for stage in (COLLECTION, GENERATION, RATINGS) if self.load(stage) is not None]
+
+    def clear(self):
+        """Forget the run, once it has completed."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def save_collection(self, cache):
+        """Record that the user's collection in `cache` is the one this run works on."""
+        version = cache.versions().get(self.username)
+        if version is not None:
+            self.save(COLLECTION, {"updated_at": version, "saved_at": time.time()})
+
+    def collection(self, cache):
+        """The collection fetched by the interrupted run, if `cache` still holds that version."""
+        saved = self.load(COLLECTION)
+        if saved is None or cache.versions().get(self.username) != saved["updated_at"]:
+            return None
+        entries = cache.load_entries(self.username)
+        return rated_items(entries) if entries is not None else None
+
+    def ratings(self):
+        """{rating_key: global rating} of the suggestions already rated."""
+        return self.load(RATINGS) or {}
+
+    def save_ratings(self, suggestions):
+        ratings = self.ratings()
+        ratings.update((rating_key(s), s.get("rating_sc_global")) for s in suggestions)
+        self.save(RATINGS, ratings)
@@ -0,0 +1,170 @@
+"""Columnar in-memory representation of a user's rated collection."""
+import hashlib
+import sys
+
+import numpy as np
+
+from titles import collection_norm_titles
+
+# Rating buckets are the integer part of the rating, from 0 to 10
+RATING_BUCKETS = 11
+# Value of the years column for items without a known release year
+UNKNOWN_YEAR = 0
+
+
+class Collection:
+    """Rated collection items stored column by column.
+
+    Titles are interned strings with their normalized forms precomputed,
+    categories are small-int codes into `categories`, ratings are a
+    float32 array and release years an int16 array (UNKNOWN_YEAR if
+    missing). Indices of every category and rating bucket are built
+    once, so filtering on them costs a dictionary lookup. Iterating or
+    indexing with an int yields plain item dicts, for code that does not
+    need the columns.
+    """
+
+    __slots__ = ("ids", "titles", "norm_titles", "ratings", "categories", "category_codes", "years",
+                 "_category_lookup", "_by_category", "_by_bucket", "_fingerprint")
+
+    def __init__(self, ids, titles, norm_titles, ratings, categories, category_codes, years=None):
+        if years is None:
+            years = np.full(len(titles), UNKNOWN_YEAR, dtype=np.int16)
+        self.ids = ids
+        self.titles = titles
+        self.norm_titles = norm_titles
+        self.ratings = ratings
+        self.categories = categories
+        self.category_codes = category_codes
+        self.years = years
+        self._category_lookup = {c.lower(): code for code, c in enumerate(categories)}
+        self._fingerprint = None
+
+        order = np.argsort(category_codes, kind="stable")
+        bounds = np.searchsorted(category_codes[order], np.arange(len(categories) + 1))
+        self._by_category = [order[bounds[c]:bounds[c + 1]] for c in range(len(categories))]
+
+        buckets = np.clip(ratings, 0, RATING_BUCKETS - 1).astype(np.int8)
+        order = np.argsort(buckets, kind="stable")
+        bounds = np.searchsorted(buckets[order], np.arange(RATING_BUCKETS + 1))
+        self._by_bucket = [order[bounds[b]:bounds[b + 1]] for b in range(RATING_BUCKETS)]
+
+    @classmethod
+    def from_entries(cls, entries):
+        """Build a collection from item dicts ({"id", "title", "rating_sc", "category", "year"})."""
+        entries = list(entries)
+        norm_titles = collection_norm_titles(entries)
+        categories = {}
+        codes = np.fromiter(
+            (categories.setdefault(e["category"], len(categories)) for e in entries),
+            dtype=np.int16, count=len(entries)
+        )
+        return cls(
+            ids=np.fromiter((-1 if e.get("id") is None else e["id"] for e in entries), dtype=np.int64, count=len(entries)),
+            titles=[sys.intern(e["title"]) for e in entries],
+            norm_titles=norm_titles,
+            ratings=np.fromiter((e["rating_sc"] for e in entries), dtype=np.float32, count=len(entries)),
+            categories=tuple(categories),
+            category_codes=codes,
+            years=np.fromiter((e.get("year") or UNKNOWN_YEAR for e in entries), dtype=np.int16, count=len(entries)),
+        )
+
+    def __len__(self):
+        return len(self.titles)
+
+    def __bool__(self):
+        return bool(self.titles)
+
+    def item(self, i):
+        return {
+            "id": int(self.ids[i]) if self.ids[i] >= 0 else None,
+            "title": self.titles[i],
+            "rating_sc": float(self.ratings[i]),
+            "category": self.categories[self.category_codes[i]],
+            "norm_title": self.norm_titles[i],
+            "year": int(self.years[i]) if self.years[i] != UNKNOWN_YEAR else None,
+        }
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.item(key)
+        if isinstance(key, slice):
+            key = np.arange(len(self))[key]
+        return self.take(key)
+
+    def __iter__(self):
+        return (self.item(i) for i in range(len(self)))
+
+    def take(self, indices):
+        """Sub-collection of the items at `indices`, in that order."""
+        indices = np.asarray(indices, dtype=np.int64)
+        used, first, codes = np.unique(self.category_codes[indices], return_index=True, return_inverse=True)
+        # Categories are numbered by first appearance, as in from_entries
+        order = np.argsort(first)
+        renumber = np.empty_like(order)
+        renumber[order] = np.arange(len(order))
+        return Collection(
+            ids=self.ids[indices],
+            titles=[self.titles[i] for i in indices.tolist()],
+            norm_titles=[self.norm_titles[i] for i in indices.tolist()],
+            ratings=self.ratings[indices],
+            categories=tuple(self.categories[used[o]] for o in order),
+            category_codes=renumber[codes.reshape(-1)].astype(np.int16),
+            years=self.years[indices],
+        )
+
+    def category_of(self, i):
+        return self.categories[self.category_codes[i]]
+
+    def category_indices(self, category):
+        """Indices of the items of a category (case-insensitive), in collection order."""
+        code = self._category_lookup.get(category.strip().lower())
+        if code is None:
+            return np.empty(0, dtype=np.int64)
+        return self._by_category[code]
+
+    def rating_bucket_indices(self, bucket):
+        """Indices of the items rated in [bucket, bucket + 1), in collection order."""
+        if not 0 <= bucket < RATING_BUCKETS:
+            return np.empty(0, dtype=np.int64)
+        return self._by_bucket[bucket]
+
+    def filter_categories(self, categories):
+        """Sub-collection of the items in any of `categories`, in collection order."""
+        parts = [self.category_indices(c) for c in categories]
+        indices = np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+        return self.take(indices)
+
+    def filter_ratings(self, low, high=RATING_BUCKETS - 1):
+        """Sub-collection of the items whose rating bucket is between `low` and `high`."""
+        parts = [self.rating_bucket_indices(b) for b in range(low, high + 1)]
+        indices = np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+        return self.take(indices)
+
+    @property
+    def fingerprint(self):
+        """Hash of the titles, categories and ratings, identifying this version of the collection."""
+        if self._fingerprint is None:
+            digest = hashlib.sha256()
+            digest.update("\n".join(self.titles).encode("utf-8"))
+            digest.update("\n".join(self.categories).encode("utf-8"))
+            digest.update(self.category_codes.tobytes())
+            digest.update(self.ratings.tobytes())
+            digest.update(self.years.tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+
+def as_collection(items):
+    """Return `items` as a Collection, converting a list of item dicts if needed."""
+    if isinstance(items, Collection):
+        return items
+    return Collection.from_entries(items)
+
+
+def rated_items(entries):
+    """Collection of the entries usable by the recommender."""
+    return Collection.from_entries(
+        e for e in entries
+        if e["title"] and e["rating_sc"] is not None and e["category"]
+    )
@@ -0,0 +1,115 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from cache_utils import default_cache_dir
+from titles import collection_norm_titles
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS collections (
+    username TEXT PRIMARY KEY,
+    total INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    username TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    product_id INTEGER,
+    title TEXT,
+    rating_sc REAL,
+    category TEXT,
+    norm_title TEXT,
+    year INTEGER,
+    PRIMARY KEY (username, position)
+);
+"""
+
+
+class CollectionCache:
+    """SQLite store of fetched SensCritique collections, keyed by username.
+
+    Entries are kept in the order returned by SensCritique (last action
+    first), including unrated ones, so an incremental sync can find where
+    the previously fetched collection starts again.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(default_cache_dir(), "collections.sqlite")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(entries)")}
+            if "norm_title" not in columns:
+                # Caches written before normalized titles were persisted
+                conn.execute("ALTER TABLE entries ADD COLUMN norm_title TEXT")
+            if "year" not in columns:
+                # Caches written before release years were fetched: an
+                # incremental sync would never fill them in, so resync fully
+                conn.execute("ALTER TABLE entries ADD COLUMN year INTEGER")
+                conn.execute("DELETE FROM entries")
+                conn.execute("DELETE FROM collections")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def load_entries(self, username):
+        """Return the cached entries for a user, or None if never synced."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT total FROM collections WHERE username = ?", (username,)
+            ).fetchone()
+            if row is None:
+                return None
+            rows = conn.execute(
+                "SELECT product_id, title, rating_sc, category, norm_title, year FROM entries "
+                "WHERE username = ? ORDER BY position",
+                (username,)
+            ).fetchall()
+
+        entries = [
+            {"id": product_id, "title": title, "rating_sc": rating, "category": category,
+             "norm_title": norm_title, "year": year}
+            for product_id, title, rating, category, norm_title, year in rows
+        ]
+        for entry, norm_title in zip(entries, collection_norm_titles(entries)):
+            entry["norm_title"] = norm_title
+        return entries
+
+    def save_entries(self, username, entries):
+        """Replace the cached collection of a user."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM entries WHERE username = ?", (username,))
+            conn.executemany(
+                "INSERT INTO entries (username, position, product_id, title, rating_sc, category, norm_title, year) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (username, i, e.get("id"), e.get("title"), e.get("rating_sc"), e.get("category"), norm,
+                     e.get("year"))
+                    for i, (e, norm) in enumerate(zip(entries, collection_norm_titles(entries)))
+                )
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO collections (username, total, updated_at) VALUES (?, ?, ?)",
+                (username, len(entries), time.time())
+            )
+
+    def versions(self):
+        """{username: time of the last save} of every cached collection."""
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT username, updated_at FROM collections"))
+
+    def delete(self, username):
+        """Forget the cached collection of a user."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM entries WHERE username = ?", (username,))
+            conn.execute("DELETE FROM collections WHERE username = ?", (username,))
@@ -0,0 +1,224 @@
+"""Collaborative signal from every collection in the local cache.
+
+Items are keyed by normalized title and category. Each cached user is
+a sparse row of their ratings as z-scores (relative to the user's own
+mean and spread), and two items are similar when the same users rate
+them on the same side of their mean: the adjusted cosine of their
+columns. A user's candidates are the unseen items most similar to what
+they liked and least similar to what they disliked, i.e. (S q)_j with S
+the item-item similarity matrix and q the user's z-scores.
+
+S is never materialized: with R the user×item matrix and n its column
+norms, S q = R^T (R (q / n)) / n, two sparse products over the cached
+ratings. The index loads only the collections saved since its last
+refresh, so it grows with every collection the app fetches, at no API
+cost.
+"""
+import threading
+import time
+
+import numpy as np
+
+from collection import UNKNOWN_YEAR, as_collection, rated_items
+from collection_cache import CollectionCache
+
+# Least number of cached users rating an item for it to be a candidate
+MIN_RATERS = 2
+# Least number of co-occurrences (a user rating both the candidate and
+# one of the query's items) behind a candidate
+MIN_COOCCURRENCE = 3
+# Query items quoted in a candidate's reason
+REASON_ITEMS = 2
+# Least time between two refreshes (seconds), so that a burst of saved
+# collections (e.g. a batch run) rebuilds the index once, not per collection
+REFRESH_INTERVAL = 60
+
+
+def item_key(norm_title, category):
+    """Key of an item in the index: normalized title and category."""
+    return f"{norm_title}|{category.strip().lower()}"
+
+
+class CooccurrenceIndex:
+    """Item-item similarities learned from the collections of a CollectionCache.
+
+    Call `refresh` to take newly saved collections into account, then
+    `candidates` for a collection's best unseen items. The cache is only
+    opened on first refresh. Both do SQLite reads and NumPy work: async
+    callers run them in a thread.
+    """
+
+    def __init__(self, cache=None):
+        self._cache = cache
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._refreshed_at = None
+        # Item ids and z-scores of each cached user
+        self._users = {}
+        self._item_ids = {}
+        # (normalized title, title, category, year) of each item id, as first seen
+        self._items = []
+        self._matrix = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = CollectionCache()
+        return self._cache
+
+    def __len__(self):
+        """Number of users in the index."""
+        return len(self._users)
+
+    @property
+    def items(self):
+        return len(self._items)
+
+    def _vector(self, collection, add):
+        """Item ids and rating z-scores of a collection's items; unknown items are skipped unless `add`."""
+        ids = np.full(len(collection), -1, dtype=np.int64)
+        for i, norm_title in enumerate(collection.norm_titles):
+            if not norm_title:
+                continue
+            category = collection.category_of(i)
+            key = item_key(norm_title, category)
+            item = self._item_ids.get(key)
+            if item is None and add:
+                item = self._item_ids[key] = len(self._items)
+                year = int(collection.years[i])
+                self._items.append((norm_title, collection.titles[i], category,
+                                    year if year != UNKNOWN_YEAR else None))
+            if item is not None:
+                ids[i] = item
+        ratings = collection.ratings.astype(np.float64)
+        z = (ratings - ratings.mean()) / (ratings.std() or 1.0) if len(ratings) else ratings
+        known = ids >= 0
+        return ids[known], z[known].astype(np.float32)
+
+    def refresh(self, force=False):
+        """Load the collections saved (or dropped) since the last refresh; returns how many changed.
+
+        Unless `force`, does nothing within REFRESH_INTERVAL of the last
+        refresh. Concurrent calls wait for the one running and then find
+        nothing left to load.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._refreshed_at is not None and now - self._refreshed_at < REFRESH_INTERVAL:
+                return 0
+            self._refreshed_at = now
+            versions = self.cache.versions()
+            changed = [u for u, version in versions.items() if self._versions.get(u) != version]
+            removed = [u for u in self._versions if u not in versions]
+            for username in removed:
+                del self._versions[username], self._users[username]
+            for username in changed:
+                entries = self.cache.load_entries(username) or []
+                self._users[username] = self._vector(rated_items(entries), add=True)
+                self._versions[username] = versions[username]
+            if changed or removed:
+                self._matrix = None
+        return len(changed) + len(removed)
+
+    def _ratings_matrix(self):
+        """COO arrays (rows, cols, values) of the user×item matrix, and its column norms and counts."""
+        if self._matrix is None:
+            vectors = list(self._users.values())
+            lengths = [len(ids) for ids, _ in vectors]
+            rows = np.repeat(np.arange(len(vectors), dtype=np.int64), lengths)
+            cols = np.concatenate([ids for ids, _ in vectors]) if vectors else np.empty(0, dtype=np.int64)
+            values = np.concatenate([z for _, z in vectors]) if vectors else np.empty(0, dtype=np.float32)
+            n_items = len(self._items)
+            norms = np.sqrt(np.bincount(cols, weights=values.astype(np.float64) ** 2, minlength=n_items))
+            raters = np.bincount(cols, minlength=n_items)
+            categories = np.array([category.lower() for _, _, category, _ in self._items], dtype=object)
+            self._matrix = (rows, cols, values, norms, raters, categories)
+        return self._matrix
+
+    def candidates(self, collection, n, categories=None, exclude=()):
+        """The collection's `n` best unseen items, as suggestion dicts.
+
+        Suggestions have the recommender's fields: "score" is relative to
+        the best candidate (100), and "reason" quotes the user's items
+        that contributed most. `categories` restricts the candidates;
+        `exclude` holds normalized titles to leave out.
+        """
+        collection = as_collection(collection)
+        with self._lock:
+            rows, cols, values, norms, raters, item_categories = self._ratings_matrix()
+            n_users, n_items = len(self._users), len(self._items)
+            ids, z = self._vector(collection, add=False)
+            if not len(ids) or not n_items or n <= 0:
+                return []
+
+            q = np.zeros(n_items)
+            q[ids] = z
+            seen = np.zeros(n_items, dtype=bool)
+            seen[ids] = True
+            safe_norms = np.where(norms > 0, norms, 1.0)
+
+            # S q = R^T (R (q / n)) / n
+            per_user = np.bincount(rows, weights=values * (q / safe_norms)[cols], minlength=n_users)
+            scores = np.bincount(cols, weights=values * per_user[rows], minlength=n_items) / safe_norms
+            # Co-occurrences of each item with the query's items
+            shared = np.bincount(rows, weights=seen[cols], minlength=n_users)
+            cooccurrences = np.bincount(cols, weights=shared[rows], minlength=n_items)
+
+            eligible = (~seen) & (raters >= MIN_RATERS) & (cooccurrences >= MIN_COOCCURRENCE) & (scores > 0)
+            if categories:
+                eligible &= np.isin(item_categories, [c.strip().lower() for c in categories])
+            candidates = np.flatnonzero(eligible)
+            if exclude:
+                exclude = set(exclude)
+                keep = [self._items[i][0] not in exclude for i in candidates.tolist()]
+                candidates = candidates[np.asarray(keep, dtype=bool)]
+            if len(candidates) > n:
+                candidates = candidates[np.argpartition(-scores[candidates], n - 1)[:n]]
+            candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+            if not len(candidates):
+                return []
+
+            reasons = self._reasons(ids, z, candidates, rows, cols, values, safe_norms, n_users)
+            best = scores[candidates[0]]
+            return [
+                {
+                    "title": title,
+                    "category": category,
+                    "year": year,
+                    "reason": reason,
+                    "score": round(float(100 * scores[item] / best)),
+                }
+                for item, reason in zip(candidates.tolist(), reasons)
+                for _, title, category, year in [self._items[item]]
+            ]
+
+    def _reasons(self, ids, z, candidates, rows, cols, values, norms, n_users):
+        """French reason of each candidate, quoting the query items weighing most in its score."""
+        k = len(candidates)
+        # Candidate columns as a dense users×k block
+        slot = np.full(len(self._items), -1, dtype=np.int64)
+        slot[candidates] = np.arange(k)
+        block = np.zeros((n_users, k))
+        mask = slot[cols] >= 0
+        block[rows[mask], slot[cols[mask]]] = values[mask]
+
+        # Contribution of each query item to each candidate: z_i × S_ij
+        position = np.full(len(self._items), -1, dtype=np.int64)
+        position[ids] = np.arange(len(ids))
+        mask = position[cols] >= 0
+        contributions = np.zeros((len(ids), k))
+        np.add.at(contributions, position[cols[mask]], values[mask, None] * block[rows[mask]])
+        # Only liked items are quoted
+        liked = np.where(z > 0, z, 0) / norms[ids]
+        contributions *= liked[:, None] / norms[candidates][None, :]
+
+        titles = [self._items[i][1] for i in ids.tolist()]
+        reasons = []
+        for column in contributions.T:
+            top = [i for i in np.argsort(-column, kind="stable")[:REASON_ITEMS] if column[i] > 0]
+            quoted = " et ".join(f"« {titles[i]} »" for i in top)
+            reasons.append(
+                f"Apprécié par les utilisateurs qui ont aimé {quoted}" if quoted
+                else "Apprécié par les utilisateurs aux goûts proches des miens"
+            )
+        return reasons
@@ -0,0 +1,123 @@
+"""Export of batch results (see batch.py) to Excel, CSV or Parquet/Arrow.
+
+    python export.py results.jsonl suggestions.xlsx           one sheet per user
+    python export.py results.jsonl suggestions.parquet        one table, with a username column
+    python export.py results.jsonl exports/ --per-user -f csv one file per user
+
+The results file is read line by line and each user's rows are written
+as soon as they are read, so memory use does not grow with the number
+of users. With --per-user, the files are written by a pool of processes,
+with a bounded number of users waiting for a free process.
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from file_utils import open_writer, user_filename
+
+FORMATS = ("xlsx", "csv", "parquet", "arrow")
+# Users handed to the pool per process and not written yet
+QUEUED_PER_PROCESS = 2
+
+
+def read_results(path):
+    """(username, suggestions) of each successful job of a JSONL results file ("-" for stdin)."""
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{line_no}: {e}") from None
+            if result.get("suggestions"):
+                yield result["username"], result["suggestions"]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def export_combined(results, filename):
+    """Write every user's suggestions to one file; returns the number of users written."""
+    writer = open_writer(filename, with_username=True)
+    users = 0
+    try:
+        for username, suggestions in results:
+            writer.write_user(username, suggestions)
+            users += 1
+    finally:
+        writer.close()
+    return users
+
+
+def _write_user_file(filename, suggestions):
+    writer = open_writer(filename)
+    try:
+        writer.write_rows(suggestions)
+    finally:
+        writer.close()
+    return filename
+
+
+def export_per_user(results, directory, fmt="xlsx", processes=None):
+    """Write each user's suggestions to their own file in `directory`, in a process pool.
+
+    A user listed more than once (batch.py appends to its results file)
+    gets the last of their results. Returns the files written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    processes = processes or os.cpu_count() or 1
+    filenames, taken = {}, set()
+    # Write of each file still in the pool
+    writing = {}
+
+    def collect(futures):
+        for filename, future in list(writing.items()):
+            if future in futures:
+                future.result()
+                del writing[filename]
+
+    with ProcessPoolExecutor(processes) as pool:
+        for username, suggestions in results:
+            # Reading stops while the pool is behind, so pending users stay bounded
+            if len(writing) >= processes * QUEUED_PER_PROCESS:
+                collect(wait(writing.values(), return_when=FIRST_COMPLETED).done)
+            filename = filenames.get(username)
+            if filename is None:
+                filename = filenames[username] = user_filename(directory, username, fmt, taken)
+            elif filename in writing and not writing[filename].cancel():
+                # The earlier result, already being written, must be done before it is overwritten
+                collect(wait([writing[filename]]).done)
+            writing[filename] = pool.submit(_write_user_file, filename, suggestions)
+        collect(wait(writing.values()).done)
+    return list(filenames.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export WatWatch batch results")
+    parser.add_argument("results", help="JSONL results file written by batch.py, or - for stdin")
+    parser.add_argument("target", help="File to write, or directory with --per-user")
+    parser.add_argument("-f", "--format", choices=FORMATS,
+                        help="File format (default: from the target's extension, xlsx with --per-user)")
+    parser.add_argument("--per-user", action="store_true", help="Write one file per user into the target directory")
+    parser.add_argument("-p", "--processes", type=int, help="Processes writing the files with --per-user")
+    args = parser.parse_args()
+
+    results = read_results(args.results)
+    if args.per_user:
+        files = export_per_user(results, args.target, args.format or "xlsx", args.processes)
+        print(f"{len(files)} file(s) written to {args.target}", file=sys.stderr)
+    else:
+        target = args.target
+        if args.format and not target.lower().endswith("." + args.format):
+            target += "." + args.format
+        users = export_combined(results, target)
+        print(f"{users} user(s) written to {target}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
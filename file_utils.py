@@ -1,24 +1,242 @@
-import xlsxwriter
+"""Suggestion files: Excel workbooks, CSV, and Parquet/Arrow tables.
 
+All writers take suggestions in batches through `write_rows`, or a whole
+user at a time through `write_user` (a sheet per user in Excel, a
+username column in the other formats), and hold a bounded number of
+rows in memory whatever the total. `open_writer` picks the writer from
+the file extension.
+"""
+import csv
+import os
+import re
 
+from tracing import traced
+
+# Columns of the CSV and Parquet/Arrow files, in order
+COLUMNS = ("title", "category", "year", "score", "rating_sc_global", "reason")
+# Rows buffered by the Parquet/Arrow writer before they are written as one row group
+ROW_GROUP_SIZE = 50000
+# Excel worksheet names are at most 31 characters, without any of []:*?/\
+SHEET_NAME_MAX = 31
+_SHEET_NAME_RE = re.compile(r"[\[\]:*?/\\]")
+_FILENAME_RE = re.compile(r"[^\w.-]")
+
+
+def suggestion_rows(suggestions):
+    """Values of each suggestion, in COLUMNS order."""
+    for s in suggestions:
+        yield (s["title"], s["category"], s.get("year", ""), s["score"], s.get("rating_sc_global"),
+               s.get("reason", ""))
+
+
+def user_filename(directory, username, extension, taken=None):
+    """File named after a user in `directory`, with unsafe characters of the name replaced.
+
+    Names already in `taken` (a set of lowercased names) get a numbered
+    suffix, so that users whose names only differ by unsafe characters or
+    case get files of their own; the name chosen is added to it.
+    """
+    base = _FILENAME_RE.sub("_", username) or "_"
+    name = base
+    if taken is not None:
+        n = 1
+        # Some file systems ignore case
+        while name.lower() in taken:
+            n += 1
+            name = f"{base}-{n}"
+        taken.add(name.lower())
+    return os.path.join(directory, name + "." + extension)
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class SuggestionsXlsWriter:
+    """Excel file filled incrementally as suggestions come in.
+
+    The workbook is written in xlsxwriter's constant_memory mode: each
+    row is flushed to disk as soon as the next one starts, so rows are
+    written in order, one sheet after the other.
+    """
+
+    HEADERS = ("Titre", "Catégorie", "Année", "Score IA", "Note SC Globale", "Raison")
+
+    def __init__(self, filename):
+        import xlsxwriter
+
+        self.filename = filename
+        self._wb = xlsxwriter.Workbook(filename, {"constant_memory": True})
+        self._ws = None
+        self._sheet_names = set()
+        self._row = 0
+
+    def add_sheet(self, name=None):
+        """Start a new sheet, where the next rows go."""
+        if name is not None:
+            base = _SHEET_NAME_RE.sub("_", name)[:SHEET_NAME_MAX] or "_"
+            name, n = base, 1
+            # Sheet names must be unique, case-insensitively
+            while name.lower() in self._sheet_names:
+                n += 1
+                suffix = f" ({n})"
+                name = base[:SHEET_NAME_MAX - len(suffix)] + suffix
+            self._sheet_names.add(name.lower())
+        self._ws = self._wb.add_worksheet(name)
+        self._ws.write_row(0, 0, self.HEADERS)
+        self._row = 1
+
+    @traced("output.xlsx.rows")
+    def write_rows(self, suggestions):
+        """Append suggestions after the ones already written."""
+        if self._ws is None:
+            self.add_sheet()
+        for values in suggestion_rows(suggestions):
+            self._ws.write_row(self._row, 0, values)
+            self._row += 1
+
+    def write_user(self, username, suggestions):
+        """Write a user's suggestions to a sheet of their own."""
+        self.add_sheet(username)
+        self.write_rows(suggestions)
+
+    @traced("output.xlsx.close")
+    def close(self):
+        if self._ws is None:
+            self.add_sheet()
+        self._wb.close()
+
+
+class SuggestionsCsvWriter:
+    """UTF-8 CSV file of COLUMNS, after a username column if `with_username`."""
+
+    def __init__(self, filename, with_username=False):
+        self.filename = filename
+        self.with_username = with_username
+        self._file = open(filename, "w", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow((("username",) if with_username else ()) + COLUMNS)
+
+    @traced("output.csv.rows")
+    def write_rows(self, suggestions, username=None):
+        """Append suggestions after the ones already written."""
+        rows = suggestion_rows(suggestions)
+        if self.with_username:
+            rows = ((username,) + row for row in rows)
+        self._writer.writerows(rows)
+
+    def write_user(self, username, suggestions):
+        self.write_rows(suggestions, username)
+
+    def close(self):
+        self._file.close()
+
+
+class SuggestionsArrowWriter:
+    """Parquet (.parquet) or Arrow IPC (.arrow, .feather) file of COLUMNS.
+
+    Rows are buffered column by column and written as a row group (or
+    record batch) every ROW_GROUP_SIZE rows. pyarrow is only needed, and
+    imported, for these formats.
+    """
+
+    def __init__(self, filename, with_username=False):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet/Arrow export needs pyarrow: pip install pyarrow") from None
+
+        self.filename = filename
+        self.with_username = with_username
+        fields = [("username", pa.string())] if with_username else []
+        fields += [
+            ("title", pa.string()),
+            ("category", pa.string()),
+            ("year", pa.int32()),
+            ("score", pa.float64()),
+            ("rating_sc_global", pa.float64()),
+            ("reason", pa.string()),
+        ]
+        self._schema = pa.schema(fields)
+        self._from_pydict = pa.Table.from_pydict
+        if filename.lower().endswith(".parquet"):
+            self._writer = pq.ParquetWriter(filename, self._schema)
+        else:
+            self._writer = pa.ipc.new_file(filename, self._schema)
+        self._columns = {name: [] for name in self._schema.names}
+        self._buffered = 0
+
+    def _flush(self):
+        if self._buffered:
+            self._writer.write_table(self._from_pydict(self._columns, schema=self._schema))
+            for values in self._columns.values():
+                values.clear()
+            self._buffered = 0
+
+    @traced("output.arrow.rows")
+    def write_rows(self, suggestions, username=None):
+        """Append suggestions after the ones already written."""
+        columns = self._columns
+        for title, category, year, score, rating, reason in suggestion_rows(suggestions):
+            if self.with_username:
+                columns["username"].append(username)
+            columns["title"].append(title)
+            columns["category"].append(category)
+            columns["year"].append(_as_int(year))
+            columns["score"].append(_as_float(score))
+            columns["rating_sc_global"].append(_as_float(rating))
+            columns["reason"].append(reason)
+            self._buffered += 1
+            if self._buffered >= ROW_GROUP_SIZE:
+                self._flush()
+
+    def write_user(self, username, suggestions):
+        self.write_rows(suggestions, username)
+
+    @traced("output.arrow.close")
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+# Writer of each file extension
+WRITERS = {
+    ".xlsx": SuggestionsXlsWriter,
+    ".csv": SuggestionsCsvWriter,
+    ".parquet": SuggestionsArrowWriter,
+    ".arrow": SuggestionsArrowWriter,
+    ".feather": SuggestionsArrowWriter,
+}
+
+
+def open_writer(filename, with_username=False):
+    """Writer of `filename`, chosen by its extension.
+
+    With `with_username`, CSV and Parquet/Arrow files start with a
+    username column; Excel files get a sheet per user instead.
+    """
+    writer = WRITERS.get(os.path.splitext(filename)[1].lower())
+    if writer is None:
+        raise ValueError(f"unsupported export file: {filename} (expected one of {', '.join(WRITERS)})")
+    if writer is SuggestionsXlsWriter:
+        return writer(filename)
+    return writer(filename, with_username=with_username)
+
+
+@traced("output.xlsx")
 def save_suggestions_to_xls(suggestions, filename):
     """Save suggestions to Excel file with all metadata."""
-    wb = xlsxwriter.Workbook(filename)
-    ws = wb.add_worksheet()
-
-    ws.write(0, 0, "Titre")
-    ws.write(0, 1, "Catégorie")
-    ws.write(0, 2, "Année")
-    ws.write(0, 3, "Score IA")
-    ws.write(0, 4, "Note SC Globale")
-    ws.write(0, 5, "Raison")
-
-    for i, s in enumerate(suggestions, start=1):
-        ws.write(i, 0, s["title"])
-        ws.write(i, 1, s["category"])
-        ws.write(i, 2, s.get("year", ""))
-        ws.write(i, 3, s["score"])
-        ws.write(i, 4, s.get("rating_sc_global"))
-        ws.write(i, 5, s.get("reason", ""))
-
-    wb.close()
+    writer = SuggestionsXlsWriter(filename)
+    writer.write_rows(suggestions)
+    writer.close()
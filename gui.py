@@ -1,3 +1,9 @@
+import asyncio
+import importlib
+import os
+import threading
+
+import aiohttp
 from PySide6.QtWidgets import (
     QWidget, QFileDialog, QVBoxLayout, QLabel,
     QPushButton, QLineEdit, QSpinBox, QListWidget, QListWidgetItem,
@@ -5,69 +11,166 @@ from PySide6.QtWidgets import (
 )
 from PySide6.QtCore import QThread, Signal
 
-from api_clients import fetch_senscritique_collection, get_sc_global_rating
-from recommender import get_recommendations
+from api_clients import fetch_sc_global_ratings_async, sync_collection
+from checkpoint import RunCheckpoint, rating_key
+from collection_cache import CollectionCache
+from recommender import CATEGORIES, rank_suggestions, stream_recommendations
 from visualization import show_bokeh
-from file_utils import save_suggestions_to_xls
+from file_utils import SuggestionsXlsWriter
+from tracing import Trace, profiling, span, tracing
+
+# Heavy dependencies of the later stages, left out of the startup imports
+# and loaded in the background while a run waits on the network
+PRELOAD_MODULES = ("openai", "bokeh.plotting", "bokeh.models", "bokeh.layouts")
+
 
+def preload_modules(modules=PRELOAD_MODULES):
+    """Import `modules` in a background thread so the stages using them do not wait."""
+    def load():
+        for name in modules:
+            importlib.import_module(name)
 
-CATEGORIES = [
-    "Film", "Série", "Court-métrage d'animation", "Long-métrage d'animation",
-    "Émission TV", "Drama", "Documentaire", "Spectacle", "Album",
-    "Court-métrage", "Moyen-métrage", "Manga", "Dessin animé",
-    "Comics", "BD Franco-Belge", "Jeu"
-]
+    threading.Thread(target=load, name="preload", daemon=True).start()
 
 
 class WorkerThread(QThread):
-    """Background thread for processing with progress updates."""
+    """Background thread for processing with progress updates.
+
+    Suggestions are emitted in batches as soon as they are accepted
+    (`suggestions_found`) and again once their global ratings are known
+    (`suggestions_rated`); rating lookups run while generation goes on.
+    Each stage's output is checkpointed (see checkpoint.RunCheckpoint):
+    a run stopped by `cancel` or by an error resumes from its last
+    finished stage or round when the same search is started again.
+    Stage timings go to `trace`; with WATWATCH_PROFILE set, the run is
+    also profiled with cProfile into that file.
+    """
     progress = Signal(int, int)
     status = Signal(str)
+    suggestions_found = Signal(object)
+    suggestions_rated = Signal(object)
     finished_with_result = Signal(object)
     error = Signal(str)
+    cancelled = Signal()
     
-    def __init__(self, username, n_suggestions, categories, model, output_file):
+    def __init__(self, username, n_suggestions, categories, model):
         super().__init__()
         self.username = username
         self.n_suggestions = n_suggestions
         self.categories = categories
         self.model = model
-        self.output_file = output_file
+        self.trace = Trace("gui", username=username, n_suggestions=n_suggestions, model=model)
+        self.checkpoint = RunCheckpoint(username, n_suggestions, categories, model)
+        # Event loop and task of the running stages, cancelled from the GUI thread
+        self._lock = threading.Lock()
+        self._cancel_requested = False
+        self._loop = None
+        self._task = None
+
+    def cancel(self):
+        """Stop the run at its next await; the stages already done stay checkpointed."""
+        with self._lock:
+            self._cancel_requested = True
+            if self._task is not None:
+                self._loop.call_soon_threadsafe(self._task.cancel)
     
     def run(self):
+        with tracing(self.trace), profiling(os.environ.get("WATWATCH_PROFILE")):
+            self._run()
+
+    def _run(self):
         try:
-            self.status.emit("Récupération de la collection SensCritique...")
-            
-            def progress_callback(current, total):
-                self.progress.emit(current, total)
-            
-            collection = fetch_senscritique_collection(self.username, progress_callback)
-            self.status.emit(f"✓ {len(collection)} œuvres récupérées")
-            
-            self.status.emit("Recherche de suggestions...")
-            self.progress.emit(0, 0)
-            recos = get_recommendations(collection, self.n_suggestions, self.categories, self.model)
-            self.status.emit(f"✓ {len(recos)} suggestions trouvées")
-            
-            self.status.emit("Récupération des notes SensCritique...")
-            total_recos = len(recos)
-            for i, reco in enumerate(recos):
-                title = reco["title"]
-                reco["rating_sc_global"] = get_sc_global_rating(title)
-                self.progress.emit(i + 1, total_recos)
-            
-            self.status.emit("✓ Notes récupérées")
-            
-            if self.output_file:
-                self.status.emit("Sauvegarde du fichier Excel...")
-                save_suggestions_to_xls(recos, self.output_file)
-                self.status.emit(f"✓ Fichier sauvegardé : {self.output_file}")
+            recos = asyncio.run(self._run_stages())
+            self.status.emit(f"✓ {len(recos)} suggestions trouvées et notées")
             
             self.finished_with_result.emit(recos)
             
+        except asyncio.CancelledError:
+            self.cancelled.emit()
         except Exception as e:
             self.error.emit(str(e))
 
+    async def _run_stages(self):
+        with self._lock:
+            if self._cancel_requested:
+                raise asyncio.CancelledError()
+            self._loop = asyncio.get_running_loop()
+            self._task = asyncio.current_task()
+        try:
+            return await self._stages()
+        finally:
+            # The loop closes with the run: a late cancel has nothing left to stop
+            with self._lock:
+                self._loop = None
+                self._task = None
+
+    async def _stages(self):
+        if self.checkpoint.stages():
+            self.status.emit("↻ Reprise de la recherche interrompue")
+        cache = CollectionCache()
+
+        def progress_callback(current, total):
+            self.progress.emit(current, total)
+
+        async with aiohttp.ClientSession() as session:
+            collection = self.checkpoint.collection(cache)
+            if collection is not None:
+                self.status.emit(f"✓ Collection déjà récupérée ({len(collection)} œuvres)")
+            else:
+                self.status.emit("Récupération de la collection SensCritique...")
+                collection = await sync_collection(session, self.username, progress_callback, cache=cache)
+                self.checkpoint.save_collection(cache)
+                self.status.emit(f"✓ {len(collection)} œuvres récupérées")
+
+            self.status.emit("Recherche de suggestions...")
+            self.progress.emit(0, self.n_suggestions)
+            with span("recommendations", n_suggestions=self.n_suggestions):
+                recos = await self._generate_and_rate(session, collection)
+
+        self.checkpoint.clear()
+        return recos
+
+    async def _generate_and_rate(self, session, collection):
+        """Stream suggestions and look up their global ratings batch by batch."""
+        recos = []
+        rated = 0
+        # Ratings found before an interruption are not looked up again
+        known = self.checkpoint.ratings()
+
+        async def rate(batch):
+            nonlocal rated
+            missing = []
+            for reco in batch:
+                key = rating_key(reco)
+                if key in known:
+                    reco["rating_sc_global"] = known[key]
+                else:
+                    missing.append(reco)
+            if missing:
+                ratings = await fetch_sc_global_ratings_async(missing, session=session)
+                for reco, rating in zip(missing, ratings):
+                    reco["rating_sc_global"] = rating
+                self.checkpoint.save_ratings(missing)
+            rated += len(batch)
+            self.progress.emit(rated, self.n_suggestions)
+            self.suggestions_rated.emit([dict(r) for r in batch])
+
+        rating_tasks = []
+        try:
+            async for batch in stream_recommendations(collection, self.n_suggestions, self.categories, self.model,
+                                                      checkpoint=self.checkpoint):
+                recos.extend(batch)
+                self.suggestions_found.emit([dict(r) for r in batch])
+                rating_tasks.append(asyncio.create_task(rate(batch)))
+            if rating_tasks:
+                self.status.emit("Récupération des notes SensCritique...")
+            await asyncio.gather(*rating_tasks)
+        finally:
+            for task in rating_tasks:
+                task.cancel()
+
+        return rank_suggestions(recos)
+
 
 class App(QWidget):
     def __init__(self):
@@ -152,8 +255,14 @@ class App(QWidget):
         self.btn_run.clicked.connect(self.run_all)
         layout.addWidget(self.btn_run)
 
+        self.btn_cancel = QPushButton("Annuler")
+        self.btn_cancel.setEnabled(False)
+        self.btn_cancel.clicked.connect(self.cancel_run)
+        layout.addWidget(self.btn_cancel)
+
         self.setLayout(layout)
         self.worker = None
+        self.exporter = None
 
     def select_output(self):
         fn, _ = QFileDialog.getSaveFileName(self, "Choisir fichier XLS", "", "Fichiers Excel (*.xlsx)")
@@ -171,17 +280,30 @@ class App(QWidget):
         cats = [item.text() for item in self.cat_list.selectedItems()]
 
         self.btn_run.setEnabled(False)
+        self.btn_cancel.setEnabled(True)
         self.progress_bar.setVisible(True)
         self.progress_bar.setValue(0)
         self.log_display.clear()
         
-        self.worker = WorkerThread(username, n, cats, model, self.output_file)
+        self.exporter = SuggestionsXlsWriter(self.output_file) if self.output_file else None
+        preload_modules()
+
+        self.worker = WorkerThread(username, n, cats, model)
         self.worker.progress.connect(self.on_progress)
         self.worker.status.connect(self.log)
+        self.worker.suggestions_found.connect(self.on_suggestions_found)
+        self.worker.suggestions_rated.connect(self.on_suggestions_rated)
         self.worker.finished_with_result.connect(self.on_finished)
         self.worker.error.connect(self.on_error)
+        self.worker.cancelled.connect(self.on_cancelled)
         self.worker.start()
     
+    def cancel_run(self):
+        if self.worker:
+            self.btn_cancel.setEnabled(False)
+            self.log("Annulation en cours...")
+            self.worker.cancel()
+
     def on_progress(self, current, total):
         if total > 0:
             self.progress_bar.setMaximum(total)
@@ -193,13 +315,54 @@ class App(QWidget):
     def log(self, message):
         self.log_display.append(message)
     
-    def on_finished(self, recos):
+    def on_suggestions_found(self, batch):
+        self.log(f"+ {len(batch)} suggestion(s) : " + ", ".join(r["title"] for r in batch))
+
+    def on_suggestions_rated(self, batch):
+        for r in batch:
+            rating = r.get("rating_sc_global")
+            self.log(f"  • {r['title']} ({r['category']}) — SC : {rating if rating is not None else '?'}")
+        if self.exporter:
+            with tracing(self.worker.trace):
+                self.exporter.write_rows(batch)
+
+    def close_exporter(self):
+        if self.exporter:
+            with tracing(self.worker.trace):
+                self.exporter.close()
+            self.log(f"✓ Fichier sauvegardé : {self.exporter.filename}")
+            self.exporter = None
+
+    def report_trace(self):
+        """Log the time spent per stage, and dump the trace if WATWATCH_TRACE is set."""
+        trace = self.worker.trace
+        for name, (count, total) in trace.summary().items():
+            self.log(f"⏱ {name} : {total:.2f}s ({count}×)")
+        path = os.environ.get("WATWATCH_TRACE")
+        if path:
+            trace.dump(path)
+            self.log(f"✓ Trace enregistrée : {path}")
+    
+    def end_run(self):
         self.progress_bar.setVisible(False)
         self.btn_run.setEnabled(True)
+        self.btn_cancel.setEnabled(False)
+        self.close_exporter()
+
+    def on_finished(self, recos):
+        self.end_run()
         self.log("\n✅ Terminé ! Affichage des résultats...")
-        show_bokeh(recos)
+        with tracing(self.worker.trace):
+            show_bokeh(recos)
+        self.report_trace()
     
     def on_error(self, error_msg):
-        self.progress_bar.setVisible(False)
-        self.btn_run.setEnabled(True)
+        self.end_run()
         self.log(f"\n❌ Erreur : {error_msg}")
+        self.log("Relancez la même recherche pour reprendre où elle s'est arrêtée.")
+        self.report_trace()
+
+    def on_cancelled(self):
+        self.end_run()
+        self.log("\n⏹ Recherche annulée. Relancez-la pour reprendre où elle s'est arrêtée.")
+        self.report_trace()
@@ -0,0 +1,154 @@
+"""Resolution of suggestions to SensCritique products, and the persisted index of the results.
+
+A search returns several candidates; each is scored locally against the
+suggestion's normalized title, category and year, instead of trusting
+the first result. Resolved products are stored on disk so that later
+lookups of the same suggestion go straight to the product by id.
+"""
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from cache_utils import default_cache_dir
+from titles import normalize_title
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    key TEXT PRIMARY KEY,
+    product_id INTEGER NOT NULL,
+    title TEXT,
+    category TEXT,
+    year INTEGER,
+    resolved_at REAL NOT NULL
+);
+"""
+
+# Match scores: the title must match, category and year disambiguate
+EXACT_TITLE = 3
+PARTIAL_TITLE = 1
+SAME_CATEGORY = 1
+OTHER_CATEGORY = -2
+SAME_YEAR = 1
+NEAR_YEAR = 0.5
+OTHER_YEAR = -1
+# Lowest score of an accepted search result
+MIN_MATCH_SCORE = 2
+
+
+def _as_year(value):
+    try:
+        return int(value) or None
+    except (TypeError, ValueError):
+        return None
+
+
+def rating_query(item):
+    """{"title", "category", "year"} of a title or of a suggestion dict."""
+    if isinstance(item, str):
+        return {"title": item, "category": None, "year": None}
+    return {"title": item["title"], "category": item.get("category"), "year": _as_year(item.get("year"))}
+
+
+def product_key(query):
+    """Key of a rating query: normalized title, category and year."""
+    category = (query.get("category") or "").strip().lower()
+    return f"{normalize_title(query['title'])}|{category}|{query.get('year') or ''}"
+
+
+def match_score(query, norm_title, product):
+    """Score of a search result for a query, or None if its titles do not match."""
+    titles = [normalize_title(t) for t in (product.get("title"), product.get("originalTitle")) if t]
+    if norm_title in titles:
+        score = EXACT_TITLE
+    elif any(t and (norm_title in t or t in norm_title) for t in titles):
+        score = PARTIAL_TITLE
+    else:
+        return None
+
+    category, product_category = query.get("category"), product.get("category")
+    if category and product_category:
+        same = category.strip().lower() == product_category.strip().lower()
+        score += SAME_CATEGORY if same else OTHER_CATEGORY
+
+    year, product_year = _as_year(query.get("year")), _as_year(product.get("displayedYear"))
+    if year and product_year:
+        gap = abs(year - product_year)
+        score += SAME_YEAR if gap == 0 else NEAR_YEAR if gap == 1 else OTHER_YEAR
+    return score
+
+
+def best_match(query, products):
+    """The search result matching the query best, or None if none scores MIN_MATCH_SCORE.
+
+    Between equal scores, the result ranked first by the search wins.
+    """
+    norm_title = normalize_title(query["title"])
+    if not norm_title:
+        return None
+    best, best_score = None, None
+    for product in products:
+        score = match_score(query, norm_title, product)
+        if score is not None and score >= MIN_MATCH_SCORE and (best_score is None or score > best_score):
+            best, best_score = product, score
+    return best
+
+
+class ProductIndex:
+    """SQLite store of the product each rating query resolved to, keyed by product_key.
+
+    The database is only created on first use.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(default_cache_dir(), "products.sqlite")
+        self.path = path
+        self._ready = False
+
+    @contextmanager
+    def _connect(self):
+        if not self._ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                if not self._ready:
+                    conn.executescript(SCHEMA)
+                    self._ready = True
+                yield conn
+        finally:
+            conn.close()
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+
+    def get_many(self, keys):
+        """{key: product id} of the keys already resolved."""
+        keys = list(keys)
+        found = {}
+        with self._connect() as conn:
+            # Stay under SQLite's bound parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = conn.execute(
+                    f"SELECT key, product_id FROM products WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                )
+                found.update(rows)
+        return found
+
+    def set(self, key, product):
+        """Remember the search result `product` for a key."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO products (key, product_id, title, category, year, resolved_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, product["id"], product.get("title"), product.get("category"),
+                 _as_year(product.get("displayedYear")), time.time())
+            )
+
+    def forget(self, key):
+        """Drop a wrong mapping, so the next lookup searches again."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM products WHERE key = ?", (key,))
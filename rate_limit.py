@@ -0,0 +1,289 @@
+"""Shared budgets of outbound API calls: token buckets behind priority queues.
+
+Every request to an external API first takes a slot from its endpoint's
+budget, with `limiter.acquire` (or `acquire_sync` from blocking code):
+one bucket of requests per minute and, for OpenAI, one of tokens per
+minute, charged with the call's estimated tokens and settled with the
+actual usage once known. Callers of an endpoint wait in a single queue
+where interactive runs go before batch ones (see `priority`), and a 429
+answer pauses the endpoint for every caller until its Retry-After.
+
+Budgets come from WATWATCH_APOLLO_RPM, WATWATCH_OPENAI_RPM and
+WATWATCH_OPENAI_TPM when set (0 lifts a limit), DEFAULT_BUDGETS otherwise.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from tracing import span
+
+APOLLO = "apollo"
+OPENAI = "openai"
+
+# Queue priorities, lowest first
+INTERACTIVE = 0
+BATCH = 1
+
+# (requests per minute, tokens per minute) of each endpoint, None for no limit
+DEFAULT_BUDGETS = {
+    APOLLO: (1200, None),
+    OPENAI: (500, 200000),
+}
+BUDGET_VARIABLES = {
+    APOLLO: ("WATWATCH_APOLLO_RPM", None),
+    OPENAI: ("WATWATCH_OPENAI_RPM", "WATWATCH_OPENAI_TPM"),
+}
+# Seconds of budget that can be spent at once after an idle period
+BURST_SECONDS = 10
+# Pause of an endpoint after a 429 without Retry-After (seconds)
+THROTTLE_PAUSE = 2.0
+# Retries of the OpenAI clients themselves: none, 429s are handled here and
+# the callers retry server and network errors (see recommender.OPENAI_RETRIES)
+OPENAI_MAX_RETRIES = 0
+
+_priority = ContextVar("watwatch_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def priority(level):
+    """Queue the calls made in this context, and in the tasks it starts, at `level`."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def retry_after(headers):
+    """Seconds to wait according to a Retry-After header, if any."""
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def env_budget(name):
+    """(requests, tokens) per minute of an endpoint, from the environment or DEFAULT_BUDGETS."""
+    budget = list(DEFAULT_BUDGETS.get(name, (None, None)))
+    for i, variable in enumerate(BUDGET_VARIABLES.get(name, (None, None))):
+        value = os.environ.get(variable) if variable else None
+        if value:
+            budget[i] = float(value) or None
+    return tuple(budget)
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `capacity`.
+
+    A cost above the capacity is granted once the bucket is full and
+    leaves it in debt, so oversized calls are slowed down, not refused.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, cost, now):
+        """Seconds until `cost` tokens can be taken."""
+        self._refill(now)
+        return max(0.0, (min(cost, self.capacity) - self.tokens) / self.rate)
+
+    def take(self, cost):
+        self.tokens -= cost
+
+    def give_back(self, amount):
+        """Return tokens charged in excess (or charge more, if negative)."""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+def _per_minute_bucket(per_minute):
+    if not per_minute:
+        return None
+    rate = per_minute / 60
+    return TokenBucket(rate, max(1.0, rate * BURST_SECONDS))
+
+
+class _Ticket:
+    __slots__ = ("priority", "cost", "wake", "enqueued_at", "cancelled")
+
+    def __init__(self, level, cost, wake):
+        self.priority = level
+        self.cost = cost
+        self.wake = wake
+        self.enqueued_at = time.monotonic()
+        self.cancelled = False
+
+
+class Endpoint:
+    """Budget, waiting queue and counters of one endpoint."""
+
+    def __init__(self, name, requests_per_minute=None, tokens_per_minute=None):
+        self.name = name
+        self.requests = _per_minute_bucket(requests_per_minute)
+        self.tokens = _per_minute_bucket(tokens_per_minute)
+        self.paused_until = 0.0
+        # Heap of (priority, arrival, ticket); only its head may be granted
+        self.queue = []
+        self.granted = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self.max_queued = 0
+
+    def head(self):
+        while self.queue and self.queue[0][2].cancelled:
+            heapq.heappop(self.queue)
+        return self.queue[0][2] if self.queue else None
+
+
+class RateLimiter:
+    """Budgets of every endpoint, shared by the threads and event loops of the process.
+
+    `budgets` maps endpoint names to (requests, tokens) per minute; by
+    default they are read from the environment on first use (see
+    env_budget). Unknown endpoints are not limited.
+    """
+
+    def __init__(self, budgets=None):
+        self._budgets = budgets
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        self._arrivals = itertools.count()
+
+    def _endpoint(self, name):
+        endpoint = self._endpoints.get(name)
+        if endpoint is None:
+            budget = env_budget(name) if self._budgets is None else self._budgets.get(name, (None, None))
+            endpoint = self._endpoints[name] = Endpoint(name, *budget)
+        return endpoint
+
+    def _enqueue(self, name, cost, level, wake):
+        ticket = _Ticket(_priority.get() if level is None else level, cost, wake)
+        with self._lock:
+            endpoint = self._endpoint(name)
+            heapq.heappush(endpoint.queue, (ticket.priority, next(self._arrivals), ticket))
+            endpoint.max_queued = max(endpoint.max_queued, len(endpoint.queue))
+        return endpoint, ticket
+
+    def _try(self, endpoint, ticket):
+        """Grant the ticket if it heads the queue and the budget allows: 0, else seconds to wait (None: until woken)."""
+        with self._lock:
+            if endpoint.head() is not ticket:
+                return None
+            now = time.monotonic()
+            wait = endpoint.paused_until - now
+            if endpoint.requests is not None:
+                wait = max(wait, endpoint.requests.delay(1, now))
+            if endpoint.tokens is not None and ticket.cost:
+                wait = max(wait, endpoint.tokens.delay(ticket.cost, now))
+            if wait > 0:
+                return wait
+
+            heapq.heappop(endpoint.queue)
+            if endpoint.requests is not None:
+                endpoint.requests.take(1)
+            if endpoint.tokens is not None:
+                endpoint.tokens.take(ticket.cost)
+            endpoint.granted += 1
+            endpoint.waited += now - ticket.enqueued_at
+            self._wake_next(endpoint)
+            return 0
+
+    def _wake_next(self, endpoint):
+        head = endpoint.head()
+        if head is not None:
+            head.wake()
+
+    def _cancel(self, endpoint, ticket):
+        with self._lock:
+            ticket.cancelled = True
+            self._wake_next(endpoint)
+
+    async def acquire(self, name, cost=0, level=None):
+        """Wait for a call slot of endpoint `name`, charging `cost` tokens.
+
+        `level` defaults to the context's priority.
+        """
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+        endpoint, ticket = self._enqueue(name, cost, level, lambda: loop.call_soon_threadsafe(woken.set))
+        wait = self._try(endpoint, ticket)
+        if wait == 0:
+            return
+        try:
+            with span("ratelimit.wait", endpoint=name, priority=ticket.priority):
+                while wait != 0:
+                    try:
+                        await asyncio.wait_for(woken.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    woken.clear()
+                    wait = self._try(endpoint, ticket)
+        except BaseException:
+            self._cancel(endpoint, ticket)
+            raise
+
+    def acquire_sync(self, name, cost=0, level=None):
+        """Blocking version of `acquire`, for threads without an event loop."""
+        woken = threading.Event()
+        endpoint, ticket = self._enqueue(name, cost, level, woken.set)
+        wait = self._try(endpoint, ticket)
+        if wait == 0:
+            return
+        try:
+            with span("ratelimit.wait", endpoint=name, priority=ticket.priority):
+                while wait != 0:
+                    woken.wait(wait)
+                    woken.clear()
+                    wait = self._try(endpoint, ticket)
+        except BaseException:
+            self._cancel(endpoint, ticket)
+            raise
+
+    def settle(self, name, charged, used):
+        """Correct the tokens charged for a call once its actual usage is known."""
+        with self._lock:
+            endpoint = self._endpoint(name)
+            if endpoint.tokens is not None:
+                endpoint.tokens.give_back(charged - used)
+
+    def throttle(self, name, seconds=None):
+        """Pause an endpoint after a 429, for `seconds` (its Retry-After) or THROTTLE_PAUSE."""
+        with self._lock:
+            endpoint = self._endpoint(name)
+            pause_end = time.monotonic() + (seconds if seconds is not None else THROTTLE_PAUSE)
+            endpoint.paused_until = max(endpoint.paused_until, pause_end)
+            endpoint.throttled += 1
+            # The head re-checks the pause instead of sleeping through it on an older estimate
+            self._wake_next(endpoint)
+
+    def stats(self):
+        """Queue depth and counters of each endpoint used so far."""
+        now = time.monotonic()
+        with self._lock:
+            stats = {}
+            for name, endpoint in self._endpoints.items():
+                waiting = [t for _, _, t in endpoint.queue if not t.cancelled]
+                stats[name] = {
+                    "queued": len(waiting),
+                    "queued_batch": sum(t.priority >= BATCH for t in waiting),
+                    "max_queued": endpoint.max_queued,
+                    "granted": endpoint.granted,
+                    "throttled": endpoint.throttled,
+                    "wait_seconds": round(endpoint.waited, 3),
+                    "paused_for": round(max(0.0, endpoint.paused_until - now), 3),
+                }
+            return stats
+
+
+limiter = RateLimiter()
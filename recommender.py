@@ -1,58 +1,133 @@
+import asyncio
 import json
-import re
-import unicodedata
-from openai import OpenAI
+import math
+import os
+import random
+import time
 
+import ijson
+import numpy as np
 
-def normalize_title(title):
-    """Normalize title for comparison (remove accents, lowercase, alphanum only)."""
-    if not title:
-        return ""
-    
-    # Remove everything in parentheses (years, versions, etc.)
-    title = re.sub(r'\([^)]*\)', '', title)
-    
-    # Remove common version/sequel markers
-    title = re.sub(r'\b(version|v\.|vol\.|volume|part|partie|saison|season|s\d+|épisode|episode|ep\.?)\b', '', title, flags=re.IGNORECASE)
-    
-    title = unicodedata.normalize("NFKD", title)
-    title = title.encode("ascii", "ignore").decode("ascii")
-    title = title.lower().strip()
-    # Remove all non-alphanumeric characters and collapse spaces
-    title = re.sub(r"[^a-z0-9]+", "", title)
-    return title
+from affinity import LOW_AFFINITY, NEAR_DUPLICATE_THRESHOLD, AffinityIndex
+from cache_utils import JSONFileCache, default_cache_dir, stable_hash
+from checkpoint import GENERATION
+from collection import as_collection
+from cooccurrence import CooccurrenceIndex
+from rate_limit import OPENAI, OPENAI_MAX_RETRIES, limiter, retry_after
+from taste_profile import taste_profile
+from titles import TitleIndex, collection_norm_titles, normalize_title
+from tracing import span
 
+CATEGORIES = [
+    "Film", "Série", "Court-métrage d'animation", "Long-métrage d'animation",
+    "Émission TV", "Drama", "Documentaire", "Spectacle", "Album",
+    "Court-métrage", "Moyen-métrage", "Manga", "Dessin animé",
+    "Comics", "BD Franco-Belge", "Jeu"
+]
 
-def build_prompt(collection, n_suggestions, allowed_categories):
-    """Build the OpenAI prompt for recommendations."""
-    allowed_txt = ", ".join(allowed_categories)
+# Concurrent requests per round in the parallel mode, and how many more
+# suggestions than needed they ask for in total to absorb duplicates
+FANOUT_SHARDS = 3
+FANOUT_OVERSHOOT = 1.3
 
-    library_txt = "\n".join(
-        f"- {x['title']} (cat={x['category']}, rating={x['rating_sc']})"
-        for x in collection[:500]
-    )
+# Prompt size limit (tokens); what the taste profile leaves goes to the
+# list of seen titles
+PROMPT_TOKEN_BUDGET = 3000
+TOKENIZER_ENCODING = "o200k_base"
+# Estimate used when tiktoken is not available
+CHARS_PER_TOKEN = 3.5
+# Suggestions asked per suggestion needed when ranking them locally, and
+# the AI score points worth one standard deviation of local affinity
+PRERANK_OVERSHOOT = 1.5
+AFFINITY_SCORE_WEIGHT = 10
+# Complete answers are reused for identical requests during this long (seconds)
+RESPONSE_CACHE_TTL = 24 * 3600
+# Candidates from similar users' collections suggested in the request prompt
+SEED_CANDIDATES = 15
+# Favorites pointed out to each shard when shards share the same categories
+INSPIRATION_ITEMS = 5
+# Output tokens charged to the OpenAI budget per call, until its usage is known
+ANSWER_TOKENS_ESTIMATE = 1500
+# Retries of an OpenAI call failing with a 5xx answer, a timeout or a network
+# error, with jittered exponential backoff (seconds); 429s go through rate_limit
+OPENAI_RETRIES = 2
+OPENAI_BACKOFF_BASE = 0.5
+OPENAI_BACKOFF_MAX = 8.0
+# Rate limited rounds after which a run stops waiting for OpenAI
+MAX_THROTTLED_ROUNDS = 10
 
-    seen_titles = [x["title"] for x in collection[:1000]]
-    seen_titles_json = json.dumps(seen_titles, ensure_ascii=False, indent=2)
+response_cache = JSONFileCache(os.path.join(default_cache_dir(), "responses"), ttl=RESPONSE_CACHE_TTL)
+cooccurrence_index = CooccurrenceIndex()
 
-    return f"""
-Tu es un moteur de recommandation basé sur les goûts d'un utilisateur SensCritique.
 
-Voici une liste d'œuvres que j'ai DÉJÀ vues/écoutées/lues :
+_encoding = None
+
 
-{library_txt}
+def count_tokens(text):
+    """Number of tokens of a prompt, estimated when no tokenizer is available."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+        except Exception:
+            # tiktoken missing or its encoding cannot be downloaded
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
 
-Et voici la même liste de titres au format JSON (NE JAMAIS LES RECOMMANDER) :
-{seen_titles_json}
 
-Je veux EXACTEMENT {n_suggestions} suggestions parmi les catégories SUIVANTES UNIQUEMENT :
-{allowed_txt}
+def _fit_lines(lines, budget):
+    """Longest prefix of `lines` fitting in `budget` tokens, and its token count."""
+    kept = []
+    used = 0
+    for line in lines:
+        cost = count_tokens(line) + 1
+        if used + cost > budget:
+            break
+        kept.append(line)
+        used += cost
+    return kept, used
+
+
+def seen_titles_section(collection, token_budget, listed=()):
+    """Compact " | "-separated list of seen titles, most recent first, within `token_budget` tokens.
+
+    Titles in `listed` (already shown elsewhere in the prompt) are skipped;
+    anything that does not fit is still rejected client-side.
+    """
+    listed = set(listed)
+    seen_titles, _ = _fit_lines((t for t in collection.titles if t not in listed), token_budget)
+    return " | ".join(seen_titles)
+
+
+def build_library_prompt(collection, token_budget=PROMPT_TOKEN_BUDGET):
+    """Build the static part of the prompt: taste profile, exclusions and answer format.
+
+    The taste profile (see taste_profile.TasteProfile) summarizes the whole
+    collection; the rest of the budget lists recently seen titles. It only
+    depends on the collection and the budget, so every request and retry
+    about the same library starts with the same bytes, which lets the
+    provider's prompt caching apply.
+    """
+    collection = as_collection(collection)
+
+    def render(profile_txt, seen_titles_txt):
+        return f"""
+Tu es un moteur de recommandation basé sur les goûts d'un utilisateur SensCritique.
+
+Voici mon profil de goûts, calculé sur toute ma collection (toutes les œuvres citées sont DÉJÀ vues/écoutées/lues) :
+
+{profile_txt}
+
+Et voici d'autres titres que j'ai aussi déjà vus, séparés par " | " (NE JAMAIS LES RECOMMANDER, pas plus que ceux ci-dessus) :
+{seen_titles_txt}
 
 CONTRAINTES STRICTES :
 - Renvoie toujours le titre français officiel de l'œuvre (tel que sur SensCritique)
-- Le champ "category" DOIT être exactement une des valeurs suivantes : {allowed_txt}
-- Ne recommande JAMAIS une œuvre dont le titre figure exactement dans la liste JSON ci-dessus.
-- Si tu n'es pas sûr d'une catégorie, choisis la plus proche dans cette liste et reste cohérent.
+- Ne recommande JAMAIS une œuvre dont le titre figure exactement dans les listes ci-dessus.
+- Ne recommande JAMAIS une œuvre déjà suggérée plus tôt dans cette conversation.
 - Si tu n'arrives pas à trouver assez d'œuvres qui respectent ces contraintes, propose-en moins, mais ne casse pas le JSON.
 - IMPORTANT - CONTRAINTES D'ÉPOQUE :
   * Maximum 10% d'œuvres sorties avant 1980
@@ -64,7 +139,7 @@ FORMAT DE RÉPONSE (JSON STRICT, PAS DE TEXTE AUTOUR) :
   "suggestions": [
     {{
       "title": "Titre de l'œuvre",
-      "category": "Une valeur parmi : {allowed_txt}",
+      "category": "Une des catégories demandées",
       "year": 2024,
       "reason": "Pourquoi cette recommandation est pertinente pour moi",
       "score": 0-100
@@ -81,225 +156,897 @@ FORMAT DE RÉPONSE (JSON STRICT, PAS DE TEXTE AUTOUR) :
 Réponds STRICTEMENT avec du JSON valide, sans ``` ni explications autour.
 """
 
+    with span("prompt.build", items=len(collection)) as build_span:
+        profile = taste_profile(collection)
+        profile_txt = profile.to_prompt()
+        overhead = count_tokens(render(profile_txt, ""))
+        seen_titles_txt = seen_titles_section(
+            collection, max(0, token_budget - overhead), profile.listed_titles()
+        )
+        prompt = render(profile_txt, seen_titles_txt)
+        build_span.set(chars=len(prompt), tokens=count_tokens(prompt))
+        return prompt
+
+
+def _lead(item):
+    year = f", {item['year']}" if item.get("year") else ""
+    return f"- {item['title']} ({item['category']}{year})"
+
 
-def build_retry_prompt(collection, n_needed, allowed_categories, duplicates, already_suggested):
-    """Build a retry prompt when duplicates were filtered."""
+def build_prompt(n_suggestions, allowed_categories, seeds=(), inspiration=()):
+    """Build the request sent after the library prompt.
+
+    `seeds` are candidates from similar users (see collaborative_candidates),
+    offered to the model as leads; they stay out of the library prompt so
+    its cached prefix does not change as the index grows. `inspiration`
+    are favorites of the user this request should start from (see
+    plan_shards).
+    """
+    allowed_txt = ", ".join(allowed_categories)
+    inspiration_txt = ""
+    if inspiration:
+        favorites = "\n".join(_lead(x) for x in inspiration)
+        inspiration_txt = f"""
+Pour cette demande, pars surtout de ces œuvres que j'ai adorées (déjà vues, à ne pas recommander) :
+{favorites}
+"""
+    seeds_txt = ""
+    if seeds:
+        leads = "\n".join(_lead(s) for s in seeds)
+        seeds_txt = f"""
+Pistes tirées des collections d'utilisateurs SensCritique aux goûts proches des miens (ne les retiens que si elles me correspondent vraiment) :
+{leads}
+"""
+
+    return f"""
+Je veux EXACTEMENT {n_suggestions} suggestions parmi les catégories SUIVANTES UNIQUEMENT :
+{allowed_txt}
+
+- Le champ "category" DOIT être exactement une des valeurs suivantes : {allowed_txt}
+- Si tu n'es pas sûr d'une catégorie, choisis la plus proche dans cette liste et reste cohérent.
+{inspiration_txt}{seeds_txt}"""
+
+
+def build_retry_prompt(n_needed, allowed_categories, duplicates, already_suggested):
+    """Build the follow-up message of a retry round, when duplicates were filtered."""
     allowed_txt = ", ".join(allowed_categories)
     
-    library_txt = "\n".join(
-        f"- {x['title']} (cat={x['category']}, rating={x['rating_sc']})"
-        for x in collection[:500]
-    )
-    
-    seen_titles = [x["title"] for x in collection[:1000]]
-    seen_titles_json = json.dumps(seen_titles, ensure_ascii=False, indent=2)
-    
-    duplicates_txt = ", ".join(duplicates)
+    duplicates_txt = ", ".join(duplicates) or "aucun"
     already_suggested_titles = [s["title"] for s in already_suggested]
-    already_suggested_txt = ", ".join(already_suggested_titles)
+    already_suggested_txt = ", ".join(already_suggested_titles) or "aucune"
     
     return f"""
-Tu es un moteur de recommandation basé sur les goûts d'un utilisateur SensCritique.
+ATTENTION : parmi tes dernières suggestions, celles-ci étaient des DOUBLONS (déjà vues) :
+{duplicates_txt}
 
-Voici une liste d'œuvres que j'ai DÉJÀ vues/écoutées/lues :
+Suggestions VALIDES retenues jusqu'ici (ne les re-suggère pas) :
+{already_suggested_txt}
 
-{library_txt}
+Je veux maintenant EXACTEMENT {n_needed} NOUVELLES suggestions, COMPLÈTEMENT DIFFÉRENTES, parmi les catégories SUIVANTES UNIQUEMENT :
+{allowed_txt}
 
-Liste complète des titres déjà vus (NE JAMAIS LES RECOMMANDER) :
-{seen_titles_json}
+Même format de réponse : JSON STRICT, sans ``` ni explications autour.
+"""
 
-ATTENTION : Tu as déjà suggéré ces œuvres qui étaient des DOUBLONS (déjà vues) :
-{duplicates_txt}
 
-Tu as aussi déjà suggéré ces œuvres VALIDES (ne les re-suggère pas) :
-{already_suggested_txt}
+class Conversation:
+    """Messages of one recommendation thread, resent in full on each round.
 
-Je veux maintenant EXACTEMENT {n_needed} NOUVELLES suggestions (différentes de celles ci-dessus) parmi les catégories SUIVANTES UNIQUEMENT :
-{allowed_txt}
+    The library prompt stays the first message and earlier rounds are
+    only ever appended to, so each request extends the previous one and
+    the provider can serve the shared prefix from its prompt cache.
+    """
 
-CONTRAINTES STRICTES :
-- Renvoie toujours le titre français officiel de l'œuvre (tel que sur SensCritique)
-- Le champ "category" DOIT être exactement une des valeurs suivantes : {allowed_txt}
-- Ne recommande JAMAIS une œuvre dont le titre figure dans la liste JSON ci-dessus
-- Ne recommande PAS les doublons que tu as déjà suggérés
-- Ne recommande PAS les suggestions valides déjà faites
-- Propose des œuvres COMPLÈTEMENT DIFFÉRENTES
-- IMPORTANT - CONTRAINTES D'ÉPOQUE :
-  * Maximum 10% d'œuvres sorties avant 1980
-  * Maximum 20% d'œuvres sorties avant 2000
-  * Privilégie les œuvres récentes (2000+) pour au moins 80% des suggestions
+    def __init__(self, library_prompt, request_prompt):
+        self.messages = [
+            {"role": "developer", "content": library_prompt},
+            {"role": "user", "content": request_prompt},
+        ]
 
-FORMAT DE RÉPONSE (JSON STRICT, PAS DE TEXTE AUTOUR) :
-{{
-  "suggestions": [
-    {{
-      "title": "Titre de l'œuvre",
-      "category": "Une valeur parmi : {allowed_txt}",
-      "year": 2024,
-      "reason": "Pourquoi cette recommandation est pertinente pour moi",
-      "score": 0-100
-    }}
-  ]
-}}
+    @classmethod
+    def from_messages(cls, messages):
+        """Conversation resumed from the messages of a checkpoint."""
+        conversation = cls.__new__(cls)
+        conversation.messages = list(messages)
+        return conversation
 
-À PROPOS DES SCORES :
-- Utilise réellement toute l'échelle 0-100.
-- Certaines suggestions doivent être très fortes (>= 90).
-- D'autres moyennes (~60-80).
-- Au moins une sous 50 (pari/découverte).
+    def add_round(self, answer, follow_up):
+        """Record the model's answer and the next request."""
+        self.messages.append({"role": "assistant", "content": answer})
+        self.messages.append({"role": "user", "content": follow_up})
 
-Réponds STRICTEMENT avec du JSON valide, sans ``` ni explications autour.
-"""
+
+def recommendation_cache_key(collection, categories, model, n_suggestions, prerank=True, n_shards=None):
+    """Key of a recommendation request in the local response cache.
+
+    `n_shards` is None for the single-conversation mode of get_recommendations.
+    """
+    collection = as_collection(collection)
+    return stable_hash({
+        "collection": collection.fingerprint,
+        "categories": sorted(categories or []),
+        "model": model,
+        "n": n_suggestions,
+        "prerank": prerank,
+        "shards": n_shards,
+    })
+
+
+def _strip_code_fences(raw):
+    """Clean markdown code blocks if present."""
+    raw = raw.strip()
+    if raw.startswith("```"):
+        lines = raw.splitlines()
+        if lines and lines[0].startswith("```"):
+            lines = lines[1:]
+        if lines and lines[-1].startswith("```"):
+            lines = lines[:-1]
+        raw = "\n".join(lines).strip()
+    return raw
+
+
+class SuggestionStream:
+    """Incremental parser of a streamed answer, emitting suggestions as they close.
+
+    Text deltas are fed as they arrive; each object of the "suggestions"
+    array is returned by feed() as soon as its closing brace is seen, so a
+    truncated or malformed answer still yields the suggestions before the
+    damage. Anything before the first "{" or after the object closes
+    (e.g. a code fence) is skipped.
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._events = ijson.sendable_list()
+        self._parser = ijson.items_coro(self._events, "suggestions.item", use_float=True)
+        self._started = False
+        # Text of the top-level object once it has closed: what follows is ignored
+        self._object = None
+        self.created_at = time.perf_counter()
+        self.suggestions = []
+        self.error = None
+        # Token usage reported when the answer ended
+        self.usage = None
+
+    def _drain(self):
+        completed = [s for s in self._events if isinstance(s, dict)]
+        del self._events[:]
+        self.suggestions.extend(completed)
+        return completed
+
+    def feed(self, delta):
+        """Add a text delta; return the suggestions completed by it."""
+        self._parts.append(delta)
+        if self.error is not None or self._object is not None:
+            return []
+        if not self._started:
+            start = delta.find("{")
+            if start < 0:
+                return []
+            self._started = True
+            delta = delta[start:]
+        try:
+            self._parser.send(delta.encode("utf-8"))
+        except ijson.JSONError as e:
+            self._object = self._closed_object()
+            if self._object is None:
+                self.error = e
+        return self._drain()
+
+    def _closed_object(self):
+        """Text of the complete JSON object followed by trailing text, or None if the JSON is broken."""
+        text = self.text
+        start = text.find("{")
+        try:
+            _, end = json.JSONDecoder().raw_decode(text, start)
+        except ValueError:
+            return None
+        return text[start:end]
+
+    def close(self, error=None):
+        """Mark the end of the answer; return the suggestions completed by it."""
+        if error is not None:
+            self.error = error
+        elif not self._started:
+            self.error = ValueError("no JSON object in the answer")
+        elif self.error is None and self._object is None:
+            try:
+                self._parser.close()
+            except ijson.JSONError as e:
+                self.error = e
+        return self._drain()
+
+    @property
+    def text(self):
+        return "".join(self._parts)
+
+    def answer(self):
+        """Assistant message for the conversation history: the answer, or its valid part."""
+        if self._object is not None:
+            return self._object
+        if self.error is None:
+            return _strip_code_fences(self.text)
+        return json.dumps({"suggestions": self.suggestions}, ensure_ascii=False)
+
+
+def filter_suggestions(suggestions, title_index, allowed_set, accepted, already_suggested,
+                       affinity_index=None):
+    """Validate raw AI suggestions and append the new ones to `accepted`.
+
+    `already_suggested` holds the normalized titles of every suggestion
+    seen so far and is updated in place. With an `affinity_index`, the
+    suggestions passing the rules are then scored in one batch: near
+    duplicates of seen titles are rejected, low-affinity ones dropped,
+    and the others get an "affinity" field. Returns the titles rejected
+    as duplicates of the collection or of earlier suggestions.
+    """
+    with span("dedupe.filter", suggestions=len(suggestions)) as filter_span:
+        count_before = len(accepted)
+        new_duplicates = _filter_suggestions(
+            suggestions, title_index, allowed_set, accepted, already_suggested, affinity_index
+        )
+        filter_span.set(accepted=len(accepted) - count_before, duplicates=len(new_duplicates))
+        return new_duplicates
+
+
+def _filter_suggestions(suggestions, title_index, allowed_set, accepted, already_suggested,
+                        affinity_index):
+    new_duplicates = []
+    candidates = []
+
+    for s in suggestions:
+        title = s.get("title")
+        category = s.get("category")
+        reason = s.get("reason", "")
+        score = s.get("score", 0)
+        year = s.get("year")
+
+        if not title or not category:
+            continue
+
+        norm_title = normalize_title(title)
+        
+        # Empty after normalization = invalid
+        if not norm_title:
+            continue
+        
+        cat_clean = category.strip().lower()
+
+        # Check if duplicate from collection (strict)
+        if norm_title in title_index:
+            new_duplicates.append(title)
+            continue
+        
+        # Check if already suggested in previous attempts (strict)
+        if norm_title in already_suggested:
+            new_duplicates.append(title)
+            continue
+        
+        # Additional check: detect sequels, prequels, remakes, versions
+        # (substring inclusion or long common prefix with a seen title)
+        if title_index.is_too_similar(norm_title):
+            new_duplicates.append(title)
+            continue
+
+        if allowed_set and cat_clean not in allowed_set:
+            continue
+
+        try:
+            score = float(score)
+        except (ValueError, TypeError):
+            score = 0.0
+        
+        # Validate and convert year
+        try:
+            year = int(year) if year else None
+        except (ValueError, TypeError):
+            year = None
+
+        candidates.append({
+            "title": title,
+            "category": category,
+            "reason": reason,
+            "score": score,
+            "year": year,
+        })
+        already_suggested.add(norm_title)
+
+    if affinity_index is None:
+        accepted.extend(candidates)
+        return new_duplicates
+
+    max_similarity, affinity = affinity_index.score(candidates)
+    for candidate, similarity, candidate_affinity in zip(candidates, max_similarity, affinity):
+        if similarity >= NEAR_DUPLICATE_THRESHOLD:
+            new_duplicates.append(candidate["title"])
+            continue
+        if candidate_affinity < LOW_AFFINITY:
+            continue
+        candidate["affinity"] = round(float(candidate_affinity), 3)
+        accepted.append(candidate)
+
+    return new_duplicates
 
 
-def get_recommendations(collection, n_suggestions, categories, model):
-    """Generate recommendations using OpenAI."""
-    client = OpenAI()
+def rank_suggestions(suggestions):
+    """Order suggestions by AI score adjusted with their local affinity."""
+    return sorted(
+        suggestions,
+        key=lambda s: s["score"] + AFFINITY_SCORE_WEIGHT * s.get("affinity", 0.0),
+        reverse=True
+    )
+
+
+def collaborative_candidates(collection, n, categories, exclude=()):
+    """The collection's `n` best unseen items according to every cached collection.
+
+    See cooccurrence.CooccurrenceIndex; costs no API call.
+    """
+    with span("collaborative.candidates", n=n) as candidates_span:
+        cooccurrence_index.refresh()
+        candidates = cooccurrence_index.candidates(collection, n, categories, exclude)
+        candidates_span.set(users=len(cooccurrence_index), found=len(candidates))
+        return candidates
+
+
+def fill_from_collaborative(collection, n_needed, title_index, allowed_set, accepted, already_suggested,
+                            affinity_index=None):
+    """Complete `accepted` with collaborative candidates, when the model cannot be called.
+
+    They go through the same filter as the model's suggestions. Returns
+    the number of suggestions added.
+    """
+    candidates = collaborative_candidates(
+        collection, math.ceil(n_needed * PRERANK_OVERSHOOT), allowed_set, exclude=already_suggested
+    )
+    count_before = len(accepted)
+    filter_suggestions(candidates, title_index, allowed_set, accepted, already_suggested, affinity_index)
+    added = len(accepted) - count_before
+    print(f"OpenAI indisponible (quota ou limite de débit) : {added} suggestions tirées des collections d'utilisateurs proches")
+    return added
+
+
+def _log_round(label, new_duplicates, added, total, n_suggestions):
+    # The prerank overshoot is not counted beyond N
+    total = min(total, n_suggestions)
+    if new_duplicates:
+        print(f"Tentative {label}: {len(new_duplicates)} doublons filtrés, {added} ajoutés ({total}/{n_suggestions})")
+    else:
+        print(f"Tentative {label}: {added} ajoutés ({total}/{n_suggestions})")
+
+
+def get_recommendations(collection, n_suggestions, categories, model, use_cache=True, prerank=True):
+    """Generate recommendations using OpenAI.
+
+    With `prerank`, the model is asked for PRERANK_OVERSHOOT times more
+    suggestions than needed, which are filtered and ranked locally
+    against the collection (see affinity.AffinityIndex) before keeping
+    the best N. The prompt offers the model candidates from similar
+    users' collections, and these complete the answer if the OpenAI
+    quota is exhausted. Calls go through the shared OpenAI budget (see
+    rate_limit); a rate limited call pauses it until the Retry-After and
+    is made again, without counting as an attempt, and after
+    MAX_THROTTLED_ROUNDS of them the run gives up on OpenAI as with an
+    exhausted quota. Server and network errors are retried with backoff
+    (see OPENAI_RETRIES).
+    """
+    # Imported on first use: openai alone takes most of the app's import time
+    from openai import APIError, OpenAI, RateLimitError
+
+    collection = as_collection(collection)
+    cache_key = recommendation_cache_key(collection, categories, model, n_suggestions, prerank)
+    if use_cache:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    client = OpenAI(max_retries=OPENAI_MAX_RETRIES)
     max_attempts = 10
     all_suggestions = []
-    filtered_duplicates = []
     
-    # Build sets once for performance
-    existing_titles = {normalize_title(x["title"]) for x in collection}
+    # Build the index once for performance
+    title_index = TitleIndex(collection_norm_titles(collection))
+    affinity_index = AffinityIndex(collection) if prerank else None
+    margin = PRERANK_OVERSHOOT if prerank else 1
+    # With prerank, answers are read up to the overshoot so that it gets ranked
+    goal = math.ceil(n_suggestions * margin)
     allowed_set = {c.lower() for c in categories} if categories else set()
+    already_suggested = set()
+    conversation = Conversation(
+        build_library_prompt(collection),
+        build_prompt(math.ceil(n_suggestions * margin), categories,
+                     collaborative_candidates(collection, SEED_CANDIDATES, categories))
+    )
     
     attempt = 0
+    throttled_rounds = 0
+    quota_error = None
     while len(all_suggestions) < n_suggestions and attempt < max_attempts:
-        # Adjust prompt based on attempt
-        if attempt == 0:
-            prompt = build_prompt(collection, n_suggestions, categories)
-        else:
-            remaining_needed = n_suggestions - len(all_suggestions)
-            prompt = build_retry_prompt(
-                collection, 
-                remaining_needed, 
-                categories, 
-                filtered_duplicates,
-                all_suggestions
-            )
-        
-        response = client.responses.create(
-            model=model,
-            input=prompt,
-            store=False,
-        )
+        count_before = len(all_suggestions)
+        new_duplicates = []
 
-        raw = response.output_text.strip()
-        # Clean markdown code blocks if present
-        if raw.startswith("```"):
-            lines = raw.splitlines()
-            if lines and lines[0].startswith("```"):
-                lines = lines[1:]
-            if lines and lines[-1].startswith("```"):
-                lines = lines[:-1]
-            raw = "\n".join(lines).strip()
+        parser = SuggestionStream()
+        charged = estimated_tokens(conversation.messages)
+        limiter.acquire_sync(OPENAI, charged)
+        with span("openai.call", model=model, messages=len(conversation.messages)) as call_span:
+            try:
+                stream = _create_stream_sync(
+                    client,
+                    model=model,
+                    input=conversation.messages,
+                    store=False,
+                    stream=True,
+                )
+            except RateLimitError as e:
+                limiter.settle(OPENAI, charged, 0)
+                throttled_rounds += 1
+                if _quota_exhausted(e) or throttled_rounds >= MAX_THROTTLED_ROUNDS:
+                    quota_error = e
+                    break
+                # Waiting for the budget does not use up an attempt
+                _throttle_openai(e)
+                print(f"Tentative {attempt + 1}: limite de débit OpenAI atteinte, nouvel essai")
+                continue
+            except APIError:
+                limiter.settle(OPENAI, charged, 0)
+                raise
+            error = None
+            try:
+                for event in stream:
+                    completed = _handle_stream_event(parser, event, call_span)
+                    if completed:
+                        new_duplicates += filter_suggestions(
+                            completed, title_index, allowed_set, all_suggestions, already_suggested,
+                            affinity_index
+                        )
+                    if len(all_suggestions) >= goal:
+                        break
+            except APIError as e:
+                error = e
+            finally:
+                stream.close()
+            if len(all_suggestions) < goal:
+                completed = parser.close(error)
+                if completed:
+                    new_duplicates += filter_suggestions(
+                        completed, title_index, allowed_set, all_suggestions, already_suggested,
+                        affinity_index
+                    )
+        limiter.settle(OPENAI, charged, _used_tokens(parser, charged))
 
-        try:
-            data = json.loads(raw)
-        except Exception as e:
+        if not parser.suggestions:
             print(f"Tentative {attempt + 1}: AI response not parseable")
-            print("JSON error:", e)
+            print("JSON error:", parser.error)
             attempt += 1
             continue
+        if parser.error is not None:
+            print(f"Tentative {attempt + 1}: AI response cut short, {len(parser.suggestions)} suggestions kept")
 
-        suggestions = data.get("suggestions", [])
-        already_suggested = {normalize_title(s["title"]) for s in all_suggestions}
+        _log_round(attempt + 1, new_duplicates, len(all_suggestions) - count_before,
+                   len(all_suggestions), n_suggestions)
 
-        new_duplicates = []
-        added_this_round = 0
+        remaining_needed = n_suggestions - len(all_suggestions)
+        conversation.add_round(parser.answer(), build_retry_prompt(
+            math.ceil(remaining_needed * margin), categories, new_duplicates, all_suggestions
+        ))
         
-        for s in suggestions:
-            title = s.get("title")
-            category = s.get("category")
-            reason = s.get("reason", "")
-            score = s.get("score", 0)
-            year = s.get("year")
-
-            if not title or not category:
-                continue
+        attempt += 1
 
-            norm_title = normalize_title(title)
-            
-            # Empty after normalization = invalid
-            if not norm_title:
-                continue
-            
-            cat_clean = category.strip().lower()
+    if quota_error is not None:
+        fill_from_collaborative(collection, n_suggestions - len(all_suggestions), title_index, allowed_set,
+                                all_suggestions, already_suggested, affinity_index)
+    
+    if prerank:
+        all_suggestions = rank_suggestions(all_suggestions)
 
-            # Check if duplicate from collection (strict)
-            if norm_title in existing_titles:
-                new_duplicates.append(title)
-                continue
-            
-            # Check if already suggested in previous attempts (strict)
-            if norm_title in already_suggested:
-                new_duplicates.append(title)
-                continue
-            
-            # Additional check: detect sequels, prequels, remakes, versions
-            # If normalized title is a strict prefix or starts the same way
-            is_too_similar = False
-            for existing_norm in existing_titles:
-                if not norm_title or not existing_norm:
-                    continue
-                    
-                # If one is a substring of the other
-                if norm_title in existing_norm or existing_norm in norm_title:
-                    is_too_similar = True
-                    break
-                
-                # Check if they share a long common prefix (possible sequel/prequel)
-                min_len = min(len(norm_title), len(existing_norm))
-                if min_len >= 5:
-                    common_prefix_len = 0
-                    for i in range(min_len):
-                        if norm_title[i] == existing_norm[i]:
-                            common_prefix_len += 1
-                        else:
-                            break
-                    # If 80%+ of the shorter title matches, it's too similar
-                    if common_prefix_len / min_len >= 0.8:
-                        is_too_similar = True
-                        break
-            
-            if is_too_similar:
-                new_duplicates.append(title)
-                continue
+    if len(all_suggestions) < n_suggestions:
+        print(f"ATTENTION: Seulement {len(all_suggestions)}/{n_suggestions} suggestions uniques trouvées après {attempt} tentatives")
+    elif quota_error is None:
+        # Answers completed without the model are not kept for later runs
+        response_cache.set(cache_key, all_suggestions[:n_suggestions])
+    
+    return all_suggestions[:n_suggestions]
 
-            if allowed_set and cat_clean not in allowed_set:
-                continue
 
+def plan_shards(collection, categories, n_shards):
+    """Split one recommendation request into independent prompts.
+
+    Every shard starts from the same library prompt, built on the whole
+    collection, so all of them see the full profile and exclusions; only
+    the request differs. With enough categories, each shard gets its own
+    group of categories. Otherwise each shard asks over all categories
+    and is pointed at a different handful of the user's favorites (rated
+    above their mean). Returns a list of (categories, inspiration) pairs,
+    `inspiration` being a list of items.
+    """
+    collection = as_collection(collection)
+    n_shards = max(1, n_shards)
+    categories = list(categories or [])
+
+    if len(categories) >= n_shards:
+        return [(categories[i::n_shards], []) for i in range(n_shards)]
+    if n_shards == 1 or not collection:
+        return [(categories, [])]
+
+    by_rating = np.argsort(-collection.ratings, kind="stable")[:INSPIRATION_ITEMS * n_shards]
+    favorites = by_rating[collection.ratings[by_rating] > collection.ratings.mean()]
+    return [(categories, [collection.item(i) for i in favorites[shard::n_shards]])
+            for shard in range(n_shards)]
+
+
+def _usage_attrs(response):
+    """Token counts reported for a Responses API call, for tracing."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return {}
+    details = getattr(usage, "input_tokens_details", None)
+    return {
+        "input_tokens": getattr(usage, "input_tokens", None),
+        "output_tokens": getattr(usage, "output_tokens", None),
+        "cached_tokens": getattr(details, "cached_tokens", None),
+    }
+
+
+def _handle_stream_event(parser, event, call_span):
+    """Feed a Responses API stream event to the parser; return the completed suggestions."""
+    if event.type == "response.output_text.delta":
+        completed = parser.feed(event.delta)
+        if completed and len(parser.suggestions) == len(completed):
+            call_span.set(first_suggestion_after=round(time.perf_counter() - parser.created_at, 3))
+        return completed
+    if event.type in ("response.completed", "response.incomplete"):
+        parser.usage = getattr(event.response, "usage", None)
+        call_span.set(status=event.response.status, **_usage_attrs(event.response))
+    return []
+
+
+def estimated_tokens(messages):
+    """Tokens charged to the OpenAI budget (see rate_limit) before a call."""
+    return sum(count_tokens(m["content"]) for m in messages) + ANSWER_TOKENS_ESTIMATE
+
+
+def _used_tokens(parser, charged):
+    """Tokens a call actually used, or what it was charged if its usage is unknown."""
+    if parser.usage is None:
+        return charged
+    return (getattr(parser.usage, "input_tokens", 0) or 0) + (getattr(parser.usage, "output_tokens", 0) or 0)
+
+
+def _quota_exhausted(error):
+    """Whether a RateLimitError means the account's quota is spent, rather than a rate limit hit."""
+    return getattr(error, "code", None) == "insufficient_quota"
+
+
+def _throttle_openai(error):
+    """Pause every OpenAI call until the Retry-After of a RateLimitError."""
+    response = getattr(error, "response", None)
+    limiter.throttle(OPENAI, retry_after(response.headers) if response is not None else None)
+
+
+def _transient(error):
+    """Whether an OpenAI error is worth retrying as is: a 5xx answer, a timeout or a network error."""
+    from openai import APIConnectionError, InternalServerError
+
+    # APITimeoutError is an APIConnectionError
+    return isinstance(error, (APIConnectionError, InternalServerError))
+
+
+def _backoff_delay(retry):
+    """Jittered exponential backoff before retrying a call after a transient error."""
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** retry))
+
+
+def _create_stream_sync(client, **request):
+    """Start a Responses API stream, retrying transient errors with backoff."""
+    for retry in range(OPENAI_RETRIES + 1):
+        try:
+            return client.responses.create(**request)
+        except Exception as e:
+            if retry == OPENAI_RETRIES or not _transient(e):
+                raise
+        time.sleep(_backoff_delay(retry))
+
+
+async def _create_stream(client, **request):
+    """Async version of _create_stream_sync."""
+    for retry in range(OPENAI_RETRIES + 1):
+        try:
+            return await client.responses.create(**request)
+        except Exception as e:
+            if retry == OPENAI_RETRIES or not _transient(e):
+                raise
+        await asyncio.sleep(_backoff_delay(retry))
+
+
+def _prepare_request(collection, categories, n_shards, prerank):
+    """Title index, affinity index (with `prerank`) and shards of a concurrent request."""
+    title_index = TitleIndex(collection_norm_titles(collection))
+    affinity_index = AffinityIndex(collection) if prerank else None
+    return title_index, affinity_index, plan_shards(collection, categories, n_shards)
+
+
+async def _stream_suggestions(client, model, messages, on_suggestions):
+    """Stream one answer, passing the suggestions completed by each delta to `on_suggestions`.
+
+    Returns the SuggestionStream, whose `error` tells whether the answer
+    was cut short.
+    """
+    from openai import APIError
+
+    parser = SuggestionStream()
+    charged = estimated_tokens(messages)
+    await limiter.acquire(OPENAI, charged)
+    with span("openai.call", model=model, messages=len(messages)) as call_span:
+        try:
+            stream = await _create_stream(
+                client,
+                model=model,
+                input=messages,
+                store=False,
+                stream=True,
+            )
+        except APIError:
+            limiter.settle(OPENAI, charged, 0)
+            raise
+        error = None
+        try:
+            async for event in stream:
+                completed = _handle_stream_event(parser, event, call_span)
+                if completed:
+                    on_suggestions(completed)
+        except APIError as e:
+            error = e
+        finally:
+            await stream.close()
+        completed = parser.close(error)
+        if completed:
+            on_suggestions(completed)
+    limiter.settle(OPENAI, charged, _used_tokens(parser, charged))
+    return parser
+
+
+async def stream_recommendations(collection, n_suggestions, categories, model,
+                                 n_shards=FANOUT_SHARDS, client=None, use_cache=True, prerank=True,
+                                 checkpoint=None):
+    """Yield lists of newly accepted suggestions as the concurrent OpenAI calls answer.
+
+    Each round fans out one request per shard (see plan_shards), each
+    asking for its share of the missing suggestions plus some margin.
+    Answers are merged through the same dedupe filter as soon as they
+    arrive and the accepted ones are yielded right away, so the first
+    results are available after a single round-trip. The round stops as
+    soon as N unique suggestions exist. Every shard keeps its own
+    conversation across rounds. Yielded suggestions are in arrival order;
+    the collaborative leads, the fallback when OpenAI refuses calls and
+    the retries of failed calls work as in get_recommendations.
+
+    With `prerank`, each round collects up to PRERANK_OVERSHOOT times
+    the missing suggestions instead, and yields the best of them (see
+    rank_suggestions) once all its shards have answered.
+
+    With a `checkpoint` (see checkpoint.RunCheckpoint), the accepted
+    suggestions and every shard's conversation are saved after each
+    round, and when the generator is closed or cancelled mid-round. A
+    later call with the same checkpoint first yields the suggestions
+    saved, then carries on from the last finished round.
+    """
+    collection = as_collection(collection)
+    # The collection's fingerprint, indexes and prompts are CPU-bound and the
+    # response cache is on disk: they go to threads so that concurrent
+    # requests keep going
+    cache_key = await asyncio.to_thread(
+        recommendation_cache_key, collection, categories, model, n_suggestions, prerank, n_shards
+    )
+    if use_cache:
+        cached = await asyncio.to_thread(response_cache.get, cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    from openai import RateLimitError
+
+    own_client = client is None
+    if own_client:
+        from openai import AsyncOpenAI
+        client = AsyncOpenAI(max_retries=OPENAI_MAX_RETRIES)
+    max_attempts = 10
+    all_suggestions = []
+
+    title_index, affinity_index, shards = await asyncio.to_thread(
+        _prepare_request, collection, categories, n_shards, prerank
+    )
+    margin = FANOUT_OVERSHOOT * (PRERANK_OVERSHOOT if prerank else 1)
+    allowed_set = {c.lower() for c in categories} if categories else set()
+    already_suggested = set()
+    # SQLite reads and NumPy work, kept off the event loop
+    seeds = await asyncio.to_thread(collaborative_candidates, collection, SEED_CANDIDATES, categories)
+    conversations = [None] * len(shards)
+    # Shared by every shard, built when a shard starts its conversation
+    library_prompt = None
+    # Cleaned answer and duplicates of each shard's last parsed round
+    last_rounds = [None] * len(shards)
+    attempt = 0
+    throttled_rounds = 0
+
+    def keep_best(pool):
+        """Move the best suggestions of `pool` that still fit in N to the accepted ones."""
+        kept = (rank_suggestions(pool) if prerank else pool)[:n_suggestions - len(all_suggestions)]
+        all_suggestions.extend(kept)
+        del pool[:]
+        return kept
+
+    def save_state(rounds, pool=()):
+        # Suggestions of an interrupted round not passed on yet may be suggested again
+        unused = {normalize_title(s["title"]) for s in pool}
+        checkpoint.save(GENERATION, {
+            "fingerprint": collection.fingerprint,
+            "rounds": rounds,
+            "suggestions": all_suggestions,
+            "already_suggested": sorted(already_suggested - unused),
+            "conversations": [c.messages if c is not None else None for c in conversations],
+            "last_rounds": last_rounds,
+        })
+
+    state = checkpoint.load(GENERATION) if checkpoint is not None else None
+    # Only a run on the same collection and shards can go on where it stopped
+    if (state is not None and state["fingerprint"] == collection.fingerprint
+            and len(state["conversations"]) == len(shards)):
+        attempt = state["rounds"]
+        all_suggestions.extend(state["suggestions"])
+        already_suggested.update(state["already_suggested"])
+        conversations = [Conversation.from_messages(m) if m is not None else None for m in state["conversations"]]
+        last_rounds = [tuple(r) if r is not None else None for r in state["last_rounds"]]
+        print(f"Reprise après {attempt} tentative(s) : {len(all_suggestions)} suggestions déjà acceptées")
+
+    # Suggestions of every shard as they complete (a list per delta), then each shard's parser
+    events = asyncio.Queue()
+
+    async def ask(shard):
+        try:
+            parser = await _stream_suggestions(
+                client, model, conversations[shard].messages, lambda s: events.put_nowait((shard, s))
+            )
+            events.put_nowait((shard, parser))
+        except Exception as e:
+            events.put_nowait((shard, e))
+
+    quota_error = None
+    try:
+        if all_suggestions:
+            yield all_suggestions[:n_suggestions]
+        while len(all_suggestions) < n_suggestions and attempt < max_attempts and quota_error is None:
+            remaining_needed = n_suggestions - len(all_suggestions)
+            per_shard = max(1, math.ceil(remaining_needed * margin / len(shards)))
+            if library_prompt is None and None in conversations:
+                library_prompt = await asyncio.to_thread(build_library_prompt, collection)
+
+            for shard, (shard_categories, inspiration) in enumerate(shards):
+                if conversations[shard] is None:
+                    shard_set = {c.lower() for c in shard_categories}
+                    shard_seeds = [s for s in seeds if not shard_set or s["category"].lower() in shard_set]
+                    conversations[shard] = Conversation(
+                        library_prompt,
+                        build_prompt(per_shard, shard_categories, shard_seeds, inspiration)
+                    )
+                elif last_rounds[shard] is not None:
+                    raw, new_duplicates = last_rounds[shard]
+                    conversations[shard].add_round(raw, build_retry_prompt(
+                        per_shard, shard_categories, new_duplicates, all_suggestions
+                    ))
+                    last_rounds[shard] = None
+
+            round_duplicates = [[] for _ in shards]
+            round_added = [0] * len(shards)
+            # Suggestions accepted by the filter and not passed on yet
+            pool = []
+            round_goal = n_suggestions
+            if prerank:
+                round_goal = len(all_suggestions) + math.ceil(remaining_needed * PRERANK_OVERSHOOT)
+            tasks = [asyncio.create_task(ask(shard)) for shard in range(len(shards))]
+            round_done = False
+            answered = 0
+            throttled = None
             try:
-                score = float(score)
-            except (ValueError, TypeError):
-                score = 0.0
-            
-            # Validate and convert year
-            try:
-                year = int(year) if year else None
-            except (ValueError, TypeError):
-                year = None
-
-            all_suggestions.append({
-                "title": title,
-                "category": category,
-                "reason": reason,
-                "score": score,
-                "year": year,
-            })
-            already_suggested.add(norm_title)
-            added_this_round += 1
-        
-        # Track duplicates for next attempt
-        if new_duplicates:
-            filtered_duplicates.extend(new_duplicates)
-            print(f"Tentative {attempt + 1}: {len(new_duplicates)} doublons filtrés, {added_this_round} ajoutés ({len(all_suggestions)}/{n_suggestions})")
-        else:
-            print(f"Tentative {attempt + 1}: {added_this_round} ajoutés ({len(all_suggestions)}/{n_suggestions})")
-        
-        attempt += 1
-    
+                pending = len(tasks)
+                while pending and len(all_suggestions) + len(pool) < round_goal:
+                    shard, item = await events.get()
+                    label = f"{attempt + 1}.{shard + 1}"
+                    if isinstance(item, RateLimitError):
+                        if _quota_exhausted(item):
+                            quota_error = item
+                            break
+                        # Asked again next round, once the pause is over
+                        _throttle_openai(item)
+                        throttled = item
+                        pending -= 1
+                        print(f"Tentative {label}: limite de débit OpenAI atteinte, nouvel essai")
+                        continue
+                    if isinstance(item, Exception):
+                        raise item
+
+                    if isinstance(item, SuggestionStream):
+                        answered += 1
+                        pending -= 1
+                        if not item.suggestions:
+                            print(f"Tentative {label}: AI response not parseable")
+                            print("JSON error:", item.error)
+                            continue
+                        if item.error is not None:
+                            print(f"Tentative {label}: AI response cut short, "
+                                  f"{len(item.suggestions)} suggestions kept")
+                        last_rounds[shard] = (item.answer(), round_duplicates[shard])
+                        _log_round(label, round_duplicates[shard], round_added[shard],
+                                   len(all_suggestions) + len(pool), n_suggestions)
+                        continue
+
+                    # Suggestions completed by one delta: filter them now, and pass on
+                    # the accepted ones unless ranking the round
+                    count_before = len(pool)
+                    round_duplicates[shard] += filter_suggestions(
+                        item, title_index, allowed_set, pool, already_suggested, affinity_index
+                    )
+                    round_added[shard] += len(pool) - count_before
+                    if not prerank:
+                        accepted = keep_best(pool)
+                        if accepted:
+                            yield accepted
+                if prerank:
+                    accepted = keep_best(pool)
+                    if accepted:
+                        yield accepted
+                round_done = True
+            finally:
+                for task in tasks:
+                    task.cancel()
+                # Let cancelled shards close their streams before the client goes
+                await asyncio.gather(*tasks, return_exceptions=True)
+                # Drop what cancelled shards had queued for this round
+                while not events.empty():
+                    events.get_nowait()
+                # A round where every answer was rate limited does not use up an attempt
+                if round_done and (answered or throttled is None):
+                    attempt += 1
+                elif round_done:
+                    throttled_rounds += 1
+                if checkpoint is not None:
+                    # An interrupted round is asked again on resume, its accepted suggestions kept
+                    save_state(attempt, pool)
+            if throttled_rounds >= MAX_THROTTLED_ROUNDS:
+                # Given up on as with an exhausted quota
+                quota_error = throttled
+    finally:
+        if own_client:
+            await client.close()
+
+    if quota_error is not None and len(all_suggestions) < n_suggestions:
+        pool = []
+        await asyncio.to_thread(fill_from_collaborative, collection, n_suggestions - len(all_suggestions),
+                                title_index, allowed_set, pool, already_suggested, affinity_index)
+        accepted = keep_best(pool)
+        if accepted:
+            yield accepted
+
+    all_suggestions = all_suggestions[:n_suggestions]
+    if prerank:
+        all_suggestions = rank_suggestions(all_suggestions)
+
     if len(all_suggestions) < n_suggestions:
         print(f"ATTENTION: Seulement {len(all_suggestions)}/{n_suggestions} suggestions uniques trouvées après {attempt} tentatives")
-    
-    return all_suggestions[:n_suggestions]
+    elif quota_error is None:
+        await asyncio.to_thread(response_cache.set, cache_key, all_suggestions)
+
+
+async def get_recommendations_async(collection, n_suggestions, categories, model,
+                                    n_shards=FANOUT_SHARDS, client=None, use_cache=True, prerank=True,
+                                    checkpoint=None):
+    """Generate recommendations with concurrent OpenAI calls (see stream_recommendations)."""
+    suggestions = []
+    async for accepted in stream_recommendations(collection, n_suggestions, categories, model,
+                                                 n_shards, client, use_cache, prerank, checkpoint):
+        suggestions.extend(accepted)
+    return rank_suggestions(suggestions) if prerank else suggestions
+
+
+def get_recommendations_parallel(collection, n_suggestions, categories, model, n_shards=FANOUT_SHARDS):
+    """Synchronous wrapper for the concurrent recommendation mode."""
+    return asyncio.run(get_recommendations_async(collection, n_suggestions, categories, model, n_shards))
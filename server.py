@@ -0,0 +1,273 @@
+"""HTTP service for collection sync, recommendations and rating lookups.
+
+One long-running process keeps its HTTP connection pool, OpenAI client
+and caches (synced collections, global ratings, recommendations) warm
+between requests. Concurrent identical requests share one in-flight job:
+two callers asking for the same user's recommendations with the same
+parameters get the result of a single run.
+
+    GET  /health
+    GET  /collections/{username}          summary of the (warm) collection
+    POST /collections/{username}/sync     sync it now; ?items=1 adds the items
+    POST /recommendations                 {"username", "n", "categories", "model", "ratings", "chart"}
+    POST /ratings                         {"titles": ["...", {"title", "category", "year"}, ...]}
+"""
+import argparse
+import asyncio
+import functools
+import json
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+from openai import APIError, AsyncOpenAI
+
+from api_clients import (
+    IncompleteCollectionError, SensCritiqueError, fetch_sc_global_ratings_async, rating_cache, sync_collection
+)
+from batch import CONNECTIONS_PER_JOB, DEFAULT_CONCURRENCY, parse_job
+from cache_utils import TTLCache
+from collection_cache import CollectionCache
+from product_index import rating_query
+from rate_limit import OPENAI_MAX_RETRIES, limiter
+from recommender import get_recommendations_async
+from tracing import Trace, tracing
+from visualization import chart_json
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+# Seconds a synced collection is served from memory before the next sync
+COLLECTION_FRESHNESS = 300
+# Users whose synced collections are kept in memory
+WARM_COLLECTIONS = 256
+# Upper bounds of a single request
+MAX_SUGGESTIONS = 50
+MAX_RATING_TITLES = 200
+
+_dumps = functools.partial(json.dumps, ensure_ascii=False)
+
+
+class SingleFlight:
+    """At most one running job per key; concurrent callers of a key share its result.
+
+    Jobs run in their own task, so a caller going away (e.g. a client
+    disconnecting) does not cancel the job for the others.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.joined = 0
+
+    def __len__(self):
+        return len(self._inflight)
+
+    def _done(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Retrieved here in case every caller went away
+            task.exception()
+
+    async def run(self, key, job):
+        """Await `job()` under `key`, joining its in-flight run if there is one."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(job())
+            self._inflight[key] = task
+            task.add_done_callback(functools.partial(self._done, key))
+        else:
+            self.joined += 1
+        return await asyncio.shield(task)
+
+
+class WatWatchService:
+    """Clients and caches shared by every request of the server."""
+
+    def __init__(self, cache=None, concurrency=DEFAULT_CONCURRENCY):
+        self.cache = cache or CollectionCache()
+        self.concurrency = concurrency
+        self.session = None
+        self.client = None
+        self._jobs = None
+        self._collections = TTLCache(maxsize=WARM_COLLECTIONS, ttl=COLLECTION_FRESHNESS)
+        self._flights = SingleFlight()
+
+    async def start(self, app):
+        self._jobs = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency * CONNECTIONS_PER_JOB, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector)
+        self.client = AsyncOpenAI(max_retries=OPENAI_MAX_RETRIES)
+
+    async def stop(self, app):
+        await self.session.close()
+        await self.client.close()
+
+    def status(self):
+        return {
+            "inflight": len(self._flights),
+            "joined": self._flights.joined,
+            "warm_collections": len(self._collections),
+            "cached_ratings": len(rating_cache),
+            "rate_limits": limiter.stats(),
+        }
+
+    async def collection(self, username, refresh=False):
+        """The user's collection, synced at most every COLLECTION_FRESHNESS seconds unless `refresh`."""
+        if not refresh:
+            collection = self._collections.get(username)
+            if collection is not None:
+                return collection
+        return await self._flights.run(("sync", username), lambda: self._sync(username))
+
+    async def _sync(self, username):
+        collection = await sync_collection(self.session, username, cache=self.cache)
+        self._collections.set(username, collection)
+        return collection
+
+    async def recommend(self, job, with_ratings=True):
+        key = ("recommend", job["username"], job["n"], tuple(job["categories"]), job["model"], with_ratings)
+        return await self._flights.run(key, lambda: self._recommend(job, with_ratings))
+
+    async def _recommend(self, job, with_ratings):
+        async with self._jobs:
+            collection = await self.collection(job["username"])
+            if not collection:
+                raise _not_found("empty or private collection")
+            recos = await get_recommendations_async(
+                collection, job["n"], job["categories"], job["model"], client=self.client
+            )
+            recos = [dict(r) for r in recos]
+            if with_ratings:
+                ratings = await self.ratings(recos)
+                for r, rating in zip(recos, ratings):
+                    r["rating_sc_global"] = rating
+        return recos
+
+    async def ratings(self, items):
+        return await fetch_sc_global_ratings_async(items, session=self.session)
+
+
+SERVICE = web.AppKey("service", WatWatchService)
+
+
+def collection_summary(username, collection, with_items=False):
+    counts = np.bincount(collection.category_codes, minlength=len(collection.categories))
+    summary = {
+        "username": username,
+        "items": len(collection),
+        "fingerprint": collection.fingerprint,
+        "categories": {c: int(n) for c, n in zip(collection.categories, counts)},
+    }
+    if with_items:
+        summary["collection"] = [
+            {k: v for k, v in item.items() if k != "norm_title"} for item in collection
+        ]
+    return summary
+
+
+def _not_found(message):
+    return web.HTTPNotFound(text=_dumps({"error": message}), content_type="application/json")
+
+
+async def _json_body(request):
+    try:
+        return await request.json()
+    except json.JSONDecodeError as e:
+        raise ValueError(f"invalid JSON body: {e}") from None
+
+
+@web.middleware
+async def errors_and_timing(request, handler):
+    """JSON errors, and the request's stage timings as a Server-Timing header."""
+    trace = Trace("request", path=request.path)
+    with tracing(trace):
+        try:
+            response = await handler(request)
+        except web.HTTPException:
+            raise
+        except ValueError as e:
+            response = web.json_response({"error": str(e)}, status=400, dumps=_dumps)
+        except SensCritiqueError as e:
+            # An unknown or private user is the client's mistake, not an upstream failure
+            status = 404 if e.status == 404 else 502
+            response = web.json_response({"error": f"{type(e).__name__}: {e}"}, status=status, dumps=_dumps)
+        except (IncompleteCollectionError, APIError, aiohttp.ClientError) as e:
+            response = web.json_response({"error": f"{type(e).__name__}: {e}"}, status=502, dumps=_dumps)
+    response.headers["Server-Timing"] = ", ".join(
+        f"{name};dur={total * 1000:.1f}" for name, (_, total) in trace.summary().items()
+    )
+    return response
+
+
+async def health(request):
+    service = request.app[SERVICE]
+    return web.json_response(dict(status="ok", **service.status()))
+
+
+async def get_collection(request):
+    service = request.app[SERVICE]
+    username = request.match_info["username"]
+    refresh = request.method == "POST"
+    collection = await service.collection(username, refresh=refresh)
+    if not collection:
+        raise _not_found("empty or private collection")
+    with_items = request.query.get("items") in ("1", "true")
+    return web.json_response(collection_summary(username, collection, with_items), dumps=_dumps)
+
+
+async def post_recommendations(request):
+    service = request.app[SERVICE]
+    body = await _json_body(request)
+    job = parse_job(body)
+    if not 1 <= job["n"] <= MAX_SUGGESTIONS:
+        raise ValueError(f"n must be between 1 and {MAX_SUGGESTIONS}")
+    suggestions = await service.recommend(job, with_ratings=bool(body.get("ratings", True)))
+    result = dict(job, suggestions=suggestions)
+    if body.get("chart"):
+        # Bokeh JSON item, rendered client-side with Bokeh.embed.embed_item
+        result["chart"] = await asyncio.to_thread(chart_json, suggestions)
+    return web.json_response(result, dumps=_dumps)
+
+
+async def post_ratings(request):
+    service = request.app[SERVICE]
+    body = await _json_body(request)
+    items = body.get("titles") if isinstance(body, dict) else None
+    if not isinstance(items, list) or not all(
+        isinstance(t, str) or (isinstance(t, dict) and isinstance(t.get("title"), str)) for t in items
+    ):
+        raise ValueError("titles must be a list of titles or of {\"title\", \"category\", \"year\"} objects")
+    if len(items) > MAX_RATING_TITLES:
+        raise ValueError(f"at most {MAX_RATING_TITLES} titles per request")
+    ratings = await service.ratings(items)
+    return web.json_response({"ratings": [
+        dict(rating_query(item), rating_sc_global=rating) for item, rating in zip(items, ratings)
+    ]}, dumps=_dumps)
+
+
+def create_app(cache=None, concurrency=DEFAULT_CONCURRENCY):
+    service = WatWatchService(cache, concurrency)
+    app = web.Application(middlewares=[errors_and_timing])
+    app[SERVICE] = service
+    app.on_startup.append(service.start)
+    app.on_cleanup.append(service.stop)
+    app.router.add_get("/health", health)
+    app.router.add_get("/collections/{username}", get_collection)
+    app.router.add_post("/collections/{username}/sync", get_collection)
+    app.router.add_post("/recommendations", post_recommendations)
+    app.router.add_post("/ratings", post_ratings)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve WatWatch recommendations over HTTP")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("-c", "--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Recommendation jobs run at the same time")
+    args = parser.parse_args()
+    web.run_app(create_app(concurrency=max(1, args.concurrency)), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
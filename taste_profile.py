@@ -0,0 +1,147 @@
+"""Summary of a user's tastes computed over the whole collection, for prompts."""
+import numpy as np
+
+from cache_utils import TTLCache
+from collection import RATING_BUCKETS, UNKNOWN_YEAR, as_collection
+
+# Items listed among the overall favorites and dislikes
+TOP_ITEMS = 15
+BOTTOM_ITEMS = 8
+# Favorites listed for each category
+TOP_PER_CATEGORY = 3
+# Categories and decades with fewer items are left out of the summary
+MIN_GROUP_SIZE = 3
+# Profiles kept in memory, keyed by collection fingerprint
+PROFILE_CACHE_SIZE = 256
+
+_profiles = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=7 * 24 * 3600)
+
+
+def _group_stats(codes, ratings, n_groups):
+    """Count, mean and standard deviation of the ratings of each group code."""
+    counts = np.bincount(codes, minlength=n_groups)
+    safe = np.maximum(counts, 1)
+    means = np.bincount(codes, weights=ratings, minlength=n_groups) / safe
+    squares = np.bincount(codes, weights=ratings.astype(np.float64) ** 2, minlength=n_groups) / safe
+    stds = np.sqrt(np.maximum(squares - means ** 2, 0))
+    return counts, means, stds
+
+
+def _best(indices, ratings, count, reverse=True):
+    """The `count` best (or worst) rated of `indices`; ties go to the most recent."""
+    keys = -ratings[indices] if reverse else ratings[indices]
+    return indices[np.argsort(keys, kind="stable")[:count]]
+
+
+class TasteProfile:
+    """Rating distributions, favorites, dislikes and affinities of a collection.
+
+    Everything is aggregated over the whole collection with vectorized
+    group-bys, so its size does not depend on the library size. Category
+    and era affinities are the group's mean rating relative to the user's
+    overall mean, in standard deviations of the user's ratings.
+    """
+
+    def __init__(self, collection):
+        collection = as_collection(collection)
+        self.size = len(collection)
+        ratings = collection.ratings.astype(np.float64)
+        self.mean = float(ratings.mean()) if self.size else 0.0
+        self.std = float(ratings.std()) if self.size else 0.0
+        scale = self.std or 1.0
+        buckets = np.clip(ratings, 0, RATING_BUCKETS - 1).astype(np.int64)
+        self.histogram = np.bincount(buckets, minlength=RATING_BUCKETS)[1:].tolist()
+
+        counts, means, stds = _group_stats(collection.category_codes, ratings, len(collection.categories))
+        pair_counts = np.bincount(
+            collection.category_codes.astype(np.int64) * RATING_BUCKETS + buckets,
+            minlength=len(collection.categories) * RATING_BUCKETS
+        ).reshape(-1, RATING_BUCKETS)
+        self.categories = []
+        for code in np.argsort(-counts, kind="stable"):
+            if counts[code] < MIN_GROUP_SIZE and len(collection.categories) > 1:
+                continue
+            name = collection.categories[code]
+            favorites = _best(collection.category_indices(name), collection.ratings, TOP_PER_CATEGORY)
+            self.categories.append({
+                "category": name,
+                "count": int(counts[code]),
+                "share": float(counts[code] / self.size),
+                "mean": float(means[code]),
+                "std": float(stds[code]),
+                "affinity": float((means[code] - self.mean) / scale),
+                "histogram": pair_counts[code, 1:].tolist(),
+                "favorites": [collection.titles[i] for i in favorites],
+            })
+
+        known = np.flatnonzero(collection.years != UNKNOWN_YEAR)
+        self.eras = []
+        if len(known):
+            decades = (collection.years[known] // 10 * 10).astype(np.int64)
+            first = int(decades.min())
+            n_decades = (int(decades.max()) - first) // 10 + 1
+            counts, means, _ = _group_stats((decades - first) // 10, ratings[known], n_decades)
+            for offset in np.flatnonzero(counts >= MIN_GROUP_SIZE):
+                self.eras.append({
+                    "decade": first + 10 * int(offset),
+                    "count": int(counts[offset]),
+                    "mean": float(means[offset]),
+                    "affinity": float((means[offset] - self.mean) / scale),
+                })
+
+        everything = np.arange(self.size)
+        self.favorites = [collection.item(i) for i in _best(everything, collection.ratings, TOP_ITEMS)]
+        self.dislikes = [
+            collection.item(i) for i in _best(everything, collection.ratings, BOTTOM_ITEMS, reverse=False)
+            if collection.ratings[i] < self.mean
+        ]
+
+    def listed_titles(self):
+        """Titles named in the profile."""
+        titles = [x["title"] for x in self.favorites + self.dislikes]
+        for c in self.categories:
+            titles.extend(c["favorites"])
+        return titles
+
+    def to_prompt(self):
+        """Compact French summary of the profile for the recommendation prompt."""
+        def item_line(x):
+            year = f", {x['year']}" if x.get("year") else ""
+            return f"- {x['title']} ({x['category']}{year}, {x['rating_sc']:g})"
+
+        lines = [
+            f"Œuvres notées : {self.size}, note moyenne {self.mean:.1f}/10 (écart-type {self.std:.1f})",
+            "Répartition des notes 1→10 : " + " / ".join(str(c) for c in self.histogram),
+            "",
+            "Catégories (nombre d'œuvres, note moyenne, part des notes ≥ 8 et ≤ 4, affinité relative, favoris) :",
+        ]
+        for c in self.categories:
+            high = sum(c["histogram"][7:]) / c["count"]
+            low = sum(c["histogram"][:4]) / c["count"]
+            lines.append(
+                f"- {c['category']} : {c['count']} ({c['share']:.0%}), moyenne {c['mean']:.1f}, "
+                f"≥ 8 : {high:.0%}, ≤ 4 : {low:.0%}, affinité {c['affinity']:+.1f} ; "
+                f"favoris : {', '.join(c['favorites'])}"
+            )
+        if self.eras:
+            lines += ["", "Époques (nombre d'œuvres, note moyenne, affinité relative) :"]
+            lines += [
+                f"- {e['decade']}s : {e['count']}, moyenne {e['mean']:.1f}, affinité {e['affinity']:+.1f}"
+                for e in self.eras
+            ]
+        lines += ["", "Mes œuvres préférées (catégorie, année, ma note /10) :"]
+        lines += [item_line(x) for x in self.favorites]
+        if self.dislikes:
+            lines += ["", "Ce que j'ai le moins aimé :"]
+            lines += [item_line(x) for x in self.dislikes]
+        return "\n".join(lines)
+
+
+def taste_profile(collection):
+    """TasteProfile of a collection, computed once per collection version."""
+    collection = as_collection(collection)
+    profile = _profiles.get(collection.fingerprint)
+    if profile is None:
+        profile = TasteProfile(collection)
+        _profiles.set(collection.fingerprint, profile)
+    return profile
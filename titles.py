@@ -0,0 +1,217 @@
+"""Title normalization and the prebuilt index used for similarity checks."""
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from functools import lru_cache
+
+# Shortest title length for which the common-prefix rule applies
+PREFIX_MIN_LEN = 5
+# Fraction of the shorter title that must be a common prefix
+PREFIX_RATIO = 0.8
+# n-gram size used by the containment index
+GRAM_SIZE = 3
+# Titles whose normalized form is memoized
+NORMALIZE_CACHE_SIZE = 100000
+
+
+_PARENS_RE = re.compile(r'\([^)\n]*\)')
+_MARKERS_RE = re.compile(
+    r'\b(version|v\.|vol\.|volume|part|partie|saison|season|s\d+|épisode|episode|ep\.?)\b',
+    flags=re.IGNORECASE
+)
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9\n]+")
+
+# Bounded LRU memo shared by normalize_title and normalize_titles
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+
+
+def _normalize_joined(text):
+    """Normalize newline-separated titles in a single pass over the text."""
+    # Remove everything in parentheses (years, versions, etc.)
+    text = _PARENS_RE.sub('', text)
+    
+    # Remove common version/sequel markers
+    text = _MARKERS_RE.sub('', text)
+    
+    text = unicodedata.normalize("NFKD", text)
+    text = text.encode("ascii", "ignore").decode("ascii")
+    text = text.lower()
+    # Remove all non-alphanumeric characters and collapse spaces
+    return _NON_ALNUM_RE.sub("", text)
+
+
+def _remember(pairs):
+    with _memo_lock:
+        for title, norm in pairs:
+            _memo[title] = norm
+        while len(_memo) > NORMALIZE_CACHE_SIZE:
+            _memo.popitem(last=False)
+
+
+def normalize_titles(titles):
+    """Normalize many titles at once (see normalize_title), in input order.
+
+    Titles already in the memo are reused; the others are joined and go
+    through each precompiled pattern once, instead of once per title.
+    """
+    results = []
+    missing = {}
+    with _memo_lock:
+        for title in titles:
+            if not title:
+                results.append("")
+                continue
+            norm = _memo.get(title)
+            if norm is None:
+                missing.setdefault(title, [])
+                missing[title].append(len(results))
+            else:
+                _memo.move_to_end(title)
+            results.append(norm)
+
+    if missing:
+        keys = list(missing)
+        joined = "\n".join(k.replace("\n", " ") for k in keys)
+        norms = _normalize_joined(joined).split("\n")
+        for title, norm in zip(keys, norms):
+            for i in missing[title]:
+                results[i] = norm
+        _remember(zip(keys, norms))
+
+    return results
+
+
+def normalize_title(title):
+    """Normalize title for comparison (remove accents, lowercase, alphanum only)."""
+    if not title:
+        return ""
+    return normalize_titles((title,))[0]
+
+
+def collection_norm_titles(collection):
+    """Normalized titles of collection items, reusing the persisted ones."""
+    columnar = getattr(collection, "norm_titles", None)
+    if columnar is not None:
+        return columnar
+    norms = [x.get("norm_title") for x in collection]
+    missing = [i for i, norm in enumerate(norms) if norm is None]
+    if missing:
+        for i, norm in zip(missing, normalize_titles(collection[i]["title"] for i in missing)):
+            norms[i] = norm
+    return norms
+
+
+@lru_cache(maxsize=None)
+def _prefix_threshold(length):
+    """Smallest common prefix length considered too similar for a title of this length."""
+    for p in range(length + 1):
+        if p / length >= PREFIX_RATIO:
+            return p
+    return length
+
+
+class TitleIndex:
+    """Answers the recommender's "too similar" rules without scanning every title.
+
+    A candidate is too similar to the collection when, for some existing
+    title, one is a substring of the other, or both have at least
+    PREFIX_MIN_LEN characters and share a common prefix covering 80% of the
+    shorter one. Titles must already be normalized.
+    """
+
+    def __init__(self, normalized_titles):
+        self._titles = sorted({t for t in normalized_titles if t})
+        self._exact = set(self._titles)
+        self._lengths = sorted({len(t) for t in self._titles})
+
+        # n-gram -> ids of titles containing it, plus every shorter substring
+        self._grams = {}
+        self._short = set()
+        # prefix of length t(L) -> longest title having it (L <= len(title))
+        self._prefix_max_len = {}
+        # prefix of length t(len(title)) -> lengths of titles having it
+        self._prefix_lengths = {}
+
+        for i, title in enumerate(self._titles):
+            length = len(title)
+            for n in range(1, GRAM_SIZE):
+                for j in range(length - n + 1):
+                    self._short.add(title[j:j + n])
+            for j in range(length - GRAM_SIZE + 1):
+                self._grams.setdefault(title[j:j + GRAM_SIZE], set()).add(i)
+
+            if length < PREFIX_MIN_LEN:
+                continue
+            for p in {_prefix_threshold(m) for m in range(PREFIX_MIN_LEN, length + 1)}:
+                key = title[:p]
+                if self._prefix_max_len.get(key, 0) < length:
+                    self._prefix_max_len[key] = length
+            self._prefix_lengths.setdefault(title[:_prefix_threshold(length)], set()).add(length)
+
+    def __len__(self):
+        return len(self._titles)
+
+    def __contains__(self, norm_title):
+        return norm_title in self._exact
+
+    def is_too_similar(self, norm_title):
+        """Return True if the normalized title is too close to an indexed one."""
+        if not norm_title:
+            return False
+        if norm_title in self._exact:
+            return True
+        return (
+            self._contains_indexed(norm_title)
+            or self._is_contained(norm_title)
+            or self._shares_prefix(norm_title)
+        )
+
+    def _contains_indexed(self, norm_title):
+        """An indexed title is a substring of the candidate."""
+        size = len(norm_title)
+        for start in range(size):
+            for length in self._lengths:
+                if start + length > size:
+                    break
+                if norm_title[start:start + length] in self._exact:
+                    return True
+        return False
+
+    def _is_contained(self, norm_title):
+        """The candidate is a substring of an indexed title."""
+        size = len(norm_title)
+        if size < GRAM_SIZE:
+            return norm_title in self._short
+
+        postings = []
+        for gram in {norm_title[j:j + GRAM_SIZE] for j in range(size - GRAM_SIZE + 1)}:
+            ids = self._grams.get(gram)
+            if ids is None:
+                return False
+            postings.append(ids)
+
+        postings.sort(key=len)
+        candidates = postings[0]
+        for ids in postings[1:]:
+            candidates = candidates & ids
+            if not candidates:
+                return False
+        return any(norm_title in self._titles[i] for i in candidates)
+
+    def _shares_prefix(self, norm_title):
+        """The candidate and an indexed title share a long common prefix."""
+        size = len(norm_title)
+        if size < PREFIX_MIN_LEN:
+            return False
+
+        # Indexed titles at least as long as the candidate
+        if self._prefix_max_len.get(norm_title[:_prefix_threshold(size)], 0) >= size:
+            return True
+
+        # Shorter indexed titles: the prefix rule is relative to their length
+        for length in range(PREFIX_MIN_LEN, size):
+            if length in self._prefix_lengths.get(norm_title[:_prefix_threshold(length)], ()):
+                return True
+        return False
@@ -0,0 +1,169 @@
+"""Lightweight per-run spans, dumpable as JSON or Chrome trace format.
+
+Code marks its stages with `span(name, **attrs)`; spans are recorded into
+the trace activated with `tracing(trace)` for the current thread or asyncio
+context, and cost next to nothing when no trace is active. Chrome traces
+open in chrome://tracing or https://ui.perfetto.dev.
+"""
+import asyncio
+import cProfile
+import functools
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_current = ContextVar("watwatch_trace", default=None)
+
+
+class Span:
+    """One timed stage; attributes can be added while it runs."""
+
+    __slots__ = ("name", "start", "duration", "lane", "attrs")
+
+    def __init__(self, name, start, lane, attrs):
+        self.name = name
+        self.start = start
+        self.duration = None
+        self.lane = lane
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Trace:
+    """Spans of one run, timed relative to its creation."""
+
+    def __init__(self, name="watwatch", **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.spans = []
+        self._origin = time.perf_counter()
+        self._lanes = {}
+        self._lock = threading.Lock()
+
+    def _lane(self):
+        """Small id of the thread or asyncio task a span runs in."""
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        key = (threading.get_ident(), id(task) if task is not None else None)
+        with self._lock:
+            return self._lanes.setdefault(key, len(self._lanes))
+
+    @contextmanager
+    def span(self, name, **attrs):
+        record = Span(name, time.perf_counter() - self._origin, self._lane(), attrs)
+        try:
+            yield record
+        except BaseException as e:
+            record.attrs["error"] = type(e).__name__
+            raise
+        finally:
+            record.duration = time.perf_counter() - self._origin - record.start
+            with self._lock:
+                self.spans.append(record)
+
+    def summary(self):
+        """{name: (count, total seconds)} sorted by total time, largest first."""
+        totals = {}
+        for s in self.spans:
+            count, total = totals.get(s.name, (0, 0.0))
+            totals[s.name] = (count + 1, total + s.duration)
+        return dict(sorted(totals.items(), key=lambda item: item[1][1], reverse=True))
+
+    def to_json(self):
+        return {
+            "name": self.name,
+            "attrs": self.attrs,
+            "spans": [
+                {"name": s.name, "start": round(s.start, 6), "duration": round(s.duration, 6),
+                 "lane": s.lane, "attrs": s.attrs}
+                for s in sorted(self.spans, key=lambda s: s.start)
+            ],
+        }
+
+    def to_chrome_trace(self):
+        pid = os.getpid()
+        events = [
+            {"name": s.name, "ph": "X", "ts": round(s.start * 1e6), "dur": round(s.duration * 1e6),
+             "pid": pid, "tid": s.lane, "args": s.attrs}
+            for s in self.spans
+        ]
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": self.name}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path, fmt=None):
+        """Write the trace to `path`, as "chrome" if the name ends with .trace.json or fmt says so."""
+        if fmt is None:
+            fmt = "chrome" if path.endswith(".trace.json") else "json"
+        data = self.to_chrome_trace() if fmt == "chrome" else self.to_json()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, default=str)
+
+
+def current_trace():
+    return _current.get()
+
+
+@contextmanager
+def tracing(trace):
+    """Record the spans of the enclosed code into `trace`."""
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time a stage into the active trace, if any."""
+    trace = _current.get()
+    if trace is None:
+        yield _NULL_SPAN
+        return
+    with trace.span(name, **attrs) as record:
+        yield record
+
+
+def traced(name):
+    """Decorator timing every call of a function as a `name` span."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def profiling(path=None):
+    """Run the enclosed code under cProfile when `path` is set, dumping pstats there."""
+    if not path:
+        yield None
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
@@ -1,129 +1,134 @@
-from bokeh.plotting import figure, output_file, show
-from bokeh.models import ColumnDataSource, HoverTool, Range1d
-from bokeh.layouts import column
+"""Bokeh charts of the suggestions, ranked by AI score and by average with the global rating.
+
+Both charts are drawn from one columnar table, computed in a single pass
+over the suggestions and shared as a single ColumnDataSource. They can be
+opened in the browser, written as a standalone HTML file or exported as
+JSON for embedding in a web page, without any browser involved.
+"""
+import json
+
+import numpy as np
+
+from tracing import traced
+
+CHART_WIDTH = 1100
+CHART_HEIGHT = 500
+
+SCORE_TOOLTIPS = [
+    ("Titre", "@title"),
+    ("Score IA", "@score"),
+    ("SC Global", "@sc_text"),
+]
+AVERAGE_TOOLTIPS = [
+    ("Titre", "@title"),
+    ("Moyenne", "@avg_text"),
+    ("Score IA", "@score"),
+    ("SC Global", "@sc_text"),
+]
+
+
+def _label(suggestion):
+    year = suggestion.get("year")
+    return f"{suggestion['title']} ({year})" if year else suggestion["title"]
+
+
+def _global_rating(suggestion):
+    rating = suggestion.get("rating_sc_global")
+    return float(rating) if isinstance(rating, (int, float)) else np.nan
+
+
+def suggestion_table(suggestions):
+    """Chart columns of the suggestions, and their row orders by score and by average.
+
+    The average is (score + global rating × 10) / 2, or the score alone
+    when the global rating is unknown. Both orders are descending and
+    keep the suggestions' order between ties.
+    """
+    n = len(suggestions)
+    scores = np.fromiter((float(s["score"]) for s in suggestions), dtype=np.float64, count=n)
+    ratings = np.fromiter((_global_rating(s) for s in suggestions), dtype=np.float64, count=n)
+    known = ~np.isnan(ratings)
+    averages = np.where(known, (scores + ratings * 10) / 2, scores)
+    columns = {
+        "title": [_label(s) for s in suggestions],
+        "score": scores,
+        "average": averages,
+        "sc_text": np.where(known, np.char.mod("%.1f", ratings), "N/A").tolist(),
+        "avg_text": np.where(known, np.char.mod("%.1f", averages), "N/A").tolist(),
+    }
+    by_score = np.argsort(-scores, kind="stable")
+    by_average = np.argsort(-averages, kind="stable")
+    return columns, by_score, by_average
+
+
+def _bar_chart(source, factors, value, title, color, tooltips):
+    from bokeh.models import HoverTool, Range1d
+    from bokeh.plotting import figure
+
+    p = figure(x_range=factors, height=CHART_HEIGHT, width=CHART_WIDTH, title=title)
+    p.vbar(x="title", top=value, width=0.8, source=source, color=color)
+
+    values = source.data[value]
+    if len(values):
+        low, high = float(values.min()), float(values.max())
+        margin = max(1, (high - low) * 0.2)
+        p.y_range = Range1d(low - margin, high + margin)
+
+    p.xaxis.major_label_orientation = 1.2
+    p.add_tools(HoverTool(tooltips=tooltips))
+    return p
+
+
+def build_charts(suggestions):
+    """Layout of the score and average charts, drawn from one shared ColumnDataSource."""
+    # Bokeh is only imported once there is something to draw
+    from bokeh.layouts import column
+    from bokeh.models import ColumnDataSource
+
+    columns, by_score, by_average = suggestion_table(suggestions)
+    source = ColumnDataSource(data=columns)
+    titles = columns["title"]
+    return column(
+        _bar_chart(source, [titles[i] for i in by_score], "score",
+                   "Suggestions (Score IA)", "#4285f4", SCORE_TOOLTIPS),
+        _bar_chart(source, [titles[i] for i in by_average], "average",
+                   "Moyenne Score IA et SensCritique", "#34a853", AVERAGE_TOOLTIPS),
+    )
 
 
+@traced("output.bokeh")
 def show_bokeh(suggestions, filename="suggestions.html"):
-    """Display suggestions in an interactive Bokeh chart."""
-    # Sort suggestions by AI score (descending) for first chart
-    sorted_by_ai = sorted(suggestions, key=lambda x: float(x["score"]), reverse=True)
-    
-    # Add year to title display for first chart
-    titles_ai = []
-    for s in sorted_by_ai:
-        title = s["title"]
-        year = s.get("year")
-        if year:
-            title = f"{title} ({year})"
-        titles_ai.append(title)
-    
-    scores_ai = [float(s["score"]) for s in sorted_by_ai]
-    sc_vals_ai = [s.get("rating_sc_global") for s in sorted_by_ai]
-    sc_strs_ai = [f"{v:.1f}" if isinstance(v, (int, float)) and v is not None else "N/A" for v in sc_vals_ai]
-
-    # Sort suggestions by average score (descending) for second chart
-    suggestions_with_avg = []
-    for s in suggestions:
-        score = float(s["score"])
-        sc_val = s.get("rating_sc_global")
-        if isinstance(sc_val, (int, float)) and sc_val is not None:
-            avg = (score + sc_val * 10) / 2
-        else:
-            avg = score
-        suggestions_with_avg.append((s, avg))
-    
-    suggestions_with_avg.sort(key=lambda x: x[1], reverse=True)
-    sorted_by_avg = [s for s, _ in suggestions_with_avg]
-    
-    # Add year to title display for second chart
-    titles_avg = []
-    for s in sorted_by_avg:
-        title = s["title"]
-        year = s.get("year")
-        if year:
-            title = f"{title} ({year})"
-        titles_avg.append(title)
-    
-    scores_avg = [float(s["score"]) for s in sorted_by_avg]
-    sc_vals_avg = [s.get("rating_sc_global") for s in sorted_by_avg]
-    sc_strs_avg = [f"{v:.1f}" if isinstance(v, (int, float)) and v is not None else "N/A" for v in sc_vals_avg]
-
-    # Calculate averages for second chart
-    averages = []
-    avg_strs = []
-    for i, sc_val in enumerate(sc_vals_avg):
-        if isinstance(sc_val, (int, float)) and sc_val is not None:
-            sc_normalized = sc_val * 10
-            avg = (scores_avg[i] + sc_normalized) / 2
-            averages.append(avg)
-            avg_strs.append(f"{avg:.1f}")
-        else:
-            averages.append(scores_avg[i])
-            avg_strs.append("N/A")
-
-    # First chart: AI Scores (sorted by AI score)
-    source1 = ColumnDataSource(data=dict(
-        title=titles_ai,
-        score=scores_ai,
-        sc_text=sc_strs_ai,
-    ))
-
-    p1 = figure(
-        x_range=titles_ai,
-        height=500,
-        width=1100,
-        title="Suggestions (Score IA)"
-    )
+    """Display suggestions in an interactive Bokeh chart, opened in the browser."""
+    from bokeh.plotting import output_file, show
 
-    p1.vbar(x="title", top="score", width=0.8, source=source1, color="#4285f4")
-
-    y_min = min(scores_ai)
-    y_max = max(scores_ai)
-    margin = max(1, (y_max - y_min) * 0.2)
-    p1.y_range = Range1d(y_min - margin, y_max + margin)
-
-    p1.xaxis.major_label_orientation = 1.2
-
-    p1.add_tools(HoverTool(tooltips=[
-        ("Titre", "@title"),
-        ("Score IA", "@score"),
-        ("SC Global", "@sc_text"),
-    ]))
-
-    # Second chart: Average Scores (sorted by average)
-    source2 = ColumnDataSource(data=dict(
-        title=titles_avg,
-        average=averages,
-        ai_score=scores_avg,
-        sc_text=sc_strs_avg,
-        avg_text=avg_strs,
-    ))
-
-    p2 = figure(
-        x_range=titles_avg,
-        height=500,
-        width=1100,
-        title="Moyenne Score IA et SensCritique"
-    )
+    layout = build_charts(suggestions)
+    output_file(filename)
+    show(layout)
 
-    p2.vbar(x="title", top="average", width=0.8, source=source2, color="#34a853")
 
-    y_min2 = min(averages)
-    y_max2 = max(averages)
-    margin2 = max(1, (y_max2 - y_min2) * 0.2)
-    p2.y_range = Range1d(y_min2 - margin2, y_max2 + margin2)
+@traced("output.bokeh")
+def save_bokeh(suggestions, filename="suggestions.html", title="WatWatch"):
+    """Write the charts to a standalone HTML file, without opening a browser."""
+    from bokeh.embed import file_html
+    from bokeh.resources import CDN
 
-    p2.xaxis.major_label_orientation = 1.2
+    html = file_html(build_charts(suggestions), CDN, title)
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(html)
 
-    p2.add_tools(HoverTool(tooltips=[
-        ("Titre", "@title"),
-        ("Moyenne", "@avg_text"),
-        ("Score IA", "@ai_score"),
-        ("SC Global", "@sc_text"),
-    ]))
 
-    # Combine charts vertically
-    layout = column(p1, p2)
+@traced("output.bokeh.json")
+def chart_json(suggestions, target=None):
+    """The charts as a JSON-serializable item, rendered in a page with Bokeh.embed.embed_item."""
+    from bokeh.embed import json_item
 
-    output_file(filename)
-    show(layout)
+    return json_item(build_charts(suggestions), target)
+
+
+def write_charts(suggestions, filename):
+    """Write the charts as static JSON if `filename` ends with .json, as standalone HTML otherwise."""
+    if filename.endswith(".json"):
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(chart_json(suggestions), f)
+    else:
+        save_bokeh(suggestions, filename)